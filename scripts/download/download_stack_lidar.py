@@ -15,7 +15,7 @@ sys.path.append(expanduser('../'))
 from spicy_snow.retrieval import retrieve_snow_depth
 
 from spicy_snow.download.snowex_lidar import download_dem, download_snow_depth,\
-      download_veg_height, make_site_ds
+      download_veg_height, make_site_ds, get_site_extent
 
 lidar_dir = '/bsuhome/zacharykeskinen/scratch/lidar'
 os.makedirs(lidar_dir, exist_ok = True)
@@ -32,37 +32,35 @@ for site, site_name in sites.items():
     print(''.center(40, '-'))
     print(f'Starting {site_name}')
 
-    lidar_ds_site = make_site_ds(site, lidar_dir = lidar_dir)
+    # site bounds from the tif headers and flight dates from the filenames (each
+    # flight is only warped once onto the spicy-snow grid below)
+    area, flight_dates = get_site_extent(site, lidar_dir = lidar_dir)
 
-    lidar_ds_site = lidar_ds_site.where(lidar_ds_site < 1000).where(lidar_ds_site > -1000)
-
-    area = shapely.geometry.box(*lidar_ds_site.rio.bounds())
-
-    for date in lidar_ds_site.time:
+    for date in flight_dates:
         os.makedirs('/bsuhome/zacharykeskinen/scratch/SnowEx-Data/', exist_ok = True)
-        out_nc = f'/bsuhome/zacharykeskinen/scratch/SnowEx-Data/{site_name}_{(date).dt.strftime("%Y-%m-%d").values}.nc'
+        out_nc = f'/bsuhome/zacharykeskinen/scratch/SnowEx-Data/{site_name}_{date.strftime("%Y-%m-%d")}.nc'
 
         if exists(out_nc):
             print(f'Outfile {out_nc} exists already.')
             continue
 
-        print(f'Starting {site_name} snow depth @ {date.values}')
+        print(f'Starting {site_name} snow depth @ {date}')
 
-        if date.dt.month > 4:
+        if date.month > 4:
             continue
 
-        lidar_ds = lidar_ds_site.sel(time = date)
-
-        if date.dt.month < 8:
-            date1 = pd.to_datetime(f'{int(date.dt.year - 1)}-08-01')
+        if date.month < 8:
+            date1 = pd.to_datetime(f'{date.year - 1}-08-01')
         else:
-            date1 = pd.to_datetime(f'{int(date.dt.year)}-08-01')
+            date1 = pd.to_datetime(f'{date.year}-08-01')
 
-        dates = (date1.strftime('%Y-%m-%d'), pd.to_datetime((date + pd.Timedelta('14 day')).values).strftime('%Y-%m-%d'))
+        dates = (date1.strftime('%Y-%m-%d'), (date + pd.Timedelta('14 day')).strftime('%Y-%m-%d'))
 
         spicy_ds = retrieve_snow_depth(area = area, dates = dates, work_dir = '/bsuhome/zacharykeskinen/scratch/data/', job_name = f'spicy_{site}_{dates[1]}', existing_job_name = f'spicy_{site}_{dates[1]}')
 
-        lidar_ds = lidar_ds.rio.reproject_match(spicy_ds)
+        # warp this flight's tifs straight onto the spicy-snow grid
+        lidar_ds = make_site_ds(site, lidar_dir = lidar_dir, target = spicy_ds, dates = [date])
+        lidar_ds = lidar_ds.where(lidar_ds < 1000).where(lidar_ds > -1000).sel(time = date)
 
         ds = xr.merge([spicy_ds, lidar_ds], combine_attrs = 'drop_conflicts')
 
@@ -70,7 +68,7 @@ for site, site_name in sites.items():
 
         ds.attrs['site'] = site_name
         ds.attrs['site_abbrev'] = site
-        ds.attrs['lidar-flight-time'] = str((date).dt.strftime("%Y-%m-%d").values)
+        ds.attrs['lidar-flight-time'] = date.strftime("%Y-%m-%d")
         
         try:
             ds.to_netcdf(out_nc)
@@ -8,33 +8,17 @@ from shapely import wkt
 from shapely.geometry import box
 from pathlib import Path
 from datetime import datetime
-from scipy.stats import pearsonr
-from sklearn.metrics import mean_squared_error
 from tqdm import tqdm
 
 import sys
 sys.path.append(Path('../..'))
 
-from spicy_snow.processing.snow_index import calc_delta_cross_ratio, calc_delta_gamma, \
-    clip_delta_gamma_outlier, calc_snow_index, calc_snow_index_to_snow_depth
-from spicy_snow.processing.wet_snow import id_newly_wet_snow, id_wet_negative_si, \
-    id_newly_frozen_snow, flag_wet_snow
-
-def get_idx(x, y, z, q):
-    # ravel to numpy arrays
-    x = x.values.ravel()
-    y = y.values.ravel()
-    z = z.values.ravel()
-    q = q.values.ravel()
-
-    # find non nans
-    id = (~np.isnan(x)) & (~np.isnan(y)) & (~np.isnan(z)) & (~np.isnan(q))
-    return id
+from spicy_snow.processing.param_sweep import sweep_snow_index
 
 # Create parameter space
 A = np.round(np.arange(1, 3.1, 0.5), 2)
 B = np.round(np.arange(0, 1.01, 0.1), 2)
-C = np.round(np.arange(0, 1.001, 0.01), 2)
+# snow depth is snow_index * C so C is scored from the snow index (see param_stats)
 
 files = Path('/bsuhome/zacharykeskinen/spicy-snow/Lidar_s1_stacks/').glob('*fix.nc')
 
@@ -54,37 +38,19 @@ for f in files:
     if 'Frasier_2020-02-11.nc' in f.name:
         closest_ts = '2020-02-16T13:09:43'
 
-    param_dir.joinpath(ds_name).mkdir(exist_ok = True)
+    # pixels with lidar, fcf and dem to calculate
+    mask = dataset['lidar-sd'].notnull() & dataset['fcf'].notnull() & dataset['dem'].notnull()
 
-    # Brute-force processing loop
-    for a in tqdm(A):
-        # print(f'A: {a}')
-        ds = calc_delta_cross_ratio(dataset, A = a)
-        for b in B:
-            # print(f'    B: {b}')
-            ds = calc_delta_gamma(ds, B = b, inplace=False)
-            ds = clip_delta_gamma_outlier(ds)
-            ds = calc_snow_index(ds)
-            ds = id_newly_wet_snow(ds)
-            ds = id_wet_negative_si(ds)
-            ds = id_newly_frozen_snow(ds)
-            ds = flag_wet_snow(ds)
-            for c in C:
-                # print(f'        c: {c}')
-                # print(f'A={a}; B={b}; C={c}')
+    # snow index for every A, B with dims (A, B, pixel)
+    si = sweep_snow_index(dataset, A, B, closest_ts, mask = mask)
 
-                ds = calc_snow_index_to_snow_depth(ds, C = c)
+    # drop pixels without a snow index retrieval (same for all parameters)
+    si = si.isel(pixel = si.isel(A = 0, B = 0).notnull().values)
 
-                sub = ds.sel(time = closest_ts)[['snow_depth', 'lidar-sd', 'fcf', 'dem']]
-                id = get_idx(sub['snow_depth'], sub['lidar-sd'], sub['fcf'], sub['dem'])
-                spicy_sd = sub['snow_depth'].values.ravel()[id]
-                # param_np = np.vstack([spicy_sd, spicy_wet])
-                np.save(param_dir.joinpath(ds_name, f'{a}_{b}_{c}.npy'), spicy_sd)
+    # add lidar, fcf, and dem of the same pixels
+    param_ds = si.to_dataset()
+    pixel_sel = {dim: xr.DataArray(si[dim].values, dims = 'pixel') for dim in ['x', 'y']}
+    for var in ['lidar-sd', 'fcf', 'dem']:
+        param_ds[var] = dataset[var].sel(pixel_sel).drop_vars(['x', 'y', 'time'], errors = 'ignore')
 
-                if not param_dir.joinpath(ds_name, 'lidar.npy').exists():
-                    lidar_sd = sub['lidar-sd'].values.ravel()[id]
-                    np.save(param_dir.joinpath(ds_name, f'lidar.npy'), lidar_sd)
-                    fcf = sub['fcf'].values.ravel()[id]
-                    np.save(param_dir.joinpath(ds_name, f'fcf.npy'), fcf)
-                    dem = sub['dem'].values.ravel()[id]
-                    np.save(param_dir.joinpath(ds_name, f'dem.npy'), dem)
+    param_ds.to_netcdf(param_dir.joinpath(f'{ds_name}.nc'))
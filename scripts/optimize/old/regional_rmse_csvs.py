@@ -1,141 +1,64 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import xarray as xr
 from pathlib import Path
-from sklearn.metrics import mean_squared_error
+
+from spicy_snow.processing.param_stats import calc_sufficient_stats, calc_c_scores, calc_optimal_c
 
 out_dir = Path('/bsuhome/zacharykeskinen/spicy-snow/results/site_param_rmses/')
 
-# get best for each site
-res = pd.DataFrame()
-regions = Path('~/scratch/param_regional').expanduser()
-for region in regions.glob('*'):
+# Create parameter space
+C = np.round(np.arange(0, 1.001, 0.01), 2)
+
+# sufficient statistics of each site's snow index (A, B, pixel) from generate_param_ds.py
+regions = Path('~/scratch/param_regional_v2').expanduser()
+stats = {}
+for region in regions.glob('*.nc'):
     print(region.stem)
-    lidar = np.load(next(region.glob('lidar.npy')))
-    lowest_rmse = np.inf
-    best = {'a': -1, 'b': -1, 'c': -1}
-    for param_set in region.glob('*_*.npy'):
-        a, b, c = param_set.stem.split('_')
-        rmse = mean_squared_error(lidar, np.load(param_set), squared = False)
-        if rmse < lowest_rmse:
-            lowest_rmse = rmse
-            best['a'], best['b'], best['c'] = a, b, c
-    for k, v in best.items():
-        res.loc[region.stem, k] = v
-    res.loc[region.stem, 'rmse'] = lowest_rmse
-res.to_csv(out_dir.joinpath('varying_all.csv'))
+    param_ds = xr.open_dataset(region)
+    stats[region.stem] = calc_sufficient_stats(param_ds['snow_index'], param_ds['lidar-sd'])
+stats = xr.concat(stats.values(), dim = pd.Index(list(stats.keys()), name = 'location'))
 
-# get best holding A and B constant
+# rmse for every location, A, B, C
+rmse = calc_c_scores(stats, C)['rmse']
 
-res = pd.DataFrame()
-for region in regions.glob('*'):
-    print(region.stem)
-    lidar = np.load(next(region.glob('lidar.npy')))
-    lowest_rmse = np.inf
-    best = {'a': -1, 'b': -1, 'c': -1}
-    for param_set in region.glob('*_*.npy'):
-        a, b, c = param_set.stem.split('_')
-        if a != '1.0' or b != '1.0':
-            continue
-        rmse = mean_squared_error(lidar, np.load(param_set), squared = False)
-        if rmse < lowest_rmse:
-            lowest_rmse = rmse
-            best['a'], best['b'], best['c'] = a, b, c
-    for k, v in best.items():
-        res.loc[region.stem, k] = v
-    res.loc[region.stem, 'rmse'] = lowest_rmse
-res.to_csv(out_dir.joinpath('varying_c.csv'))
+def best_params(rmse):
+    # lowest rmse and its parameters for each location
+    res = pd.DataFrame()
+    for loc in rmse.location.values:
+        loc_rmse = rmse.sel(location = loc)
+        best = loc_rmse.isel(loc_rmse.argmin(...))
+        res.loc[loc, 'a'], res.loc[loc, 'b'], res.loc[loc, 'c'] = best.A.values, best.B.values, best.C.values
+        res.loc[loc, 'rmse'] = best.values
+    return res
 
-# get best holding A constant
+# get best for each site
+best_params(rmse).to_csv(out_dir.joinpath('varying_all.csv'))
 
-res = pd.DataFrame()
-for region in regions.glob('*'):
-    print(region.stem)
-    lidar = np.load(next(region.glob('lidar.npy')))
-    lowest_rmse = np.inf
-    best = {'a': -1, 'b': -1, 'c': -1}
-    for param_set in region.glob('*_*.npy'):
-        a, b, c = param_set.stem.split('_')
-        if a != '1.0':
-            continue
-        rmse = mean_squared_error(lidar, np.load(param_set), squared = False)
-        if rmse < lowest_rmse:
-            lowest_rmse = rmse
-            best['a'], best['b'], best['c'] = a, b, c
-    for k, v in best.items():
-        res.loc[region.stem, k] = v
-    res.loc[region.stem, 'rmse'] = lowest_rmse
-res.to_csv(out_dir.joinpath('varying_b_c.csv'))
+# get best holding A and B constant
+best_params(rmse.sel(A = [1.0], B = [1.0])).to_csv(out_dir.joinpath('varying_c.csv'))
 
-# get best holding B constant
+# get best holding A constant
+best_params(rmse.sel(A = [1.0])).to_csv(out_dir.joinpath('varying_b_c.csv'))
 
-res = pd.DataFrame()
-for region in regions.glob('*'):
-    print(region.stem)
-    lidar = np.load(next(region.glob('lidar.npy')))
-    lowest_rmse = np.inf
-    best = {'a': -1, 'b': -1, 'c': -1}
-    for param_set in region.glob('*_*.npy'):
-        a, b, c = param_set.stem.split('_')
-        if b != '1.0':
-            continue
-        rmse = mean_squared_error(lidar, np.load(param_set), squared = False)
-        if rmse < lowest_rmse:
-            lowest_rmse = rmse
-            best['a'], best['b'], best['c'] = a, b, c
-    for k, v in best.items():
-        res.loc[region.stem, k] = v
-    res.loc[region.stem, 'rmse'] = lowest_rmse
-res.to_csv(out_dir.joinpath('varying_a_c.csv'))
+# get best holding B constant
+best_params(rmse.sel(B = [1.0])).to_csv(out_dir.joinpath('varying_a_c.csv'))
 
 # get rmse for leivens 2021 params
-
-res = pd.DataFrame()
-for region in regions.glob('*'):
-    print(region.stem)
-    lidar = np.load(next(region.glob('lidar.npy')))
-    lowest_rmse = np.inf
-    best = {'a': -1, 'b': -1, 'c': -1}
-    for param_set in region.glob('*_*.npy'):
-        a, b, c = param_set.stem.split('_')
-        if a != '2.0' or b != '0.5' or c != '0.44':
-            continue
-        rmse = mean_squared_error(lidar, np.load(param_set), squared = False)
-        if rmse < lowest_rmse:
-            lowest_rmse = rmse
-            best['a'], best['b'], best['c'] = a, b, c
-    for k, v in best.items():
-        res.loc[region.stem, k] = v
-    res.loc[region.stem, 'rmse'] = lowest_rmse
-res.to_csv(out_dir.joinpath('leivens_params.csv'))
+best_params(rmse.sel(A = [2.0], B = [0.5], C = [0.44])).to_csv(out_dir.joinpath('leivens_params.csv'))
 
 # get rmse for when global best (all site optimation is used)
+global_rmse = calc_c_scores(stats.sum('location'), C)['rmse']
+global_best = global_rmse.isel(global_rmse.argmin(...))
+print(f'Global best: A = {global_best.A.values}, B = {global_best.B.values}, C = {global_best.C.values}')
+best_params(rmse.sel(A = [global_best.A], B = [global_best.B], C = [global_best.C])).to_csv(out_dir.joinpath('all_sites.csv'))
 
-combo_nps = Path('~/scratch/params_np').expanduser()
-global_best = {'a': -1, 'b': -1, 'c': -1}
-lowest_rmse = np.inf
-for param_set in combo_nps.glob('*'):
-    a, b, c = param_set.stem.split('_')
-    data = np.load(param_set)
-    rmse = mean_squared_error(data[0, :], data[1, :] , squared = False)
-    if rmse < lowest_rmse:
-        lowest_rmse = rmse
-        global_best['a'], global_best['b'], global_best['c'] = a, b, c
-
+# get best for each site with the analytic optimal C for each A, B
+optimal = calc_optimal_c(stats)
 res = pd.DataFrame()
-for region in regions.glob('*'):
-    lidar = np.load(next(region.glob('lidar.npy')))
-    lowest_rmse = np.inf
-    best = {'a': -1, 'b': -1, 'c': -1}
-    for param_set in region.glob('*_*.npy'):
-        a, b, c = param_set.stem.split('_')
-        if a != global_best['a'] or b != global_best['b'] or c != global_best['c']:
-            continue
-        rmse = mean_squared_error(lidar, np.load(param_set), squared = False)
-        if rmse < lowest_rmse:
-            lowest_rmse = rmse
-            best['a'], best['b'], best['c'] = a, b, c
-    for k, v in best.items():
-        res.loc[region.stem, k] = v
-    res.loc[region.stem, 'rmse'] = lowest_rmse
-res.to_csv(out_dir.joinpath('all_sites.csv'))
\ No newline at end of file
+for loc in optimal.location.values:
+    loc_optimal = optimal.sel(location = loc)
+    best = loc_optimal.isel(loc_optimal['rmse'].argmin(...))
+    res.loc[loc, 'a'], res.loc[loc, 'b'], res.loc[loc, 'c'] = best.A.values, best.B.values, best['C'].values
+    res.loc[loc, 'rmse'] = best['rmse'].values
+res.to_csv(out_dir.joinpath('varying_all_optimal_c.csv'))
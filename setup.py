@@ -44,13 +44,16 @@ REQUIRED = [
           'shapely',
           'hyp3_sdk',
           'asf_search',
-          'matplotlib'
+          'matplotlib',
+          'requests'
       ]
 
 
 # What packages are optional?
 EXTRAS = {
-    'ipykernel', 'ipywidgets'
+    # out of core retrievals in spatial chunks (retrieve_snow_depth(chunks = ...))
+    'dask': ['dask'],
+    'notebooks': ['ipykernel', 'ipywidgets']
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -134,7 +137,7 @@ setup(
     #     'console_scripts': ['mycli=mymodule:cli'],
     # },
     install_requires=REQUIRED,
-    # extras_require=EXTRAS,
+    extras_require=EXTRAS,
     test_suite='tests',
     include_package_data=True,
     license='MIT',
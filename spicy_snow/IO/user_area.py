@@ -2,11 +2,19 @@
 Helper function to get bounding box from user
 """
 
+import numpy as np
 import shapely.geometry
 import xarray as xr
 import rioxarray as rxa
+from rasterio.transform import Affine, from_origin
+from rasterio.warp import transform_bounds
 
-from typing import Tuple, List
+from typing import Tuple, List, Union
+
+# global lat/long grid of all products. Pixel edges are whole multiples of the
+# resolution from the origin so every area's grid shares pixel centres.
+GRID_ORIGIN = (-180, 90)
+GRID_RESOLUTION = 1 / 1200
 
 def get_input_area(coords: Tuple[List[str], List[float], bool] = False,
                    img: Tuple[xr.Dataset, xr.DataArray, bool] = False):
@@ -55,4 +63,76 @@ format. Provided list {coords} doesn't have 4 elements. Has {len(coords)}."
         
         area = shapely.geometry.box(*img.rio.bounds())
 
-    return area
\ No newline at end of file
+    return area
+
+def snap_area(area: shapely.geometry.Polygon, resolution: float = GRID_RESOLUTION) -> shapely.geometry.Polygon:
+    """
+    Helper function to snap the bounds of an area outward to the pixel edges
+    of the global grid.
+
+    Args:
+    area: shapely.geometry.Polygon of area in lat/long
+    resolution: pixel size in degrees [default: 1/1200 (3 arc seconds ~ 90 m)]
+
+    Returns:
+    snapped: shapely.geometry.Polygon of the bounding box of whole global grid pixels
+    """
+    xmin, ymin, xmax, ymax = area.bounds
+    x0, y0 = GRID_ORIGIN
+
+    # pixel edges counted from the origin (rounded to avoid an extra column or
+    # row from floating point error)
+    col_min, col_max = np.floor(np.round((xmin - x0) / resolution, 6)), np.ceil(np.round((xmax - x0) / resolution, 6))
+    row_min, row_max = np.floor(np.round((y0 - ymax) / resolution, 6)), np.ceil(np.round((y0 - ymin) / resolution, 6))
+
+    return shapely.geometry.box(x0 + col_min * resolution, y0 - row_max * resolution,
+                                x0 + col_max * resolution, y0 - row_min * resolution)
+
+def get_area_grid(area: shapely.geometry.Polygon, resolution: float = GRID_RESOLUTION) -> Tuple[Tuple[int, int], Affine]:
+    """
+    Helper function to get the lat/long grid all images of an area are warped
+    onto. The grid is the window of the global grid covering the area (see
+    snap_area) so grids of overlapping areas share pixel centres.
+
+    Args:
+    area: shapely.geometry.Polygon of area in lat/long
+    resolution: pixel size in degrees [default: 1/1200 (3 arc seconds ~ 90 m)]
+
+    Returns:
+    shape: (height, width) of the grid
+    transform: affine transform of the grid in EPSG:4326
+    """
+    xmin, ymin, xmax, ymax = snap_area(area, resolution = resolution).bounds
+
+    width = int(round((xmax - xmin) / resolution))
+    height = int(round((ymax - ymin) / resolution))
+
+    transform = from_origin(xmin, ymax, resolution, resolution)
+
+    return (height, width), transform
+
+def clip_to_bounds(img: Union[xr.Dataset, xr.DataArray], bounds: Tuple[float, float, float, float],
+                   crs: str = 'EPSG:4326', margin: int = 2) -> Union[xr.Dataset, xr.DataArray]:
+    """
+    Helper function to clip an image to bounds before warping it, so only the
+    needed window is read and reprojected. Clipping happens in the image's CRS
+    with a margin of pixels kept for resampling. Images that do not intersect
+    the bounds are returned unclipped.
+
+    Args:
+    img: xarray dataset or dataArray with a rio CRS and transform
+    bounds: (xmin, ymin, xmax, ymax) to clip to
+    crs: CRS of bounds [default: 'EPSG:4326']
+    margin: number of image pixels to keep around bounds [default: 2]
+
+    Returns:
+    img: image clipped to bounds
+    """
+    xmin, ymin, xmax, ymax = transform_bounds(crs, img.rio.crs, *bounds, densify_pts = 21)
+    left, bottom, right, top = img.rio.bounds()
+    if not (xmin < right and xmax > left and ymin < top and ymax > bottom):
+        return img
+
+    res_x, res_y = np.abs(img.rio.resolution())
+    return img.rio.clip_box(xmin - margin * res_x, ymin - margin * res_y,
+                            xmax + margin * res_x, ymax + margin * res_y)
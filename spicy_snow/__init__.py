@@ -1 +1,2 @@
-from .retrieval import retrieve_snow_depth
\ No newline at end of file
+from .retrieval import retrieve_snow_depth, append_snow_depth
+from .tiling import retrieve_snow_depth_tiled
\ No newline at end of file
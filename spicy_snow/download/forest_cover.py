@@ -6,6 +6,7 @@ import sys
 import os
 from os.path import basename, exists, expanduser, join
 import shutil
+import numpy as np
 import shapely
 import rioxarray as rxa
 import xarray as xr
@@ -14,35 +15,67 @@ import logging
 log = logging.getLogger(__name__)
 
 sys.path.append(expanduser('~/Documents/spicy-snow'))
-from spicy_snow.utils.download import url_download
+from spicy_snow.utils.download import url_download, cached_download
+from spicy_snow.IO.user_area import clip_to_bounds
 
-def download_fcf(dataset: xr.Dataset, out_fp: str) -> xr.Dataset:
+# this is the url from Lievens et al. 2021 paper
+FCF_URL = 'https://zenodo.org/record/3939050/files/PROBAV_LC100_global_v3.0.1_2019-nrt_Tree-CoverFraction-layer_EPSG-4326.tif'
+
+def get_fcf_fp(out_fp: str = None, cache: bool = True) -> str:
+    """
+    Get the filepath of the global PROBA-V forest-cover-fraction layer,
+    downloading it if needed.
+
+    The layer is kept once per machine in the read-only download cache so it
+    is shared by every work directory.
+
+    Args:
+    out_fp: filepath to save the layer to if not caching
+    cache: keep the layer in the spicy-snow cache directory [default: True]
+
+    Returns:
+    fcf_fp: filepath of the global forest-cover-fraction tif
+    """
+    if cache:
+        return str(cached_download(FCF_URL))
+
+    assert out_fp is not None, "out_fp is required if not caching the forest cover fraction"
+    # download just forest cover fraction to out file
+    url_download(FCF_URL, out_fp)
+
+    return str(out_fp)
+
+def download_fcf(dataset: xr.Dataset, out_fp: str = None, cache: bool = True) -> xr.Dataset:
     """
     Download PROBA-V forest-cover-fraction images.
 
+    Only the window of the global layer covering the dataset is read. fcf is
+    float32 0-1 in memory and saved to netcdf as uint8 0-100 with a 0.01 scale
+    factor.
+
     Args:
     dataset: large dataset to add IMS data to
-    out_fp: filepath to save tiff of results
+    out_fp: filepath to save tiff of results if not caching
+    cache: read the global layer from the spicy-snow cache directory [default: True]
 
     Returns:
     dataset: large dataset with 'fcf' added as data variable
     """
     log.debug("Downloading Forest Cover")
-    # this is the url from Lievens et al. 2021 paper
-    fcf_url = 'https://zenodo.org/record/3939050/files/PROBAV_LC100_global_v3.0.1_2019-nrt_Tree-CoverFraction-layer_EPSG-4326.tif'
-    # download just forest cover fraction to out file
-    url_download(fcf_url, out_fp)
-    # open as dataArray and return
-    fcf = rxa.open_rasterio(out_fp)
+    fcf_fp = get_fcf_fp(out_fp, cache = cache)
+    # open as dataArray (lazily so only the clipped window is read)
+    fcf = rxa.open_rasterio(fcf_fp)
 
     # reproject FCF and clip to match dataset
     log.debug(f"Clipping FCF to {dataset['s1'].rio.bounds()}")
-    # clip first to avoid super long reproject processes
-    fcf = fcf.rio.clip_box(*dataset['s1'].rio.bounds())
+    fcf = clip_to_bounds(fcf, dataset['s1'].rio.bounds(), crs = dataset['s1'].rio.crs)
     # reproject FCF to match dataset
     fcf = fcf.rio.reproject_match(dataset['s1'])
     # remove band dimension as it only has one band
-    fcf = fcf.squeeze('band')
+    fcf = fcf.squeeze('band', drop = True).astype(np.float32)
+    # use the dataset's coordinates so fcf aligns exactly
+    x_dim, y_dim = dataset['s1'].rio.x_dim, dataset['s1'].rio.y_dim
+    fcf = fcf.assign_coords({x_dim: dataset[x_dim], y_dim: dataset[y_dim]})
     # if max is greater than 1 set to 0-1
     if fcf.max() >= 1:
         log.debug("fcf max > 1 so dividing by 100")
@@ -55,9 +88,13 @@ def download_fcf(dataset: xr.Dataset, out_fp: str) -> xr.Dataset:
     log.debug(f'FCF min: {fcf.min()}')
     log.debug(f'FCF max: {fcf.max()}')
     log.debug(f'FCF mean: {fcf.mean()}')
+
+    # save as percent in one byte
+    fcf.attrs = {}
+    fcf.encoding = {'dtype': 'uint8', 'scale_factor': 0.01, '_FillValue': 255}
     
-    # merge FCF and name it 'fcf' as a data variable
-    dataset = xr.merge([dataset, fcf.rename('fcf')])
+    # add FCF and name it 'fcf' as a data variable
+    dataset = dataset.assign(fcf = fcf)
 
     return dataset
 
@@ -6,23 +6,29 @@ import sys
 import os
 from os.path import basename, exists, expanduser, join
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import asf_search as asf
+import numpy as np
 import pandas as pd
 import xarray as xr
 import rioxarray as rxa
 from rioxarray.merge import merge_arrays
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, array_bounds
 import shapely.geometry
 from datetime import date
 from tqdm import tqdm
 import hyp3_sdk as sdk
 from hyp3_sdk.exceptions import AuthenticationError
 
-from typing import Dict, Tuple, List, Union
+from typing import Callable, Dict, Iterator, Tuple, List, Union
 
 import sys
 from os.path import expanduser
 sys.path.append(expanduser('~/Documents/spicy-snow'))
-from spicy_snow.utils.download import url_download
+from spicy_snow.utils.download import cached_download, get_cache_dir
+from spicy_snow.IO.user_area import clip_to_bounds, get_area_grid, GRID_RESOLUTION
 from spicy_snow.processing.s1_preprocessing import s1_power_to_dB
 
 import logging
@@ -70,7 +76,24 @@ def s1_img_search(area: shapely.geometry.Polygon, dates: Tuple[str, str]) -> pd.
 
     return results
 
-def hyp3_pipeline(search_results: pd.DataFrame, job_name, existing_job_name: Union[bool, str] = False) -> sdk.jobs.Batch:
+def get_hyp3_client() -> sdk.HyP3:
+    """
+    Log in to Hyp3 with .netrc credentials or prompt for a password.
+
+    Returns:
+    hyp3: HyP3 client
+    """
+    try:
+        # .netrc
+        hyp3 = sdk.HyP3()
+    except AuthenticationError:
+        # prompt for password
+        hyp3 = sdk.HyP3(prompt = True)
+
+    return hyp3
+
+def hyp3_pipeline(search_results: pd.DataFrame, job_name, existing_job_name: Union[bool, str] = False,
+                  watch: bool = True, hyp3: sdk.HyP3 = None) -> sdk.jobs.Batch:
     """
     Start and monitor Hyp3 pipeline for desired Sentinel-1 granules
     https://hyp3-docs.asf.alaska.edu/using/sdk_api/
@@ -79,21 +102,25 @@ def hyp3_pipeline(search_results: pd.DataFrame, job_name, existing_job_name: Uni
     search_results: Pandas Dataframe of asf_search search results.
     job_name: name to give hyp3 batch run
     existing_job_name: if you have an existing job that you want to find and reuse [default: False]
+    watch: wait for the jobs to finish. If False the submitted (or existing
+    succeeded and running) jobs are returned straight away to use with
+    iter_hyp3_jobs [default: True]
+    hyp3: HyP3 client [default: log in with get_hyp3_client]
 
     Returns:
-    rtc_jobs: Hyp3 batch object of completed jobs.
+    rtc_jobs: Hyp3 batch object of completed jobs (or submitted jobs if not watching).
     """ 
-    try:
-        # .netrc
-        hyp3 = sdk.HyP3()
-    except AuthenticationError:
-        # prompt for password
-        hyp3 = sdk.HyP3(prompt = True)
+    if hyp3 is None:
+        hyp3 = get_hyp3_client()
 
     # if existing job name exists then don't submit and simply watch existing jobs.
     while existing_job_name:
         log.debug(f"existing name provided {existing_job_name}.")
         rtc_jobs = hyp3.find_jobs(name = existing_job_name)
+        # only jobs of searched granules (jobs of a name can be shared by
+        # several areas e.g. the tiles of retrieve_snow_depth_tiled)
+        granules = set(search_results['properties.sceneName'])
+        rtc_jobs = sdk.Batch([job for job in rtc_jobs if job.job_parameters['granules'][0] in granules])
         rtc_jobs = rtc_jobs.filter_jobs(succeeded = True, failed = False, \
             running = True, include_expired = False)
         log.debug(f"Found {len(rtc_jobs)} jobs under existing name. \
@@ -108,6 +135,9 @@ def hyp3_pipeline(search_results: pd.DataFrame, job_name, existing_job_name: Uni
             log.debug("No running jobs. Returning succeeded.")
             return rtc_jobs.filter_jobs(succeeded = True)
 
+        if not watch:
+            return rtc_jobs
+
         # otherwise watch running jobs
         hyp3.watch(rtc_jobs)
 
@@ -143,6 +173,9 @@ def hyp3_pipeline(search_results: pd.DataFrame, job_name, existing_job_name: Uni
         rtc_jobs += hyp3.submit_rtc_job(g, name = job_name, include_inc_map = True,\
             scale = 'power', dem_matching = False, resolution = 30)
 
+    if not watch:
+        return rtc_jobs
+
     # warn user this may take a few hours for big jobs
     log.info(f'Watching {len(rtc_jobs)} jobs. This may take a while...')
 
@@ -160,85 +193,143 @@ def hyp3_pipeline(search_results: pd.DataFrame, job_name, existing_job_name: Uni
     # return only successful jobs
     return rtc_jobs.filter_jobs(succeeded = True)
 
-def download_hyp3(jobs: sdk.jobs.Batch, area: shapely.geometry.Polygon, outdir: str, clean = True) -> Dict[str, xr.DataArray]:
+def iter_hyp3_jobs(jobs: sdk.jobs.Batch, hyp3: sdk.HyP3 = None, interval: float = 60,
+                   timeout: float = 10800) -> Iterator[sdk.jobs.Job]:
     """
-    Download rtc Sentinel-1 images from Hyp3 pipeline.
-    https://hyp3-docs.asf.alaska.edu/using/sdk_api/
+    Yield hyp3 jobs as soon as they succeed so each can be downloaded while
+    the rest are still running. Failed jobs are logged and skipped.
 
     Args:
-    jobs: hyp3 Batch object of completed jobs
+    jobs: hyp3 Batch of submitted jobs
+    hyp3: HyP3 client [default: log in with get_hyp3_client]
+    interval: seconds between checking the status of unfinished jobs [default: 60]
+    timeout: seconds to wait for all jobs to finish [default: 10800]
+
+    Returns:
+    jobs: generator of succeeded jobs in the order they finished
+    """
+    pending = list(jobs)
+    start = time.time()
+
+    while pending:
+        running = []
+        for job in pending:
+            if job.succeeded():
+                yield job
+            elif job.failed():
+                log.info(f'Job {job.job_id} failed.')
+            else:
+                running.append(job)
+
+        if not running:
+            break
+
+        if time.time() - start >= timeout:
+            raise TimeoutError(f"{len(running)} hyp3 jobs did not finish in {timeout} seconds")
+        time.sleep(interval)
+
+        if hyp3 is None:
+            hyp3 = get_hyp3_client()
+        # refresh the status of unfinished jobs
+        pending = list(hyp3.refresh(sdk.Batch(running)))
+
+def _download_hyp3_granule(url: str, granule: str, grid: Tuple[Tuple[int, int], Affine], outdir: str) -> xr.DataArray:
+    """
+    Download the VV, VH and incidence angle tifs of one hyp3 rtc product and
+    warp them onto the area's grid as a 3 band image.
+
+    Each tif is only read in a window around the grid in its native CRS and
+    warped once with average resampling.
+
+    Args:
+    url: url of the hyp3 product .zip
+    granule: Sentinel-1 granule name of the product
+    grid: (shape, transform) of the lat/long grid from get_area_grid
     outdir: directory to save tif files.
-    clean: clean up tiffs after creating DataArray [default: True]
 
     Returns:
-    images: dictionary of granule names and DataArrays
+    da: 3 band DataArray of VV, VH, and inc
     """
-    log.debug(f"Downloading hyp3 jobs into {outdir}")
-    # make data directory to store incoming tifs
-    os.makedirs(outdir, exist_ok = True)
+    shape, transform = grid
+    grid_bounds = array_bounds(*shape, transform)
 
-    # results dictionary to send to next step
-    dataArrays = {}
+    # create dictionary to hold cloud url from .zip url
+    # this lets us download only VV, VH, inc without getting other data from zip
+    urls = {}
+    urls[f'{granule}_VV'] = url.replace('.zip', '_VV.tif')
+    urls[f'{granule}_VH'] = url.replace('.zip', '_VH.tif')
+    urls[f'{granule}_inc'] = url.replace('.zip', '_inc_map.tif')
+    imgs = []
+    for name, url in urls.items():
+        # download url to a tif file (linked from the download cache)
+        cached_download(url, join(outdir, f'{name}.tif'), verbose = False)
 
-    # grab first granule name for reprojecting matching
-    first_granule = jobs[0].job_parameters['granules'][0]
+        # open image in xarray (lazily so only the clipped window is read)
+        img = rxa.open_rasterio(join(outdir, f'{name}.tif'), masked = True)
 
-    # loop through jobs
-    for job in tqdm(jobs, desc = 'Downloading S1 images'):
-        # capture url from job description
-        u = job.files[0]['url']
+        img = clip_to_bounds(img, grid_bounds)
 
-        # capture granule (for metadata scraping)
-        granule = job.job_parameters['granules'][0]
+        # warp onto the grid averaging all pixels within each grid cell
+        img = img.rio.reproject('EPSG:4326', shape = shape, transform = transform, resampling = Resampling.average)
 
-        # skip this loop if granule is repeated in job list
-        if granule in dataArrays.keys():
-            continue
+        # create band name
+        band_name = name.replace(f'{granule}_', '')
 
-        # create dictionary to hold cloud url from .zip url
-        # this lets us download only VV, VH, inc without getting other data from zip
-        urls = {}
-        urls[f'{granule}_VV'] = u.replace('.zip', '_VV.tif')
-        urls[f'{granule}_VH'] = u.replace('.zip', '_VH.tif')
-        urls[f'{granule}_inc'] = u.replace('.zip', '_inc_map.tif')
-        imgs = []
-        for name, url in urls.items():
-            # download url to a tif file
-            url_download(url, join(outdir, f'{name}.tif'), verbose = False)
+        # add band to image
+        img = img.assign_coords(band = [band_name])
 
-            # open image in xarray
-            img = rxa.open_rasterio(join(outdir, f'{name}.tif'), masked = True)
+        # add named band image to 3 image stack
+        imgs.append(img)
 
-            # reproject to WGS84
-            img = img.rio.reproject('EPSG:4326')
+    # concat VV, VH, and inc into one xarray DataArray
+    da = xr.concat(imgs, dim = 'band')
 
-            # clip to user specified area
-            img = img.rio.clip_box(*area.bounds)
+    return da
 
-            # pad to user specified area
-            img = img.rio.pad_box(*area.bounds)
+def download_hyp3(jobs: sdk.jobs.Batch, area: shapely.geometry.Polygon, outdir: str, clean = True,
+                  max_workers: int = 4, resolution: float = GRID_RESOLUTION) -> Dict[str, xr.DataArray]:
+    """
+    Download rtc Sentinel-1 images from Hyp3 pipeline.
+    https://hyp3-docs.asf.alaska.edu/using/sdk_api/
 
-            # create band name
-            band_name = name.replace(f'{granule}_', '')
+    Granules are downloaded and processed concurrently by a pool of threads so
+    downloads overlap with the raster processing of finished granules. Every
+    image is warped onto the same lat/long grid of the area. Each job is
+    started as soon as it is taken from jobs so a generator from
+    iter_hyp3_jobs downloads jobs while others are still running.
 
-            # add band to image
-            img = img.assign_coords(band = [band_name])
+    Args:
+    jobs: hyp3 Batch object (or iterable) of completed jobs
+    area: Bounding box of desired area
+    outdir: directory to save tif files.
+    clean: clean up tiffs after creating DataArray [default: True]
+    max_workers: number of granules to download and process at once [default: 4]
+    resolution: pixel size in degrees [default: 1/1200 (3 arc seconds ~ 90 m)]
 
-            # add named band image to 3 image stack
-            imgs.append(img)
+    Returns:
+    images: dictionary of granule names and DataArrays in the order of jobs
+    """
+    log.debug(f"Downloading hyp3 jobs into {outdir}")
+    # make data directory to store incoming tifs
+    os.makedirs(outdir, exist_ok = True)
 
-        # concat VV, VH, and inc into one xarray DataArray
-        da = xr.concat(imgs, dim = 'band')
+    # grid shared by all images
+    grid = get_area_grid(area, resolution = resolution)
 
-        # coarsen to correct resolution (90 m)
-        da = da.coarsen(x = 3, boundary = 'trim').mean().coarsen(y = 3, boundary = 'trim').mean()
+    # download and process each granule in the thread pool as jobs arrive
+    # (skipping granules repeated in job list)
+    futures = {}
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for job in jobs:
+            granule = job.job_parameters['granules'][0]
+            if granule not in futures:
+                futures[granule] = executor.submit(_download_hyp3_granule, job.files[0]['url'], granule, grid, outdir)
 
-        # we need to reproject each image to match the first image to make CRSs work
-        if dataArrays:
-            da = da.rio.reproject_match(dataArrays[first_granule])
+        for future in tqdm(as_completed(futures.values()), total = len(futures), desc = 'Downloading S1 images'):
+            future.result()
 
-        # add img to downloaded dataArrays list with granule as key
-        dataArrays[granule] = da
+    # results dictionary to send to next step in job order
+    dataArrays = {granule: future.result() for granule, future in futures.items()}
     
     # remove temp directory of tiffs
     if clean:
@@ -246,32 +337,128 @@ def download_hyp3(jobs: sdk.jobs.Batch, area: shapely.geometry.Polygon, outdir:
 
     return dataArrays
 
-def combine_s1_images(dataArrays: Dict[str, xr.DataArray]) -> xr.Dataset:
+def search_granule_metadata(granules: List[str]) -> pd.DataFrame:
+    """
+    Look up the flight direction, relative and absolute orbit of granules
+    with a single asf_search product search.
+
+    Args:
+    granules: list of Sentinel-1 granule names
+
+    Returns:
+    metadata: Dataframe indexed by granule with flight_dir, relative_orbit and
+    absolute_orbit columns
+    """
+    log.debug(f"Searching asf for metadata of {len(granules)} granules")
+    results = asf.product_search([f'{granule}-GRD_HD' for granule in granules])
+
+    metadata = pd.DataFrame([[r.properties['sceneName'], r.properties['flightDirection'].lower(),
+                              r.properties['pathNumber'], r.properties['orbit']] for r in results],
+                            columns = ['granule', 'flight_dir', 'relative_orbit', 'absolute_orbit'])
+
+    return metadata.set_index('granule')
+
+def resolve_granule_metadata(granules: List[str], search_results: Union[None, pd.DataFrame] = None,
+                             resolver: Callable[[List[str]], pd.DataFrame] = search_granule_metadata,
+                             cache: bool = True) -> pd.DataFrame:
+    """
+    Get the flight direction, relative and absolute orbit of granules. Metadata
+    is taken from the s1_img_search results first, then the local metadata
+    cache and only the remaining granules are looked up with one resolver call.
+
+    Args:
+    granules: list of Sentinel-1 granule names
+    search_results: optional Dataframe of asf_search results from s1_img_search
+    resolver: function returning metadata of a list of granules in the format
+    of search_granule_metadata [default: search_granule_metadata]
+    cache: read and save metadata in the local cache [default: True]
+
+    Returns:
+    metadata: Dataframe indexed by granule with flight_dir, relative_orbit and
+    absolute_orbit columns in the order of granules
+    """
+    columns = ['flight_dir', 'relative_orbit', 'absolute_orbit']
+    metadata = pd.DataFrame(columns = columns, index = pd.Index([], name = 'granule'))
+
+    # metadata already in the search results
+    if search_results is not None:
+        found = pd.DataFrame({'flight_dir': search_results['properties.flightDirection'].str.lower().values,
+                              'relative_orbit': search_results['properties.pathNumber'].values,
+                              'absolute_orbit': search_results['properties.orbit'].values},
+                             index = pd.Index(search_results['properties.sceneName'].values, name = 'granule'))
+        metadata = _add_metadata(metadata, found, granules)
+
+    # metadata from previous runs
+    cache_fp = get_cache_dir().joinpath('s1_metadata.csv') if cache else None
+    cached = pd.DataFrame(columns = columns, index = pd.Index([], name = 'granule'))
+    if cache and cache_fp.exists():
+        cached = pd.read_csv(cache_fp, index_col = 'granule')
+        metadata = _add_metadata(metadata, cached, granules)
+
+    # look up the rest at once
+    missing = [granule for granule in granules if granule not in metadata.index]
+    if missing:
+        metadata = _add_metadata(metadata, resolver(missing), granules)
+
+    missing = [granule for granule in granules if granule not in metadata.index]
+    assert not missing, f"No metadata found for granules: {missing}"
+
+    # save new metadata to the cache
+    if cache and not metadata.index.isin(cached.index).all():
+        cached = pd.concat([cached, metadata[~metadata.index.isin(cached.index)]])
+        tmp_fp = cache_fp.with_suffix(f'.{os.getpid()}.tmp')
+        cached.to_csv(tmp_fp)
+        os.replace(tmp_fp, cache_fp)
+
+    return metadata.loc[list(granules)]
+
+def _add_metadata(metadata: pd.DataFrame, new: pd.DataFrame, granules: List[str]) -> pd.DataFrame:
+    """
+    Add rows of new metadata for granules not yet in metadata.
+    """
+    new = new[new.index.isin(granules) & ~new.index.isin(metadata.index)]
+    new = new[~new.index.duplicated()]
+
+    if len(metadata) == 0:
+        return new
+
+    return pd.concat([metadata, new])
+
+def combine_s1_images(dataArrays: Dict[str, xr.DataArray], search_results: Union[None, pd.DataFrame] = None,
+                      metadata_resolver: Callable[[List[str]], pd.DataFrame] = search_granule_metadata) -> xr.Dataset:
     """
     Combine list of 3-banded Sentinel 1 data Arrays into a single xarray
     Dataset with associated metadata bands and attributes.
 
     Args:
     dataArrays: dictionary of granule name and 3 band Sentinel-1 data Arrays
+    search_results: optional Dataframe of asf_search results to take granule
+    metadata from before the metadata cache and metadata_resolver
+    metadata_resolver: function to look up metadata of granules not in search
+    results or the cache (see resolve_granule_metadata)
 
     Returns:
     dataset: xr dataset with time dimension added, metadata attributes, and 
     metadata coordinates (flight direction, orbit #, platform)
     """
+    # flight direction and orbits of all granules
+    metadata = resolve_granule_metadata(list(dataArrays.keys()), search_results = search_results,
+                                        resolver = metadata_resolver)
+
     das = []
 
     for granule, da in tqdm(dataArrays.items(), desc = 'Combining Sentinel-1 dataArrays'):
         # get granule metadata
-        granule_metadata = asf.product_search(f'{granule}-GRD_HD')[0]
+        granule_metadata = metadata.loc[granule]
 
         # set flight direction
-        flight_dir = granule_metadata.properties['flightDirection'].lower()
+        flight_dir = granule_metadata['flight_dir']
 
         # set relative orbit 
-        relative_orbit = granule_metadata.properties['pathNumber']
+        relative_orbit = granule_metadata['relative_orbit']
 
         # set absolute orbit
-        absolute_orbit = granule_metadata.properties['orbit']
+        absolute_orbit = granule_metadata['absolute_orbit']
 
         # expand time dimension of DataArray from zero dimension (scalar) to 1d
         da = da.expand_dims(dim = {'time': 1})
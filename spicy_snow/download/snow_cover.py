@@ -7,6 +7,7 @@ https://nsidc.org/data/user-resources/help-center/how-access-data-using-ftp-clie
 
 import sys
 import os
+import hashlib
 from os.path import basename, exists, expanduser, join
 import shutil
 from datetime import datetime
@@ -15,81 +16,255 @@ from urllib.error import URLError
 from tqdm import tqdm
 from pyproj import Transformer
 import shapely
+import numpy as np
 import pandas as pd
 import xarray as xr
 import rioxarray as rxa
+from rasterio.warp import transform_bounds
+from rasterio.windows import from_bounds
+
+from typing import List, Tuple
 
 import logging
 log = logging.getLogger(__name__)
 
 sys.path.append(expanduser('~/Documents/spicy-snow'))
-from spicy_snow.utils.download import url_download, decompress
+from spicy_snow.utils.download import url_download, decompress, get_cache_dir
+
+# url of gzipped IMS 1 km netcdfs by year and day of year
+IMS_URL = 'ftp://sidads.colorado.edu/pub/DATASETS/NOAA/G02156/netcdf/1km/{year}/ims{year}{doy}_1km_v1.3.nc.gz'
 
-def get_ims_day_data(year: str, doy: str, tmp_dir: str) -> xr.DataArray:
+def fetch_ims_day(year: str, doy: str, out_dir: str, max_days: int = 10) -> str:
     """
-    Download and decompress one days worth of IMS data.
+    Download and decompress one days worth of IMS data into out_dir. Days are
+    saved by the requested year and day of year so a day already in out_dir
+    is not downloaded again.
+
+    If the day is missing from the IMS archive the next available day (up to
+    max_days later) is used.
 
     Args:
     year: Year of the data you want.
     doy: Calendar day of year you want in 'DDD' format. Range is 001 - 366.
+    out_dir: directory to save decompressed IMS netcdfs to
+    max_days: number of days to try before raising an error [default: 10]
+
+    Returns:
+    out_fp: filepath of the decompressed IMS netcdf
     """
+    os.makedirs(out_dir, exist_ok = True)
 
-    # make temporary directory
-    cd = os.getcwd()
-    os.makedirs(tmp_dir, exist_ok = True)
-    os.chdir(tmp_dir)
+    out_fp = join(out_dir, f'ims{year}{doy}_1km_v1.3.nc')
 
     # if we haven't found a file that works add one more to day and try again
-    local_fp = None
-    while not local_fp:
+    for day in range(int(doy), int(doy) + max_days):
+        if exists(out_fp):
+            break
+        url = IMS_URL.format(year = year, doy = f'{day:03}')
         try:
-            # download IMS data for this day and year
-            local_fp, _ = urllib.request.urlretrieve(f'ftp://sidads.colorado.edu/pub/DATASETS/NOAA/G02156/netcdf/1km/{year}/ims{year}{doy}_1km_v1.3.nc.gz', f'ims{year}{doy}_1km_v1.3.nc.gz')
-        except:
-            doy = f'{int(doy) + 1:03}'
-    # decompress .gz compression
-    out_file = decompress(local_fp, local_fp.replace('.gz',''))
-    # open as xarray dataArray
-    ims = rxa.open_rasterio(out_file, decode_times = False)
-    os.chdir(cd)
-    return ims
-
-
-def download_snow_cover(dataset: xr.Dataset, tmp_dir: str = './tmp', clean: bool = True) -> xr.Dataset:
+            # stream the download through decompression into out_dir
+            with urllib.request.urlopen(url) as response:
+                decompress(response, out_fp)
+        except (URLError, OSError) as e:
+            log.debug(f"Unable to get IMS data from {url}: {e}")
+    
+    assert exists(out_fp), f"No IMS data found for {year} from day {doy} to {int(doy) + max_days - 1}"
+
+    return out_fp
+
+def fetch_ims_days(times: List, tmp_dir: str = './tmp', cache: bool = True) -> List[str]:
+    """
+    Download the IMS days of a list of times into the directory that
+    download_snow_cover reads them from. Used to fetch IMS data while
+    Sentinel-1 images are still being processed.
+
+    Args:
+    times: list of timestamps (anything pd.to_datetime reads)
+    tmp_dir: filepath to save downloads to if not caching [default: './tmp']
+    cache: save IMS days in the spicy-snow cache directory [default: True]
+
+    Returns:
+    fps: filepaths of each unique day
+    """
+    ims_dir = get_cache_dir('ims') if cache else tmp_dir
+
+    days = [pd.to_datetime(t) for t in times]
+    keys = dict.fromkeys((day.year, f'{day.dayofyear:03}') for day in days)
+
+    return [fetch_ims_day(year, doy, out_dir = ims_dir) for year, doy in keys]
+
+def get_ims_day_data(year: str, doy: str, out_dir: str, max_days: int = 10,
+                     bounds: Tuple[float, float, float, float] = None, crs: str = 'EPSG:4326',
+                     margin: int = 2) -> xr.DataArray:
+    """
+    Download and decompress one days worth of IMS data. Days are saved in
+    out_dir by the requested year and day of year so a day already in out_dir
+    is only opened.
+
+    If the day is missing from the IMS archive the next available day (up to
+    max_days later) is used.
+
+    Args:
+    year: Year of the data you want.
+    doy: Calendar day of year you want in 'DDD' format. Range is 001 - 366.
+    out_dir: directory to save decompressed IMS netcdfs to
+    max_days: number of days to try before raising an error [default: 10]
+    bounds: (xmin, ymin, xmax, ymax) of the area to read. Only the window of
+    IMS pixels covering bounds is read [default: None reads the full grid]
+    crs: CRS of bounds [default: 'EPSG:4326']
+    margin: number of IMS pixels to add around bounds for resampling [default: 2]
+
+    Returns:
+    ims: DataArray of IMS snow cover
+    """
+    out_fp = fetch_ims_day(year, doy, out_dir, max_days = max_days)
+
+    # open as xarray dataArray (lazily so only the window is read)
+    ims = rxa.open_rasterio(out_fp, decode_times = False)
+
+    if bounds is not None:
+        ims = ims.isel(get_ims_window(ims, bounds, crs = crs, margin = margin))
+
+    return ims.load()
+
+def get_ims_window(ims: xr.DataArray, bounds: Tuple[float, float, float, float],
+                   crs: str = 'EPSG:4326', margin: int = 2) -> dict:
+    """
+    Get the rows and columns of the IMS polar stereographic grid covering bounds.
+
+    Args:
+    ims: DataArray of IMS snow cover
+    bounds: (xmin, ymin, xmax, ymax) of the area
+    crs: CRS of bounds [default: 'EPSG:4326']
+    margin: number of pixels to add on each side of the window [default: 2]
+
+    Returns:
+    window: dictionary of y and x slices to pass to isel
+    """
+    # densify so the curved edges of the area in polar stereographic are covered
+    ims_bounds = transform_bounds(crs, ims.rio.crs, *bounds, densify_pts = 21)
+    window = from_bounds(*ims_bounds, transform = ims.rio.transform())
+
+    height, width = ims.rio.height, ims.rio.width
+    row_start = int(np.clip(np.floor(window.row_off) - margin, 0, height))
+    row_stop = int(np.clip(np.ceil(window.row_off + window.height) + margin, 0, height))
+    col_start = int(np.clip(np.floor(window.col_off) - margin, 0, width))
+    col_stop = int(np.clip(np.ceil(window.col_off + window.width) + margin, 0, width))
+
+    assert row_stop > row_start and col_stop > col_start, f"Bounds {bounds} are outside of the IMS grid"
+
+    return {ims.rio.y_dim: slice(row_start, row_stop), ims.rio.x_dim: slice(col_start, col_stop)}
+
+
+def get_resampling_index(src: xr.DataArray, dst: xr.DataArray, cache: bool = True) -> np.ndarray:
+    """
+    Get the nearest neighbour source pixel of every target pixel to resample
+    rasters on the src grid onto the dst grid.
+
+    The index only depends on the two grids so it is saved in the spicy-snow
+    cache directory by a hash of the grids and reused.
+
+    Args:
+    src: DataArray on the source grid with a CRS
+    dst: DataArray on the target grid with a CRS
+    cache: read and save the index in the local cache [default: True]
+
+    Returns:
+    index: (y, x) array of flat (row * width + col) source pixel index of each
+    target pixel. -1 where the target pixel is outside of the source grid.
+    """
+    src_x, src_y = src[src.rio.x_dim].values, src[src.rio.y_dim].values
+    dst_x, dst_y = dst[dst.rio.x_dim].values, dst[dst.rio.y_dim].values
+
+    key = hashlib.sha1()
+    for crs, x, y in [(src.rio.crs, src_x, src_y), (dst.rio.crs, dst_x, dst_y)]:
+        key.update(crs.to_wkt().encode())
+        key.update(np.ascontiguousarray(x, dtype = np.float64).tobytes())
+        key.update(np.ascontiguousarray(y, dtype = np.float64).tobytes())
+    index_fp = get_cache_dir('resampling').joinpath(f'{key.hexdigest()}.npy') if cache else None
+
+    if cache and index_fp.exists():
+        log.debug(f"Using cached resampling index {index_fp}")
+        return np.load(index_fp)
+
+    # source pixel containing the center of each target pixel
+    transformer = Transformer.from_crs(dst.rio.crs, src.rio.crs, always_xy = True)
+    xx, yy = np.meshgrid(dst_x, dst_y)
+    xx, yy = transformer.transform(xx, yy)
+    cols, rows = ~src.rio.transform(recalc = True) * (xx, yy)
+    rows, cols = np.floor(rows), np.floor(cols)
+
+    height, width = len(src_y), len(src_x)
+    valid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    index = np.where(valid, rows * width + cols, -1).astype(np.int64)
+
+    if cache:
+        tmp_fp = index_fp.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_fp, 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp_fp, index_fp)
+
+    return index
+
+def download_snow_cover(dataset: xr.Dataset, tmp_dir: str = './tmp', clean: bool = True, cache: bool = True) -> xr.Dataset:
     """
     Download IMS snow-cover images.
 
+    Each day is downloaded once even if several Sentinel-1 images are from the
+    same day. All days are resampled (nearest neighbour) onto the Sentinel-1
+    grid with one gather from a cached resampling index.
+
     Args:
     dataset: Full dataset to add IMS data to
-    tmp_dir: filepath to save temporary downloads to [default: './tmp']
+    tmp_dir: filepath to save temporary downloads to if not caching [default: './tmp']
     clean: Remove temporary directory after download?
+    cache: save IMS days in the spicy-snow cache directory to reuse between
+    runs and areas instead of tmp_dir [default: True]
 
     Returns:
-    None
+    dataset: Full dataset with 'ims' (time, y, x) uint8 data var
     """
+    ims_dir = get_cache_dir('ims') if cache else tmp_dir
+
+    # only read IMS pixels around the Sentinel-1 area
+    bounds, crs = dataset['s1'].rio.bounds(), dataset['s1'].rio.crs
+
     # get list of days that we have Sentinel-1 data for
     days = [pd.to_datetime(d) for d in dataset.time.values]
+    day_keys = [(day.year, f'{day.dayofyear:03}') for day in days]
 
-    all_ims = []
-    for day in tqdm(days, desc = 'Downloading IMS snow-cover'):
+    unique_keys = list(dict.fromkeys(day_keys))
+    ims_days = []
+    for year, doy in tqdm(unique_keys, desc = 'Downloading IMS snow-cover'):
         # download IMS data for this day and open with xarray
-        ims = get_ims_day_data(day.year, f'{day.dayofyear:03}', tmp_dir = tmp_dir) #revert to clean = True at somepoint
-        # add timestamp info
-        ims = ims.assign_coords(time = [day])
-        # reproject and clip to match dataset
-        ims = ims.rio.reproject_match(dataset['s1'])
-        # add day to list of ims days
-        all_ims.append(ims)
-    # make dataArray of all IMS images
-    full_ims = xr.concat(all_ims, dim = 'time')
+        ims = get_ims_day_data(year, doy, out_dir = ims_dir, bounds = bounds, crs = crs)
+        # every day has the same window of the IMS grid
+        assert ims.size == ims.rio.height * ims.rio.width, f"Expected one IMS image for {year} {doy}"
+        ims_days.append(ims.values.astype(np.uint8).ravel())
+
+    # (day, pixel) stack of IMS days with a 0 (outside of IMS) pixel at the end
+    # for target pixels outside of the IMS window
+    ims_stack = np.zeros((len(ims_days), ims.rio.height * ims.rio.width + 1), dtype = np.uint8)
+    ims_stack[:, :-1] = ims_days
+
+    # source pixel of each target pixel and IMS day of each timestamp
+    index = get_resampling_index(ims, dataset['s1'], cache = cache)
+    day_index = np.array([unique_keys.index(key) for key in day_keys])
+
+    # gather every timestamp's resampled image at once
+    full_ims = ims_stack[day_index[:, None, None], index[None]]
+
+    y_dim, x_dim = dataset['s1'].rio.y_dim, dataset['s1'].rio.x_dim
+    full_ims = xr.DataArray(full_ims, dims = ['time', y_dim, x_dim],
+                            coords = {'time': dataset.time, y_dim: dataset[y_dim], x_dim: dataset[x_dim]})
 
     # add dataArray of IMS to the sentinel-1 dataset with timestamp information
-    dataset = xr.merge([dataset, full_ims.rename('ims')])
+    dataset = dataset.assign(ims = full_ims)
     
     # remove data directory of downloaded IMS tifs
-    if clean == True:
+    if clean == True and not cache and exists(tmp_dir):
         shutil.rmtree(tmp_dir)
     
     return dataset
 
-# End of file
\ No newline at end of file
+# End of file
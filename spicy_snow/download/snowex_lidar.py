@@ -2,20 +2,29 @@ import sys
 import os
 from os.path import basename, exists, expanduser, join
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 import asf_search as asf
+import numpy as np
 import pandas as pd
 import xarray as xr
 import rioxarray as rxa
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, array_bounds
+from rasterio.warp import calculate_default_transform
 from rioxarray.merge import merge_arrays
 import shapely.geometry
 from datetime import date
 from tqdm import tqdm
 from glob import glob
 
+from typing import Dict, List, Tuple, Union
+
 import sys
 from os.path import expanduser
 sys.path.append(expanduser('~/Documents/spicy-snow'))
 from spicy_snow.utils.nsidc import cmr_download, cmr_search
+from spicy_snow.IO.user_area import clip_to_bounds
 
 import logging
 log = logging.getLogger(__name__)
@@ -32,8 +41,6 @@ def download_dem(out_dir = './tmp'):
     None
     """
     os.makedirs(out_dir, exist_ok = True)
-    old_cd = os.getcwd()
-    os.chdir(out_dir)
 
     short_name = 'SNEX20_QSI_DEM'
     version = '1'
@@ -53,12 +60,10 @@ def download_dem(out_dir = './tmp'):
                                     bounding_box=bounding_box, polygon=polygon,
                                     filename_filter=filename_filter, quiet=quiet)
 
-        cmr_download(url_list, force=force, quiet=quiet)
+        cmr_download(url_list, force=force, quiet=quiet, out_dir=out_dir)
     except KeyboardInterrupt:
         quit()
 
-    os.chdir(old_cd)
-
 def download_snow_depth(out_dir = './tmp'):
     """
     Function to download snow depth files to outdir.
@@ -72,8 +77,6 @@ def download_snow_depth(out_dir = './tmp'):
     """
 
     os.makedirs(out_dir, exist_ok = True)
-    old_cd = os.getcwd()
-    os.chdir(out_dir)
 
     short_name = 'SNEX20_QSI_SD'
     version = '1'
@@ -93,11 +96,9 @@ def download_snow_depth(out_dir = './tmp'):
                                     bounding_box=bounding_box, polygon=polygon,
                                     filename_filter=filename_filter, quiet=quiet)
 
-        cmr_download(url_list, force=force, quiet=quiet)
+        cmr_download(url_list, force=force, quiet=quiet, out_dir=out_dir)
     except KeyboardInterrupt:
         quit()
-    
-    os.chdir(old_cd)
 
 def download_veg_height(out_dir = './tmp'):
     """
@@ -112,8 +113,6 @@ def download_veg_height(out_dir = './tmp'):
     """
 
     os.makedirs(out_dir, exist_ok = True)
-    old_cd = os.getcwd()
-    os.chdir(out_dir)
 
     short_name = 'SNEX20_QSI_VH'
     version = '1'
@@ -133,46 +132,146 @@ def download_veg_height(out_dir = './tmp'):
                                     bounding_box=bounding_box, polygon=polygon,
                                     filename_filter=filename_filter, quiet=quiet)
 
-        cmr_download(url_list, force=force, quiet=quiet)
+        cmr_download(url_list, force=force, quiet=quiet, out_dir=out_dir)
     except KeyboardInterrupt:
         quit()
-    
-    os.chdir(old_cd)
 
-def make_site_ds(site: str, lidar_dir: str) -> xr.Dataset:
+def _open_lidar_tif(fp: str, grid: Tuple[str, Tuple[int, int], Affine], resampling: Resampling) -> xr.DataArray:
     """
-    Makes a dataset of snow depth, veg height, and DEM for a specific site abbreviation
-    in the lidar directory. Returns it reprojected to EPSG4326.
+    Lazily open one lidar tif and warp only its window around grid onto grid.
+
+    Args:
+    fp: filepath of lidar tif
+    grid: (crs, shape, transform) to warp onto
+    resampling: rasterio resampling method
+
+    Returns:
+    img: DataArray of the tif on grid with a time dimension from its filename
+    """
+    crs, shape, transform = grid
+    date = pd.to_datetime(basename(fp).split('_')[-2])
+
+    img = rxa.open_rasterio(fp).squeeze(dim = 'band', drop = True)
+
+    img = clip_to_bounds(img, array_bounds(*shape, transform), crs = crs)
+
+    img = img.rio.reproject(crs, shape = shape, transform = transform, resampling = resampling)
+
+    return img.expand_dims(time = [date])
+
+def _get_lidar_grid(files: List[str]) -> Tuple[str, Tuple[int, int], Affine]:
+    """
+    Get the EPSG:4326 grid covering every lidar tif in files.
+
+    Args:
+    files: filepaths of lidar tifs in one CRS
+
+    Returns:
+    grid: (crs, shape, transform) of the grid
+    """
+    bounds, resolutions, crs = [], [], None
+    for f in files:
+        with rasterio.open(f) as src:
+            assert crs is None or src.crs == crs, "Lidar tifs of a site must share a CRS"
+            crs = src.crs
+            bounds.append(src.bounds)
+            resolutions.append(src.res)
+
+    bounds = np.array(bounds)
+    left, bottom = bounds[:, 0].min(), bounds[:, 1].min()
+    right, top = bounds[:, 2].max(), bounds[:, 3].max()
+    res_x, res_y = np.min(resolutions, axis = 0)
+    width, height = int(round((right - left) / res_x)), int(round((top - bottom) / res_y))
+
+    transform, width, height = calculate_default_transform(crs, 'EPSG:4326', width, height, left, bottom, right, top)
+
+    return 'EPSG:4326', (height, width), transform
+
+def _get_site_files(site: str, lidar_dir: str, dates: List = None) -> Dict[str, List[str]]:
+    """
+    Get the snow depth, veg height and DEM tifs of a site.
 
     Args:
     site: Site abbreviation to search for
     lidar_dir: Direction of lidar tiffs
+    dates: optional dates of lidar flights to use [default: all]
 
     Returns:
-    dataset: xarray dataset of dem, sd, vh for site
+    files: dictionary of image type (SD, VH, DEM) and sorted filepaths
     """
+    files = {}
+    for img_type in ['SD', 'VH', 'DEM']:
+        files[img_type] = sorted(glob(join(lidar_dir, f'*_{img_type}_*_{site}_*.tif')))
+        assert files[img_type], f"No files found for {img_type} at {site}"
 
-    dataset = xr.Dataset()
+        if dates is not None:
+            dates = pd.to_datetime(dates)
+            files[img_type] = [f for f in files[img_type] if pd.to_datetime(basename(f).split('_')[-2]) in dates]
+            assert files[img_type], f"No files found for {img_type} at {site} on {list(dates)}"
 
-    for img_type in ['SD', 'VH', 'DEM']:
-        files = glob(join(lidar_dir, f'*_{img_type}_*_{site}_*.tif'))
-        assert files, f"No files found for {img_type} at {site}"
-        
-        imgs = []
-        for f in files:
+    return files
 
-            date = pd.to_datetime(basename(f).split('_')[-2])
+def get_site_extent(site: str, lidar_dir: str) -> Tuple[shapely.geometry.Polygon, pd.DatetimeIndex]:
+    """
+    Get the bounds and flight dates of a site without reading or warping its
+    tifs. Bounds are those of the EPSG:4326 grid of make_site_ds (from the tif
+    headers) and dates are from the filenames.
 
-            img = rxa.open_rasterio(f)
+    Args:
+    site: Site abbreviation to search for
+    lidar_dir: Direction of lidar tiffs
 
-            img = img.squeeze(dim = 'band')
-            
-            img = img.expand_dims(time = [date])
+    Returns:
+    area: shapely box of the site in lat/long
+    dates: sorted dates of the site's lidar flights
+    """
+    files = [f for fps in _get_site_files(site, lidar_dir).values() for f in fps]
+    _, shape, transform = _get_lidar_grid(files)
+    dates = pd.DatetimeIndex(sorted({pd.to_datetime(basename(f).split('_')[-2]) for f in files}))
 
-            imgs.append(img)
-    
-        dataset['lidar-' + img_type.lower()] = xr.concat(imgs, dim = 'time')
+    return shapely.geometry.box(*array_bounds(*shape, transform)), dates
 
-    dataset = dataset.rio.reproject('EPSG:4326')
-    
-    return dataset
\ No newline at end of file
+def make_site_ds(site: str, lidar_dir: str, target: Union[xr.Dataset, xr.DataArray] = None,
+                 dates: List = None, resampling: Resampling = None, max_workers: int = 4) -> xr.Dataset:
+    """
+    Makes a dataset of snow depth, veg height, and DEM for a specific site abbreviation
+    in the lidar directory. Returns it reprojected to EPSG4326 or onto target's grid.
+
+    Tifs are opened lazily and warped in parallel, each reading only the
+    window needed for the output grid. Without a target the grid is the
+    EPSG:4326 grid covering every tif of the site.
+
+    Args:
+    site: Site abbreviation to search for
+    lidar_dir: Direction of lidar tiffs
+    target: optional dataset (e.g. a spicy-snow retrieval) to warp onto
+    dates: optional dates of lidar flights to use [default: all]
+    resampling: rasterio resampling method [default: average with a target
+    else nearest]
+    max_workers: number of tifs to warp at once [default: 4]
+
+    Returns:
+    dataset: xarray dataset of dem, sd, vh for site
+    """
+    files = _get_site_files(site, lidar_dir, dates = dates)
+
+    if target is not None:
+        grid = (target.rio.crs, target.rio.shape, target.rio.transform())
+        resampling = Resampling.average if resampling is None else resampling
+    else:
+        grid = _get_lidar_grid([f for fps in files.values() for f in fps])
+        resampling = Resampling.nearest if resampling is None else resampling
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {img_type: [executor.submit(_open_lidar_tif, f, grid, resampling) for f in fps]
+                   for img_type, fps in files.items()}
+
+        dataset = xr.Dataset()
+        for img_type, imgs in futures.items():
+            dataset['lidar-' + img_type.lower()] = xr.concat([future.result() for future in imgs], dim = 'time')
+
+    if target is not None:
+        # use the target's coordinates so the lidar aligns exactly
+        dataset = dataset.assign_coords(x = target.x, y = target.y)
+
+    return dataset
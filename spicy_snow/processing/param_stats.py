@@ -0,0 +1,196 @@
+"""
+Functions to score the snow depth retrieval against observed snow depths for
+calibrating the A, B, C parameters.
+
+Snow depth is snow_index * C so the RMSE, bias and pearson r of every C can be
+calculated from the sums Σx, Σy, Σxy, Σx², Σy² and n of the snow index (x) and
+the observed snow depth (y). The sums are additive so statistics of several
+sites can be summed to score them together.
+"""
+
+import numpy as np
+import xarray as xr
+
+from typing import Sequence, Union
+
+import logging
+log = logging.getLogger(__name__)
+
+def calc_sufficient_stats(snow_index: xr.DataArray, observed: xr.DataArray, dim: str = 'pixel') -> xr.Dataset:
+    """
+    Calculate the sums needed to score snow_index * C against observed snow
+    depths for any C. Only pixels where both are valid are used.
+
+    Args:
+    snow_index: DataArray of snow index, e.g. (A, B, pixel) from sweep_snow_index
+    observed: DataArray of observed (lidar) snow depths along dim
+    dim: dimension to sum over [default: 'pixel']
+
+    Returns:
+    stats: Dataset with n, sum_x, sum_y, sum_xy, sum_xx, sum_yy with the
+    dimensions of snow_index except dim
+    """
+    valid = snow_index.notnull() & observed.notnull()
+    x = snow_index.where(valid, 0)
+    y = observed.where(valid, 0)
+
+    stats = xr.Dataset()
+    stats['n'] = valid.sum(dim)
+    stats['sum_x'] = x.sum(dim)
+    stats['sum_y'] = y.sum(dim)
+    stats['sum_xy'] = (x * y).sum(dim)
+    stats['sum_xx'] = (x ** 2).sum(dim)
+    stats['sum_yy'] = (y ** 2).sum(dim)
+
+    return stats
+
+def calc_c_scores(stats: xr.Dataset, C: Sequence[float]) -> xr.Dataset:
+    """
+    Calculate the RMSE, bias and pearson r of snow_index * C against the
+    observed snow depths for every C from sufficient statistics.
+
+    RMSE(C) = sqrt((C² Σx² - 2C Σxy + Σy²) / n)
+    bias(C) = (C Σx - Σy) / n
+    r(C) = sign(C) * (n Σxy - Σx Σy) / sqrt((n Σx² - (Σx)²) (n Σy² - (Σy)²))
+
+    Args:
+    stats: Dataset of sufficient statistics from calc_sufficient_stats
+    C: snow index to snow depth parameters to score
+
+    Returns:
+    scores: Dataset of rmse, bias and pearsonr with a C dimension added
+    """
+    C = np.atleast_1d(np.asarray(C, dtype = float))
+    C = xr.DataArray(C, dims = 'C', coords = {'C': C})
+
+    n = stats['n'].where(stats['n'] > 0)
+
+    scores = xr.Dataset()
+
+    # clip negative mse from floating point error
+    mse = (C ** 2 * stats['sum_xx'] - 2 * C * stats['sum_xy'] + stats['sum_yy']) / n
+    scores['rmse'] = np.sqrt(mse.clip(min = 0))
+
+    scores['bias'] = (C * stats['sum_x'] - stats['sum_y']) / n
+
+    # correlation is independent of C except for its sign (undefined at C = 0)
+    scores['pearsonr'] = np.sign(C).where(C != 0) * _pearsonr(stats)
+
+    return scores.transpose(..., 'C')
+
+def calc_optimal_c(stats: xr.Dataset) -> xr.Dataset:
+    """
+    Calculate the C minimizing the RMSE of snow_index * C against the observed
+    snow depths (C = Σxy / Σx²) and its scores.
+
+    Args:
+    stats: Dataset of sufficient statistics from calc_sufficient_stats
+
+    Returns:
+    optimal: Dataset of C, rmse, bias and pearsonr at the optimal C
+    """
+    n = stats['n'].where(stats['n'] > 0)
+    C = stats['sum_xy'] / stats['sum_xx'].where(stats['sum_xx'] > 0)
+
+    optimal = xr.Dataset()
+    optimal['C'] = C
+    optimal['rmse'] = np.sqrt(((stats['sum_yy'] - C * stats['sum_xy']) / n).clip(min = 0))
+    optimal['bias'] = (C * stats['sum_x'] - stats['sum_y']) / n
+    optimal['pearsonr'] = np.sign(C).where(C != 0) * _pearsonr(stats)
+
+    return optimal
+
+def _pearsonr(stats: xr.Dataset) -> xr.DataArray:
+    """
+    Pearson r of snow index and observed snow depth from sufficient statistics.
+    """
+    n = stats['n']
+    cov = n * stats['sum_xy'] - stats['sum_x'] * stats['sum_y']
+    var_x = n * stats['sum_xx'] - stats['sum_x'] ** 2
+    var_y = n * stats['sum_yy'] - stats['sum_y'] ** 2
+
+    denominator = np.sqrt(var_x.clip(min = 0) * var_y.clip(min = 0))
+
+    return cov / denominator.where(denominator > 0)
+
+def bootstrap_stats(predicted: xr.DataArray, observed: xr.DataArray, iterations: int = 500,
+                    seed: Union[None, int] = None, dim: str = 'pixel',
+                    max_memory: float = 2**28) -> xr.Dataset:
+    """
+    Bootstrap the RMSE, MAE and pearson r of predicted snow depths against
+    observed snow depths for every parameter set.
+
+    Each iteration resamples pixels with replacement as a vector of counts
+    (how many times each pixel was drawn) so the statistics of a batch of
+    iterations for all parameter sets are matrix products of the counts with
+    the per pixel errors. The same resampled pixels are used for every
+    parameter set.
+
+    Args:
+    predicted: DataArray of predicted snow depths, e.g. (A, B, C, pixel)
+    observed: DataArray of observed (lidar) snow depths along dim
+    iterations: number of bootstrap iterations
+    seed: seed of the random generator. Results only depend on the seed, not
+    on the batch sizes used.
+    dim: dimension of pixels to resample [default: 'pixel']
+    max_memory: approximate limit in bytes of the arrays used for each batch
+
+    Returns:
+    stats: Dataset of rmse, mae and pearsonr with the dimensions of predicted
+    except dim and an iteration dimension
+    """
+    param_dims = [d for d in predicted.dims if d != dim]
+    predicted = predicted.transpose(*param_dims, dim)
+
+    # only resample pixels valid for the observations and every parameter set
+    valid = (observed.notnull() & predicted.notnull().all(param_dims)).values
+    x = predicted.values.reshape(-1, predicted.sizes[dim])[:, valid].T
+    y = observed.values[valid]
+    n, n_params = x.shape
+    log.debug(f"Bootstrapping {n_params} parameter sets with {n} pixels")
+
+    # one generator per iteration so results are independent of batch size
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(iterations)]
+
+    # split parameter sets and iterations into batches that fit in max_memory
+    # (5 (pixel, parameter) matrices per parameter chunk and 2 (iteration,
+    # pixel) + 5 (iteration, parameter) arrays per iteration batch)
+    chunk = int(np.clip(max_memory / 2 // (5 * 8 * n), 1, n_params))
+    batch = int(np.clip(max_memory / 2 // (8 * (2 * n + 5 * chunk)), 1, iterations))
+
+    rmse, mae, pearsonr = [np.empty((n_params, iterations)) for _ in range(3)]
+    sum_y, sum_yy = np.empty(iterations), np.empty(iterations)
+
+    for start in range(0, iterations, batch):
+        its = slice(start, min(start + batch, iterations))
+
+        # counts of each pixel in each iteration (iteration, pixel)
+        counts = np.stack([np.bincount(rng.integers(0, n, n), minlength = n) for rng in rngs[its]]).astype(float)
+        sum_y[its], sum_yy[its] = counts @ y, counts @ y ** 2
+
+        for p_start in range(0, n_params, chunk):
+            params = slice(p_start, min(p_start + chunk, n_params))
+            x_chunk = x[:, params]
+            error = x_chunk - y[:, None]
+
+            rmse[params, its] = np.sqrt(counts @ error ** 2 / n).T
+            mae[params, its] = (counts @ np.abs(error) / n).T
+
+            # weighted sums for pearson r
+            sum_x, sum_xx, sum_xy = counts @ x_chunk, counts @ x_chunk ** 2, counts @ (x_chunk * y[:, None])
+            cov = n * sum_xy - sum_x * sum_y[its, None]
+            var_x = n * sum_xx - sum_x ** 2
+            var_y = n * sum_yy[its, None] - sum_y[its, None] ** 2
+            denominator = np.sqrt(np.clip(var_x, 0, None) * np.clip(var_y, 0, None))
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                pearsonr[params, its] = np.where(denominator > 0, cov / denominator, np.nan).T
+
+    coords = {d: predicted[d] for d in param_dims if d in predicted.coords}
+    coords['iteration'] = np.arange(iterations)
+    shape = [predicted.sizes[d] for d in param_dims] + [iterations]
+
+    stats = xr.Dataset(coords = coords)
+    for name, values in zip(['rmse', 'mae', 'pearsonr'], [rmse, mae, pearsonr]):
+        stats[name] = (param_dims + ['iteration'], values.reshape(shape))
+
+    return stats
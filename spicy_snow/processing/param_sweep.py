@@ -0,0 +1,143 @@
+"""
+Functions to sweep the A, B, C parameters of the snow index retrieval.
+
+Intermediates that do not depend on a parameter are calculated once: the
+orbit differences of VV and VH (deltaCR = A * deltaVH - deltaVV), the previous
+snow index windows and the IMS snow cover. The snow index recursion runs once
+per A for all B values and snow depth is linear in C so C is only a final
+multiplication.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from typing import Sequence, Union
+
+from spicy_snow.processing.snow_index import _previous_orbit_index, _orbit_difference, \
+    find_repeat_interval, _prev_snow_index_windows, _snow_index_recursion
+
+import logging
+log = logging.getLogger(__name__)
+
+def sweep_snow_index(dataset: xr.Dataset, A: Sequence[float], B: Sequence[float],
+                     time: Union[str, np.datetime64, pd.Timestamp],
+                     mask: Union[None, xr.DataArray] = None,
+                     clip_thresh: float = 3, ims_masking: bool = True) -> xr.DataArray:
+    """
+    Calculate the snow index of one time step for every combination of the A
+    and B parameters. Same as running calc_delta_cross_ratio, calc_delta_gamma,
+    clip_delta_gamma_outlier and calc_snow_index for each (A, B) pair.
+
+    Only time steps up to the requested time are used and only pixels in the
+    mask are calculated. Memory use is ~ (time steps) x len(B) x (pixels) floats.
+
+    Args:
+    dataset: Xarray Dataset of sentinel images in dB with fcf and ims (and
+    optionally deltaVV) data vars
+    A: cross ratio fitting parameters to sweep
+    B: delta gamma fitting parameters to sweep
+    time: time step to return snow index for (nearest time step is used)
+    mask: optional boolean DataArray of pixels to calculate [default: all pixels]
+    clip_thresh: threshold in dB to clip delta gamma to [default: 3]
+    ims_masking: whether to mask pixels with the IMS data
+
+    Returns:
+    snow_index: DataArray of snow index with dims (A, B, pixel) and the spatial
+    coordinates of each pixel along the pixel dimension
+    """
+    # check for amp
+    if 's1_units' in dataset.attrs.keys():
+        assert dataset.attrs['s1_units'] == 'dB', 'Sentinel-1 units must be in dB'
+
+    assert dataset['fcf'].max() <= 1, "Forest cover fraction must be scaled 0-1"
+    assert dataset['fcf'].min() >= 0, "Forest cover fraction must be scaled 0-1"
+
+    A = np.atleast_1d(np.asarray(A, dtype = float))
+    B = np.atleast_1d(np.asarray(B, dtype = float))
+
+    # time step to return and all time steps it depends on
+    time = pd.DatetimeIndex(np.atleast_1d(np.asarray(time, dtype = 'datetime64[ns]')))
+    t_idx = dataset.get_index('time').get_indexer(time, method = 'nearest')[0]
+    log.debug(f"Sweeping snow index for {dataset.time.values[t_idx]}")
+
+    repeat = find_repeat_interval(dataset)
+    windows = _prev_snow_index_windows(dataset.time.values[:t_idx + 1], repeat)
+
+    # flatten spatial dimensions to pixels in the mask
+    spatial_dims = [dim for dim in dataset['s1'].dims if dim not in ('time', 'band')]
+    spatial_shape = [dataset.sizes[dim] for dim in spatial_dims]
+    if mask is None:
+        pixels = np.arange(np.prod(spatial_shape))
+    else:
+        pixels = np.flatnonzero(mask.transpose(*spatial_dims).values)
+
+    def to_pixels(da: xr.DataArray) -> np.ndarray:
+        # (time, pixel) array of time steps up to t_idx or (pixel) if no time
+        if 'time' in da.dims:
+            values = da.isel(time = slice(0, t_idx + 1)).transpose('time', *spatial_dims).values
+            return values.reshape(values.shape[0], -1)[:, pixels]
+        return da.transpose(*spatial_dims).values.ravel()[pixels]
+
+    # parameter independent intermediates
+    prev_idx = _previous_orbit_index(dataset['relative_orbit'].values)
+    if 'deltaVV' in dataset.data_vars:
+        deltaVV = to_pixels(dataset['deltaVV'])
+    else:
+        deltaVV = to_pixels(_orbit_difference(dataset['s1'].sel(band = 'VV'), prev_idx))
+    deltaVH = to_pixels(_orbit_difference(dataset['s1'].sel(band = 'VH'), prev_idx))
+    fcf = to_pixels(dataset['fcf'])
+    snow_cover = to_pixels(dataset['ims'] == 4)[:, None] if ims_masking else None
+
+    # forest cover weighted deltaVV for every B (time, B, pixel)
+    forest_deltaVV = (fcf * deltaVV)[:, None] * B[:, None]
+
+    snow_index = np.empty((len(A), len(B), len(pixels)))
+    for i, a in enumerate(A):
+        # delta CR and delta gamma for all B values at once
+        deltaCR = a * deltaVH - deltaVV
+        deltaGamma = ((1 - fcf) * deltaCR)[:, None] + forest_deltaVV
+
+        # clip outliers of delta gamma (nans are kept)
+        np.clip(deltaGamma, -clip_thresh, clip_thresh, out = deltaGamma)
+
+        snow_index[i] = _snow_index_recursion(deltaGamma, snow_cover, windows)[-1]
+
+    coords = {'A': A, 'B': B, 'time': dataset.time.values[t_idx]}
+    for dim, values in zip(spatial_dims, np.meshgrid(*[dataset[dim].values for dim in spatial_dims], indexing = 'ij')):
+        coords[dim] = ('pixel', values.ravel()[pixels])
+
+    return xr.DataArray(snow_index, dims = ('A', 'B', 'pixel'), coords = coords, name = 'snow_index')
+
+def sweep_parameters(dataset: xr.Dataset, A: Sequence[float], B: Sequence[float],
+                     C: Sequence[float], time: Union[str, np.datetime64, pd.Timestamp],
+                     mask: Union[None, xr.DataArray] = None, clip_thresh: float = 3,
+                     ims_masking: bool = True) -> xr.DataArray:
+    """
+    Calculate the snow depth of one time step for every combination of the A, B
+    and C parameters. Snow index is calculated once per (A, B) with
+    sweep_snow_index and multiplied by every C.
+
+    Args:
+    dataset: Xarray Dataset of sentinel images in dB with fcf and ims (and
+    optionally deltaVV) data vars
+    A: cross ratio fitting parameters to sweep
+    B: delta gamma fitting parameters to sweep
+    C: snow index to snow depth parameters to sweep
+    time: time step to return snow depth for (nearest time step is used)
+    mask: optional boolean DataArray of pixels to calculate [default: all pixels]
+    clip_thresh: threshold in dB to clip delta gamma to [default: 3]
+    ims_masking: whether to mask pixels with the IMS data
+
+    Returns:
+    snow_depth: DataArray of snow depth with dims (A, B, C, pixel)
+    """
+    snow_index = sweep_snow_index(dataset, A, B, time, mask = mask,
+                                  clip_thresh = clip_thresh, ims_masking = ims_masking)
+
+    C = np.atleast_1d(np.asarray(C, dtype = float))
+    C = xr.DataArray(C, dims = 'C', coords = {'C': C})
+
+    snow_depth = (snow_index * C).transpose('A', 'B', 'C', 'pixel')
+
+    return snow_depth.rename('snow_depth')
@@ -27,7 +27,7 @@ def s1_power_to_dB(dataset: xr.Dataset, inplace: bool = False):
     dataset: Xarray dataset of sentinel image in dB
     """
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check for dB
     if 's1_units' in dataset.attrs.keys():
@@ -38,9 +38,9 @@ def s1_power_to_dB(dataset: xr.Dataset, inplace: bool = False):
             return
     
     # mask all values 0 or negative
-    dataset['s1'] = dataset['s1'].where(dataset['s1'] > 0)
+    s1 = dataset['s1'].where(dataset['s1'] > 0)
     # convert all s1 images from amplitude to dB
-    dataset['s1'].loc[dict(band = ['VV','VH'])] = 10 * np.log10(dataset['s1'].sel(band = ['VV','VH']))
+    dataset['s1'] = s1.where(~s1.band.isin(['VV','VH']), 10 * np.log10(s1))
 
     dataset.attrs['s1_units'] = 'dB'
     
@@ -59,7 +59,7 @@ def s1_dB_to_power(dataset: xr.Dataset, inplace: bool = False):
     dataset: Xarray Dataset of sentinel images in amplitude
     """
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
     
     # check for amp
     if 's1_units' in dataset.attrs.keys():
@@ -69,18 +69,22 @@ def s1_dB_to_power(dataset: xr.Dataset, inplace: bool = False):
         if dataset.attrs['s1_units'] == 'amp':
             return
         
-    # convert all s1 images from amplitude to dB
-    dataset['s1'].loc[dict(band = ['VV','VH'])] = 10 ** (dataset['s1'].sel(band = ['VV','VH']) / 10)
+    # convert all s1 images from dB to amplitude
+    s1 = dataset['s1']
+    dataset['s1'] = s1.where(~s1.band.isin(['VV','VH']), 10 ** (s1 / 10))
     dataset.attrs['s1_units'] = 'amp'
     if not inplace:
         return dataset
 
 
-def merge_partial_s1_images(dataset, inplace: bool = False) -> xr.Dataset:
+def merge_partial_s1_images(dataset: xr.Dataset) -> xr.Dataset:
     """
     Merges s1 images that have been split by hyp3 into a single image with the 
     first time stamp of that relative orbit pass as the time index.
 
+    Images are selected once from the input so the input is never modified
+    (there is no inplace flag as images are dropped).
+
     Args:
     dataset: Xarray Dataset with Sentinel 1 images that have been arbitrarily
     split by hyp3 into an arbitrary number of subswaths
@@ -89,35 +93,31 @@ def merge_partial_s1_images(dataset, inplace: bool = False) -> xr.Dataset:
     dataset: Xarray Dataset with Sentinel 1 images combined into single images and
     only the first subswath's time step
     """
-    if not inplace:
-        dataset = dataset.copy(deep=True)
-    
-    # split out each relative orbit and make its own dataset
-    for orbit_num, orbit_ds in dataset.groupby('relative_orbit'):
-
-        # split out each absolute orbit and combine images
-        for absolute_num, abs_ds in orbit_ds.groupby('absolute_orbit'):
+    # time indexes of the images in each relative and absolute orbit pass
+    orbits = pd.DataFrame({'relative': dataset['relative_orbit'].values,
+                           'absolute': dataset['absolute_orbit'].values})
+    passes = list(orbits.groupby(['relative', 'absolute'], sort = False).indices.values())
 
-            # if only 1 image in this absolute orbit go to the next
-            if len(abs_ds.time) == 1:
-                continue
+    # keep the first image of each pass
+    merged = dataset.isel(time = np.sort([idx[0] for idx in passes]))
 
-            # combine all images into the first image time step
-            combo_imgs = abs_ds.mean(dim = 'time')
+    time_vars = [var for var in dataset.data_vars if 'time' in dataset[var].dims]
+    for idx in passes:
 
-            # set first image in dataset to this new combined image
-            dataset.loc[{'time' : abs_ds.isel(time = 0).time}] = combo_imgs
+        # if only 1 image in this absolute orbit go to the next
+        if len(idx) == 1:
+            continue
 
-            # drop images that have been combined
-            dataset = dataset.drop_sel(time = abs_ds.isel(time = slice(1, len(abs_ds.time))).time)
+        # combine all images into the first image time step
+        combo_imgs = dataset[time_vars].isel(time = idx).mean(dim = 'time')
+        for var in time_vars:
+            merged[var].loc[{'time' : dataset.time[idx[0]]}] = combo_imgs[var]
 
     # can leave some outliers in the dataset along the edges so remove unreasonable values
-    if 's1' in dataset.data_vars:
-        dataset['s1'] = dataset['s1'].where(dataset['s1'] < 100)
-        dataset['s1'] = dataset['s1'].where(dataset['s1'] > -1e30)
+    if 's1' in merged.data_vars:
+        merged['s1'] = merged['s1'].where((merged['s1'] < 100) & (merged['s1'] > -1e30))
 
-    if not inplace:
-        return dataset
+    return merged
 
 def subset_s1_images(dataset: xr.Dataset) -> Dict[str, xr.Dataset]:
     """
@@ -167,36 +167,185 @@ def s1_orbit_averaging(dataset: xr.Dataset, inplace: bool = False) -> xr.Dataset
 
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
     
     # check for dB
     if 's1_units' in dataset.attrs.keys():
         assert dataset.attrs['s1_units'] == 'dB', "Sentinel 1 units must be dB not amplitude."
 
-    # get all unique relative orbits
-    orbits = np.unique(dataset['relative_orbit'].values)
+    s1 = dataset['s1'].sel(band = ['VV', 'VH'])
 
-    # loop through bands
-    for band in ['VV', 'VH']:
-        
-        # calculate the overall (all orbits) mean
-        overall_mean  = dataset['s1'].mean(dim = ['x','y','time']).sel(band = band)
-        log.debug(f"dataset's mean: {overall_mean}")
+    # calculate the overall (all orbits) mean and each orbit's mean value
+    # (computed once here so chunked datasets don't recompute them for every chunk)
+    overall_mean = s1.mean(dim = ['x','y','time']).compute()
+    # (grouped by the loaded orbits as dask backed coordinates can't be grouped)
+    orbits = xr.DataArray(dataset['relative_orbit'].values, dims = 'time', name = 'relative_orbit')
+    orbit_mean = s1.groupby(orbits).mean(dim = ['x','y','time']).compute()
+    log.debug(f"dataset's mean: {overall_mean.values}")
+    log.debug(f"Orbit's pre-mean: {orbit_mean.values}")
 
-        for orbit in orbits:
-            
-            # calculate each orbit's mean value
-            orbit_mean = dataset['s1'].sel(time = dataset.relative_orbit == orbit, band = band).mean(dim = ['x','y','time'])
-            log.debug(f"Orbit's {orbit} pre-mean: {overall_mean}")
+    # mean correction (orbit mean -> overall mean) of each image, 0 for incidence angle
+    correction = (orbit_mean - overall_mean).sel(relative_orbit = orbits)
+    correction = correction.reindex(band = dataset['band'], fill_value = 0)
 
-            # rescale each image by the mean correction (orbit mean -> overall mean)
-            dataset['s1'].loc[dict(time = dataset.relative_orbit == orbit, band = band)] = \
-                dataset['s1'].loc[dict(time = dataset.relative_orbit == orbit, band = band)] - (orbit_mean - overall_mean)
+    # rescale each image by its orbit's correction
+    dataset['s1'] = dataset['s1'] - correction
 
     if not inplace:
         return dataset
 
-def s1_clip_outliers(dataset: xr.Dataset, inplace: bool = False) -> xr.Dataset:
+def _quantile_from_histogram(counts: np.ndarray, edges: np.ndarray, q: List[float]) -> np.ndarray:
+    """
+    Quantiles of the values of a histogram interpolated within the bin of each
+    quantile (see _histogram_quantile).
+
+    Args:
+    counts: histogram counts
+    edges: histogram bin edges
+    q: list of quantiles between 0 and 1
+
+    Returns:
+    quantiles: array of quantiles
+    """
+    n = counts.sum()
+    # rank of each quantile and the bin holding that rank
+    cdf = np.cumsum(counts)
+    rank = np.asarray(q) * (n - 1)
+    b = np.searchsorted(cdf, rank, side = 'right')
+    # position of the rank among the values of the bin (assumed evenly spread)
+    frac = (rank - (cdf[b] - counts[b]) + 0.5) / counts[b]
+
+    return edges[b] + frac * (edges[b + 1] - edges[b])
+
+def _histogram_quantile(da: xr.DataArray, q: List[float], dim: List[str], bins: int = 2**16) -> xr.DataArray:
+    """
+    Quantiles of a DataArray from a histogram of its values. The histogram of
+    a dask backed array is built chunk by chunk so memory is bounded by the
+    chunk size instead of the array size.
+
+    Values are interpolated within the histogram bin of each quantile (the
+    same linear method as DataArray.quantile) so results are within two bin
+    widths ((max - min) / bins) of the exact quantile. Nans are skipped.
+
+    Args:
+    da: DataArray to calculate quantiles of
+    q: list of quantiles between 0 and 1
+    dim: dimensions to reduce over
+    bins: number of histogram bins [default: 2**16]
+
+    Returns:
+    quantiles: DataArray with a 'quantile' dimension and the dimensions not in dim
+    """
+    if da.chunks is None:
+        histogram = np.histogram
+    else:
+        import dask
+        import dask.array
+        histogram = dask.array.histogram
+
+    other_dims = [d for d in da.dims if d not in dim]
+    da = da.transpose(*other_dims, *dim)
+
+    # value range of each slice of the other dimensions
+    v_min, v_max = da.min(dim = dim), da.max(dim = dim)
+    if da.chunks is not None:
+        v_min, v_max = dask.compute(v_min, v_max)
+
+    # histogram of each slice with values (every chunk is read once for all slices)
+    index = [idx for idx in np.ndindex(*v_min.shape) if np.isfinite(v_min.values[idx])]
+    hists = [histogram(da.data[idx], bins = bins, range = (float(v_min.values[idx]), float(v_max.values[idx]))) for idx in index]
+    if da.chunks is not None:
+        hists = dask.compute(*hists)
+
+    quantiles = np.full((len(q), *v_min.shape), np.nan)
+    for idx, (counts, edges) in zip(index, hists):
+        quantiles[(slice(None), *idx)] = _quantile_from_histogram(counts, edges, q)
+
+    coords = {d: da[d] for d in other_dims if d in da.coords}
+    return xr.DataArray(quantiles, dims = ['quantile', *other_dims], coords = {'quantile': q, **coords})
+
+def calc_s1_percentiles(dataset: xr.Dataset) -> xr.DataArray:
+    """
+    Calculate the time series 10th and 90th percentiles of VV and VH used to
+    clip outliers.
+
+    Args:
+    dataset: Xarray Dataset of sentinel images in dB
+
+    Returns:
+    percentiles: DataArray of percentiles with quantile (0.1, 0.9) and band (VV, VH) dimensions
+    """
+    s1 = dataset['s1'].sel(band = ['VV','VH'])
+
+    if s1.chunks is None:
+        percentiles = s1.quantile([0.1, 0.9], dim = ['x','y','time'], skipna = True)
+    else:
+        # chunked (dask) datasets can't be sorted in memory so use histograms of the chunks
+        percentiles = _histogram_quantile(s1, [0.1, 0.9], dim = ['x','y','time'])
+
+    return percentiles.transpose('quantile', 'band')
+
+def stream_s1_percentiles(dataset: xr.Dataset, bins: int = 2**16) -> Dict[str, xr.DataArray]:
+    """
+    Calculate the percentiles of calc_s1_percentiles for each subset of
+    subset_s1_images reading one time step at a time so memory is constant in
+    the number of time steps. Pixels with incidence angles > 70 degrees are
+    masked as each time step is read (as s1_incidence_angle_masking).
+
+    Percentiles are taken from histograms (see _histogram_quantile) so are
+    within two bin widths of calc_s1_percentiles.
+
+    Args:
+    dataset: Xarray Dataset of sentinel images in dB (e.g. opened lazily from a netcdf)
+    bins: number of histogram bins [default: 2**16]
+
+    Returns:
+    {'S1A-ascending': percentiles, ...}: dictionary of subset names and percentiles
+    """
+    names = [f'{platform}-{direction}' for platform, direction in
+             zip(dataset['platform'].values, dataset['flight_dir'].values)]
+    subsets = [f'{p}-{d}' for p, d in product(['S1A','S1B'], ['descending', 'ascending'])]
+
+    def read_step(i):
+        s1 = dataset['s1'].isel(time = i).load()
+        s1 = s1.where(s1.sel(band = 'inc') < np.deg2rad(70)).sel(band = ['VV','VH']).values
+        return [band[np.isfinite(band)] for band in s1.reshape(2, -1)]
+
+    # value range of each subset and band
+    v_min, v_max = {}, {}
+    for i, name in enumerate(names):
+        if name not in subsets:
+            continue
+        v_min.setdefault(name, np.full(2, np.inf))
+        v_max.setdefault(name, np.full(2, -np.inf))
+        for j, values in enumerate(read_step(i)):
+            if values.size:
+                v_min[name][j] = min(v_min[name][j], values.min())
+                v_max[name][j] = max(v_max[name][j], values.max())
+
+    # histogram of each subset and band
+    hists = {name: [[np.zeros(bins, dtype = np.int64), None] for _ in range(2)] for name in v_min}
+    for i, name in enumerate(names):
+        if name not in hists:
+            continue
+        for j, values in enumerate(read_step(i)):
+            if np.isfinite(v_min[name][j]):
+                counts, hists[name][j][1] = np.histogram(values, bins = bins, range = (v_min[name][j], v_max[name][j]))
+                hists[name][j][0] += counts
+
+    percentiles = {}
+    for name, band_hists in hists.items():
+        quantiles = np.full((2, 2), np.nan)
+        for j, (counts, edges) in enumerate(band_hists):
+            if edges is not None:
+                quantiles[:, j] = _quantile_from_histogram(counts, edges, [0.1, 0.9])
+        percentiles[name] = xr.DataArray(quantiles, dims = ['quantile', 'band'],
+                                         coords = {'quantile': [0.1, 0.9], 'band': ['VV', 'VH']})
+        log.debug(f'{name} percentiles: {quantiles}')
+
+    return percentiles
+
+def s1_clip_outliers(dataset: xr.Dataset, inplace: bool = False, percentiles: xr.DataArray = None) -> xr.Dataset:
     """
     Remove s1 image outliers by masking pixels 3 dB above 90th percentile or
     3 dB before the 10th percentile. (-35 -> 15 dB for VV) and (-40 -> 10 for VH
@@ -205,38 +354,33 @@ def s1_clip_outliers(dataset: xr.Dataset, inplace: bool = False) -> xr.Dataset:
     Args:
     dataset: Xarray Dataset of sentinel images to clip outliers
     inplace: boolean flag to modify original Dataset or return a new Dataset
+    percentiles: percentiles from calc_s1_percentiles to clip with (e.g. of
+    the earlier images of a retrieval being continued) [default: None to
+    calculate from dataset]
 
     Returns:
     dataset: Xarray Dataset of sentinel images with masked outliers
     """
     # Check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check for dB
     if 's1_units' in dataset.attrs.keys():
         assert dataset.attrs['s1_units'] == 'dB', "Sentinel 1 units must be dB not amplitude."
 
+    s1 = dataset['s1']
+
     # Calculate time series 10th and 90th percentile 
     # Threshold vals 3 dB above/below percentiles
-    for band in ['VV','VH']:
-        data = dataset['s1'].sel(band=band)
-
-        thresh_lo, thresh_hi = data.quantile([0.1, 0.9], skipna = True)
-        thresh_lo -= 3
-        thresh_hi += 3
-        # Mask using percentile thresholds
-        data_masked = data.where((data > thresh_lo) & (data < thresh_hi))
+    if percentiles is None:
+        percentiles = calc_s1_percentiles(dataset)
+    thresh_lo = percentiles.sel(quantile = 0.1, drop = True).reindex(band = s1['band']) - 3
+    thresh_hi = percentiles.sel(quantile = 0.9, drop = True).reindex(band = s1['band']) + 3
+    log.debug(f'Thresh min: {thresh_lo.values}. Thresh max: {thresh_hi.values}')
 
-
-        log.debug(f'Clipping band: {band}')
-        log.debug(f'Thresh min: {thresh_lo.values}. Thresh max: {thresh_hi.values}')
-        pre_min, pre_max = data.min().values, data.max().values
-        log.debug(f'Data min: {pre_min}. Data max: {pre_max}')
-        min, max = data_masked.min().values, data_masked.max().values
-        log.debug(f'Masked data min: {min}. Data max: {max}')
-
-        dataset['s1'].loc[dict(band = band)] = data_masked
+    # Mask using percentile thresholds (incidence angle is left unmasked)
+    dataset['s1'] = s1.where(((s1 > thresh_lo) & (s1 < thresh_hi)) | ~s1.band.isin(['VV','VH']))
 
     if not inplace:
         return dataset
@@ -268,7 +412,7 @@ def s1_incidence_angle_masking(dataset: xr.Dataset, inplace: bool = False) -> xr
     
     # Check inplace flag
     if not inplace:
-            dataset = dataset.copy(deep=True)
+            dataset = dataset.copy()
 
     # Mask pixels with incidence angle > 70 degrees
     dataset['s1'] = dataset['s1'].where(dataset['s1'].sel(band = 'inc') < np.deg2rad(70))
@@ -305,15 +449,21 @@ def add_confidence_angle(dataset: xr.Dataset, inplace: bool = False):
     Returns:
     dataset: Xarray dataset of sentinel image with confidence interval in 
     """
-    ds_amp = s1_dB_to_power(dataset).copy()
-    ds_amp['deltaVH_amp'] = ds_amp['s1'].sel(band = 'VH').diff(1)
-    ds_amp['deltaVV_amp'] = ds_amp['s1'].sel(band = 'VV').diff(1)
+    # check inplace flag
+    if not inplace:
+        dataset = dataset.copy()
+
+    # change in amplitude between time steps
+    s1_amp = s1_dB_to_power(dataset[['s1']])['s1']
+    deltaVH_amp = s1_amp.sel(band = 'VH', drop = True).diff(dim = 'time')
+    deltaVV_amp = s1_amp.sel(band = 'VV', drop = True).diff(dim = 'time')
 
-    ds_amp['deltaVH_norm'] = np.abs(ds_amp['deltaVH_amp'] / ds_amp['deltaVH_amp'].mean())
-    ds_amp['deltaVV_norm'] = np.abs(ds_amp['deltaVV_amp'] / ds_amp['deltaVV_amp'].mean())
+    deltaVH_norm = np.abs(deltaVH_amp / deltaVH_amp.mean())
+    deltaVV_norm = np.abs(deltaVV_amp / deltaVV_amp.mean())
 
-    ds_amp['confidence'] = (ds_amp['deltaVH_norm'].dims, np.angle(ds_amp['deltaVV_norm'].values + ds_amp['deltaVH_norm'].values * 1j))
-    dataset['confidence'] = ds_amp['confidence'].mean('time')
+    # angle of the (deltaVV, deltaVH) vector - same as np.angle(deltaVV + deltaVH * 1j)
+    confidence = np.arctan2(deltaVH_norm, deltaVV_norm)
+    dataset['confidence'] = confidence.mean('time')
 
     if not inplace:
         return dataset
@@ -6,11 +6,53 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-from typing import Union
+from typing import List, Tuple, Union
 
 import logging
 log = logging.getLogger(__name__)
 
+def _previous_orbit_index(relative_orbit: np.ndarray) -> np.ndarray:
+    """
+    Find the index of the previous acquisition from the same relative orbit for
+    every time step.
+
+    Args:
+    relative_orbit: array of relative orbit numbers along the time dimension
+
+    Returns:
+    prev_idx: index of previous image of the same relative orbit (-1 for the
+    first image of each relative orbit)
+    """
+    relative_orbit = np.asarray(relative_orbit)
+
+    # stable sort keeps the time order of images within each relative orbit
+    order = np.argsort(relative_orbit, kind = 'stable')
+    same_orbit = relative_orbit[order][1:] == relative_orbit[order][:-1]
+
+    prev_idx = np.full(len(relative_orbit), -1)
+    prev_idx[order[1:][same_orbit]] = order[:-1][same_orbit]
+
+    return prev_idx
+
+def _orbit_difference(da: xr.DataArray, prev_idx: np.ndarray) -> xr.DataArray:
+    """
+    Difference each time step from the previous image of its relative orbit
+    with one gather and subtract over the full time series.
+
+    Args:
+    da: DataArray with a time dimension
+    prev_idx: index of previous image of the same relative orbit from _previous_orbit_index
+
+    Returns:
+    diff: DataArray of differences with nans for the first image of each relative orbit
+    """
+    has_prev = prev_idx >= 0
+
+    # gather previous images (first images gather themselves and are masked after)
+    previous = da.isel(time = np.where(has_prev, prev_idx, np.arange(len(prev_idx)))).variable
+
+    return (da - previous).where(xr.DataArray(has_prev, dims = 'time'))
+
 def calc_delta_VV(dataset: xr.Dataset, inplace: bool = False) -> Union[None, xr.Dataset]:
     """
     Calculate change in VV amplitude between current time step and previous
@@ -30,28 +72,17 @@ def calc_delta_VV(dataset: xr.Dataset, inplace: bool = False) -> Union[None, xr.
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check for amp
     if 's1_units' in dataset.attrs.keys():
         assert dataset.attrs['s1_units'] == 'dB', 'Sentinel-1 units must be in dB'
 
-    # get all unique relative orbits
-    orbits = np.unique(dataset['relative_orbit'].values)
-
-    for orbit in orbits:
-        
-        # Calculate change in gamma-VV between previous and current time step from the same relative orbit
-        diffVV = dataset['s1'].sel(time = dataset.relative_orbit == orbit, band = 'VV').diff(dim = 'time')
-        
-        # if adding new 
-        if 'deltaVV' not in dataset.data_vars:
-            # add delta-gamma-VV as variable to dataset
-            dataset['deltaVV'] = diffVV
-        
-        else:
-            # update deltaVV times with this. 
-            dataset['deltaVV'].loc[dict(time = diffVV.time)] = diffVV
+    # Identify previous image from the same relative orbit (6, 12, 18, or 24 days ago)
+    prev_idx = _previous_orbit_index(dataset['relative_orbit'].values)
+
+    # Calculate change in gamma-VV between previous and current time step from the same relative orbit
+    dataset['deltaVV'] = _orbit_difference(dataset['s1'].sel(band = 'VV'), prev_idx)
     
     if not inplace:
         return dataset
@@ -82,7 +113,7 @@ def calc_delta_cross_ratio(dataset: xr.Dataset, A: float = 2, inplace: bool = Fa
 
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check for amp
     if 's1_units' in dataset.attrs.keys():
@@ -91,24 +122,11 @@ def calc_delta_cross_ratio(dataset: xr.Dataset, A: float = 2, inplace: bool = Fa
     # calculate cross ratio of VH to VV with fitting parameter A
     gamma_cr = (A * dataset['s1'].sel(band='VH')) - dataset['s1'].sel(band='VV')
 
-    # get all unique relative orbits
-    orbits = np.unique(dataset['relative_orbit'].values)
-    
     # Identify previous image from the same relative orbit (6, 12, 18, or 24 days ago)
-    for orbit in orbits:
-
-        # Calculate change in gamma-cr between previous and current time step
-        diffCR = gamma_cr.sel(time = dataset.relative_orbit == orbit).diff(dim = 'time')
-        
-        # add delta-gamma-cr as band to dataset
-        # if adding new 
-        if 'deltaCR' not in dataset.data_vars:
-            # add delta-gamma-CR as new variable to dataset
-            dataset['deltaCR'] = diffCR
-        
-        else:
-            # update deltaCR times with this. 
-            dataset['deltaCR'].loc[dict(time = diffCR.time)] = diffCR
+    prev_idx = _previous_orbit_index(dataset['relative_orbit'].values)
+
+    # Calculate change in gamma-cr between previous and current time step
+    dataset['deltaCR'] = _orbit_difference(gamma_cr, prev_idx)
     
     if not inplace:
         return dataset
@@ -132,7 +150,7 @@ def calc_delta_gamma(dataset: xr.Dataset, B: float = 0.5, inplace: bool = False)
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check to ensure fcf is 0-1 not 0-100
     assert dataset['fcf'].max() <= 1, "Forest cover fraction must be scaled 0-1"
@@ -160,7 +178,7 @@ def clip_delta_gamma_outlier(dataset: xr.Dataset, thresh: float = 3, inplace: bo
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # change values above 3 and not nan to 3
     dataset['deltaGamma'] = dataset['deltaGamma'].where((dataset['deltaGamma'] < thresh) | dataset['deltaGamma'].isnull(), thresh)
@@ -231,7 +249,116 @@ def calc_prev_snow_index(dataset: xr.Dataset, current_time: np.datetime64, repea
 
     return prev_si
 
-def calc_snow_index(dataset: xr.Dataset, ims_masking: bool = True, inplace: bool = False) -> Union[None, xr.Dataset]:
+def _prev_snow_index_windows(times: Union[pd.DatetimeIndex, np.ndarray], repeat: pd.Timedelta) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Precompute, for every time step, the indexes and day weights of the images
+    that make up its previous snow index window (see calc_prev_snow_index).
+
+    Args:
+    times: acquisition times of the dataset
+    repeat: is this region capturing s1 images every 6 or 12 days
+
+    Returns:
+    windows: list of (indexes, weights) tuples, one per time step
+    """
+    times = pd.DatetimeIndex(times)
+    half_window = repeat - pd.Timedelta('1 day')
+
+    windows = []
+    for ct in times:
+        # center of the previous window and all images within +/- 5 or 11 days of it
+        t_prev = ct - repeat
+        idx = np.flatnonzero((times >= t_prev - half_window) & (times <= t_prev + half_window))
+
+        # weights are the inverse distance in days from the centered date
+        day_weights = repeat.days - np.abs(np.asarray((times[idx] - t_prev).days))
+
+        windows.append((idx, day_weights.astype(float)))
+
+    return windows
+
+def _snow_index_recursion(delta_gamma: np.ndarray, snow_cover: Union[None, np.ndarray],
+                          windows: List[Tuple[np.ndarray, np.ndarray]],
+                          snow_index: Union[None, np.ndarray] = None, start: int = 0) -> np.ndarray:
+    """
+    Run the snow index recursion on raw numpy arrays with time as the first axis.
+
+    Args:
+    delta_gamma: array of delta gamma (time, ...)
+    snow_cover: boolean array of IMS snow cover (time, ...) or None for no masking
+    windows: previous snow index windows from _prev_snow_index_windows
+    snow_index: optional preallocated snow index array to fill. Time steps
+    before start must already hold their snow index.
+    start: first time step to calculate
+
+    Returns:
+    snow_index: array of snow index (time, ...)
+    """
+    if snow_index is None:
+        snow_index = np.zeros(delta_gamma.shape, dtype = np.result_type(delta_gamma.dtype, np.float32))
+
+    # preallocated buffers reused for every time step
+    spatial_shape = snow_index.shape[1:]
+    numerator = np.empty(spatial_shape)
+    denominator = np.empty(spatial_shape)
+    weighted = np.empty(spatial_shape)
+    mask = np.empty(spatial_shape, dtype = bool)
+
+    for i in range(start, snow_index.shape[0]):
+        idx, weights = windows[i]
+
+        # weighted sum of previous snow indexes skipping nans
+        numerator.fill(0)
+        denominator.fill(0)
+        for j, weight in zip(idx, weights):
+            np.isnan(snow_index[j], out = mask)
+            np.logical_not(mask, out = mask)
+            np.multiply(snow_index[j], weight, out = weighted)
+            np.add(numerator, weighted, out = numerator, where = mask)
+            np.add(denominator, weight, out = denominator, where = mask)
+
+        # previous snow index is 0 where there were no valid previous images
+        current = snow_index[i]
+        current.fill(0)
+        np.not_equal(denominator, 0, out = mask)
+        np.divide(numerator, denominator, out = current, where = mask)
+
+        # add deltaGamma to previous snow index
+        np.add(current, delta_gamma[i], out = current)
+
+        # change to 0 when ims snow cover is not 4
+        if snow_cover is not None:
+            np.logical_not(snow_cover[i], out = mask)
+            np.copyto(current, 0, where = mask)
+
+        # change to 0 when snow_index is negative (nans are kept)
+        np.less_equal(current, 0, out = mask)
+        np.copyto(current, 0, where = mask)
+
+    return snow_index
+
+def _snow_index_ufunc(delta_gamma: np.ndarray, *arrays: np.ndarray,
+                      windows: List[Tuple[np.ndarray, np.ndarray]] = None, ims_masking: bool = True,
+                      start: int = 0) -> np.ndarray:
+    """
+    Wrapper of _snow_index_recursion for xr.apply_ufunc (time as the last axis).
+    arrays are the IMS snow cover (only if ims_masking) followed by the earlier
+    snow index (only if start > 0).
+    """
+    arrays = list(arrays)
+    delta_gamma = np.moveaxis(delta_gamma, -1, 0)
+    snow_cover = np.moveaxis(arrays.pop(0), -1, 0) if ims_masking else None
+    snow_index = arrays.pop(0) if start > 0 else None
+    if snow_index is not None:
+        # copy of the earlier snow index to fill from start
+        snow_index = np.moveaxis(snow_index, -1, 0).astype(np.result_type(delta_gamma.dtype, np.float32))
+
+    snow_index = _snow_index_recursion(delta_gamma, snow_cover, windows, snow_index = snow_index, start = start)
+
+    return np.moveaxis(snow_index, 0, -1)
+
+def calc_snow_index(dataset: xr.Dataset, ims_masking: bool = True, inplace: bool = False,
+                    start: int = 0, repeat: pd.Timedelta = None) -> Union[None, xr.Dataset]:
     """
     Calculate snow index for each time step from previous time steps' snow index
     weights, and current delta-gamma.
@@ -241,43 +368,51 @@ def calc_snow_index(dataset: xr.Dataset, ims_masking: bool = True, inplace: bool
     with SI (i, t_previous) as:
         SI (i, t_previous) = sum (t_pri - 5/11 days, t_pri + 5/11 days)(SI * weights) / sum(weights)
 
+    The windows and weights of every time step are calculated once and the
+    recursion is run on numpy arrays before being added back to the dataset.
+
     Args:
     dataset: Xarray Dataset of sentinel images with delta-gamma
     ims_masking: whether to mask pixels with the IMS data
     inplace: operate on dataset in place or return copy
+    start: first time step to calculate. Time steps before start must already
+    have their snow_index in dataset (e.g. the previous snow index window of a
+    retrieval being continued) [default: 0]
+    repeat: repeat interval of the images [default: None to find from dataset]
 
     Returns:
     dataset: Xarray Dataset of sentinel images with snow-index added as band
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
-
-    # set all snow index to 0 to start
-    dataset['snow_index'] = xr.zeros_like(dataset['deltaGamma'])
+        dataset = dataset.copy()
 
     # find repeat interval of dataset
-    repeat = find_repeat_interval(dataset)
-
-    # iterate through time steps
-    for ct in dataset.time.values:
-
-        # calculate previous snow index
-        prev_si = calc_prev_snow_index(dataset, ct, repeat)
-
-        # set prev_si to 0 at nans
-        prev_si = prev_si.where(~prev_si.isnull(), 0)
-        
-        # add deltaGamma to previous snow index
-        dataset['snow_index'].loc[dict(time = ct)] = prev_si + dataset['deltaGamma'].sel(time = ct)
-        
-        # change to 0 when ims snow cover is not 4
-        if ims_masking:
-            dataset['snow_index'].loc[dict(time = ct)] = dataset['snow_index'].sel(time = ct).where(dataset['ims'].sel(time = ct) == 4, 0)
-
-        # change to 0 when snow_index is negative
-        dataset['snow_index'].loc[dict(time = ct)] = \
-            dataset['snow_index'].sel(time = ct).where((dataset['snow_index'].sel(time = ct).isnull()) | (dataset['snow_index'].sel(time = ct) > 0), 0)
+    if repeat is None:
+        repeat = find_repeat_interval(dataset)
+
+    # calculate previous snow index windows and weights for every time step
+    windows = _prev_snow_index_windows(dataset.time.values, repeat)
+
+    # snow covered pixels from IMS (no mask is passed without ims_masking)
+    inputs = [dataset['deltaGamma']]
+    if ims_masking:
+        inputs.append(dataset['ims'] == 4)
+
+    # earlier snow index to continue from
+    if start > 0:
+        assert 'snow_index' in dataset.data_vars, "Need snow_index of the time steps before start"
+        inputs.append(dataset['snow_index'])
+
+    # run the time recursion with time as the core dimension (chunk by chunk
+    # for dask backed datasets with the full time series in each chunk)
+    snow_index = xr.apply_ufunc(_snow_index_ufunc, *inputs,
+                                input_core_dims = [['time']] * len(inputs), output_core_dims = [['time']],
+                                kwargs = {'windows': windows, 'ims_masking': ims_masking, 'start': start}, keep_attrs = True,
+                                dask = 'parallelized',
+                                output_dtypes = [np.result_type(dataset['deltaGamma'].dtype, np.float32)])
+
+    dataset['snow_index'] = snow_index.transpose(*dataset['deltaGamma'].dims)
     
     if not inplace:
         return dataset
@@ -298,7 +433,7 @@ def calc_snow_index_to_snow_depth(dataset: xr.Dataset, C: float = 0.44, inplace:
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
     
     dataset['snow_depth'] = dataset['snow_index'] * C
 
@@ -1,10 +1,10 @@
 """
 Functions to identify, mask, and create weights for wet-snow.
 """
-import sys
 import numpy as np
 import xarray as xr
-from typing import Union
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import List, Tuple, Union
 
 import logging
 log = logging.getLogger(__name__)
@@ -25,7 +25,7 @@ def id_newly_wet_snow(dataset: xr.Dataset, wet_thresh: int = -2, inplace: bool =
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
     
     # check we have the neccessary variables
     necessary_vars = set(['fcf', 'deltaCR', 'deltaVV'])
@@ -62,7 +62,7 @@ def id_newly_frozen_snow(dataset: xr.Dataset, freeze_thresh: int = 2, inplace: b
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check we have the neccessary variables
     necessary_vars = set(['deltaGamma'])
@@ -97,7 +97,7 @@ def id_wet_negative_si(dataset: xr.Dataset, wet_SI_thresh = 0, inplace: bool = F
     """
     # check inplace flag
     if not inplace:
-        dataset = dataset.copy(deep=True)
+        dataset = dataset.copy()
 
     # check we have the neccessary variables
     necessary_vars = set(['snow_index', 'ims'])
@@ -117,128 +117,240 @@ def id_wet_negative_si(dataset: xr.Dataset, wet_SI_thresh = 0, inplace: bool = F
     if not inplace:
         return dataset
 
-def flag_wet_snow(dataset: xr.Dataset, inplace: bool = False) -> Union[None, xr.Dataset]:
+def _wet_snow_scan(wet_flag: np.ndarray, alt_wet_flag: np.ndarray, freeze_flag: np.ndarray,
+                   snow_cover: np.ndarray, s1_valid: np.ndarray, orbit_idxs: List[np.ndarray],
+                   melt_season: np.ndarray, wet_state: np.ndarray, melt_flags: np.ndarray,
+                   melt_max: np.ndarray, melt_counts: List[int]) -> Tuple[np.ndarray, ...]:
     """
-    Identifies time steps with wet snow. Sets all time slices, for a relative orbit,
-    as dry until the first melting then sets all time steps, for that relative orbit,
-    as wet until either end of time series or next re-freezing.
+    Propagate the wet snow state and perma-wet fraction through time on numpy
+    arrays with time as the first axis. See flag_wet_snow for the method.
 
-    If re-freezing revert to set all as dry until next melt. Repeat to end of time series.
-    
-    If after Feburary 1st until August 1st if last two of four relative orbits
-    were classified as wet we set remained to wet to stop retrievals
+    The scan starts from the state of each orbit after its earlier time steps
+    (see get_wet_snow_state) and returns the state after the last time step so
+    a time series can be continued without its earlier time steps.
 
     Args:
-    dataset: xarray dataset with melting, freezing as data vars
-    inplace: return copy of dataset or operate on dataset inplace?
+    wet_flag: newly wet snow flags from deltaVV and deltaCR drops (time, ...)
+    alt_wet_flag: newly wet snow flags from negative snow index (time, ...)
+    freeze_flag: newly frozen snow flags (time, ...)
+    snow_cover: boolean IMS snow cover (time, ...)
+    s1_valid: boolean of non-nan Sentinel-1 VV (time, ...)
+    orbit_idxs: list of time indexes for each relative orbit of the state
+    melt_season: boolean array of time steps in the melt season (February - July)
+    wet_state: wet snow state of each orbit before the first time step (orbit, ...)
+    melt_flags: last 3 flagged melt season images of each orbit (orbit, 3, ...)
+    melt_max: maximum rolling wet fraction of each orbit (orbit, ...)
+    melt_counts: number of images in melt_flags of each orbit (the last ones)
 
     Returns:
-    dataset: xarray data with wet_snow data var
+    wet_snow: wet snow state with perma-wet applied (time, ...)
+    perma_wet: rolling fraction of wet images in the melt season (time, ...)
+    wet_state, melt_flags, melt_max: state of each orbit after the last time step
     """
-    # check inplace flag
-    if not inplace:
-        dataset = dataset.copy(deep=True)
-
-    # check we have the neccessary variables
-    necessary_vars = set(['wet_flag', 'alt_wet_flag', 'freeze_flag'])
-    assert necessary_vars.issubset(set(dataset.data_vars)),\
-          f"Missing variables {necessary_vars.difference(set(dataset.data_vars))}"
-    
-    # create new data variable wet_snow and set to 0
-    dataset['wet_snow'] = xr.zeros_like(dataset['wet_flag'])
-    dataset['perma_wet'] = xr.zeros_like(dataset['wet_flag'])
-
-    # get all unique relative orbits
-    orbits = np.unique(dataset['relative_orbit'].values)
-
-    # Identify previous image from the same relative orbit (6, 12, 18, or 24 days ago)
-    for orbit in orbits:
-        # select just that orbit to do wet snow propogation
-        orbit_dataset = dataset.sel(time = dataset.relative_orbit == orbit)
+    dtype = np.result_type(wet_flag.dtype, np.float32)
+    wet_snow = np.zeros(wet_flag.shape, dtype = dtype)
+    perma_wet = np.zeros(wet_flag.shape, dtype = dtype)
 
-        prev_time = None
-
-        # loop through time steps in this orbit
-        for ts in orbit_dataset.time:
-
-            # if not first round then pull in previous time step's values for wet-snow
-            if prev_time:
-                dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = prev_time)['wet_snow']
+    wet_state, melt_flags, melt_max = wet_state.astype(dtype), melt_flags.astype(dtype), melt_max.astype(dtype)
 
+    for k, idx in enumerate(orbit_idxs):
+        # propagate clamped wet snow state through this orbit's time steps
+        state = wet_state[k]
+        for i in idx:
             # add newly wet snow flags to old wet snow and then bound at 1
-
-            dataset['wet_snow'].loc[dict(time = ts)] = xr.where(~dataset.sel(time = ts)['wet_flag'].isnull(),dataset.sel(time = ts)['wet_snow'] + dataset.sel(time = ts)['wet_flag'],np.nan)
-            dataset['wet_snow'].loc[dict(time = ts)] = xr.where(~dataset.sel(time = ts)['alt_wet_flag'].isnull(),dataset.sel(time = ts)['wet_snow'] + dataset.sel(time = ts)['alt_wet_flag'],np.nan)
-            dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = ts)['wet_snow'].where((dataset.sel(time = ts)['wet_snow'] < 1) | (dataset.sel(time = ts)['wet_snow'].isnull()), 1)
+            state += wet_flag[i]
+            state += alt_wet_flag[i]
+            np.minimum(state, 1, out = state)
 
             # add newly frozen snow flags to old wet snow and then bound at 0 to avoid negatives
-            dataset['wet_snow'].loc[dict(time = ts)] = xr.where(~dataset.sel(time = ts)['freeze_flag'].isnull(),dataset.sel(time = ts)['wet_snow'] - dataset.sel(time = ts)['freeze_flag'],np.nan)
-            dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = ts)['wet_snow'].where((dataset.sel(time = ts)['wet_snow'] > 0) | (dataset.sel(time = ts)['wet_snow'].isnull()), 0)
+            state -= freeze_flag[i]
+            np.maximum(state, 0, out = state)
 
             # set non snow (IMS != 4) to not wet (0)
-            dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = ts)['wet_snow'].where(dataset.sel(time = ts)['ims'] == 4, 0)
+            state[~snow_cover[i]] = 0
 
             # make nans at areas without S1 data
-            dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = ts)['wet_snow'].where(~dataset['s1'].sel(time = ts, band = 'VV').isnull(), np.nan)
-                    
-            prev_time = ts
+            state[~s1_valid[i]] = np.nan
+
+            wet_snow[i] = state
 
         # if >50% wet of last 4 cycles after feb 1 then set remainer till
-        # august 1st to perma-wet(2?)
-    
-        melt_season = (dataset['time.month'] > 1) & (dataset['time.month'] < 8)
+        # august 1st to perma-wet
+        melt_idx = idx[melt_season[idx]]
+        if len(melt_idx) == 0:
+            continue
 
-        # get images of this relative orbit and in the melt season
-        melt_season = (dataset['time.month'] > 1) & (dataset['time.month'] < 8)
+        # flagged wet by dB drop or negative snow index (floored back to 1)
+        # after the orbit's earlier flagged melt season images
+        history = melt_flags[k, 3 - melt_counts[k]:]
+        flagged = np.concatenate([history, np.minimum(wet_flag[melt_idx] + alt_wet_flag[melt_idx], 1)])
 
-        # get images of this relative orbit and in the melt season
-        melt_orbit = (melt_season & (dataset.relative_orbit == orbit))
+        # rolling mean of the last 4 images (nan until 4 valid images)
+        fraction = np.full(flagged.shape, np.nan, dtype = dtype)
+        if len(flagged) >= 4:
+            fraction[3:] = sliding_window_view(flagged, 4, axis = 0).mean(axis = -1)
 
-        # check if there are at least 4 time slices in melt season for this orbit
-        if len(dataset['perma_wet'].loc[dict(time = melt_orbit)]) < 4:
-            continue
+        # propogate forward the maximum so > 50% masks the remainder of the melt season
+        fraction = np.fmax.accumulate(np.concatenate([melt_max[k][None], fraction[len(history):]]), axis = 0)[1:]
+
+        # keep the last 3 flagged images and the maximum for the next time steps
+        n = min(len(flagged), 3)
+        melt_flags[k, :3 - n] = np.nan
+        melt_flags[k, 3 - n:] = flagged[len(flagged) - n:]
+        melt_max[k] = fraction[-1]
 
-        # first set all perma wet to match the flagged wet times from dB drop
-        dataset['perma_wet'].loc[dict(time = melt_orbit)] = \
-            dataset['wet_flag'].loc[dict(time = melt_orbit)]
-        
-        # then set times that were made wet by negative snow index to wet as well
-        dataset['perma_wet'].loc[dict(time = melt_orbit)] = dataset['perma_wet'].loc[dict(time = melt_orbit)] + \
-            dataset['alt_wet_flag'].loc[dict(time = melt_orbit)]
-        
-        # now if we are over 1 (ie it was flagged wet by dB and negative SI flags) we should floor those back to 1
-        dataset['perma_wet'].loc[dict(time = melt_orbit)] = \
-            dataset['perma_wet'].loc[dict(time = melt_orbit)].where((dataset['perma_wet'].loc[dict(time = melt_orbit)] <= 1) | (dataset['perma_wet'].loc[dict(time = melt_orbit)].isnull()) , 1)
-        
-        # now calculate the rolling mean of the perma wet so we have a % 0-1 of days out of 4 that were flagged
-        dataset['perma_wet'].loc[dict(time = melt_orbit)] = \
-            dataset['perma_wet'].loc[dict(time = melt_orbit)].rolling(time = 4).mean()
-        
-        # then propogate forward so that if we get to > 50% in a 4 image window we mask the remained of the melt season
-        # this will fail if bottleneck is installed due to it lacking the min_periods keyword
-        # see: https://github.com/pydata/xarray/issues/4922
-
-
-        if 'bottleneck' not in sys.modules:
-            dataset['perma_wet'].loc[dict(time = melt_orbit)] = \
-                dataset['perma_wet'].loc[dict(time = melt_orbit)].rolling(time = len(orbit_dataset.time), min_periods = 1).max()
-        else:
-            log.info("bottleneck installed. Consider pip uninstalling and re-running if this fails.")
-            dataset['perma_wet'].loc[dict(time = melt_orbit)] = \
-                dataset['perma_wet'].loc[dict(time = melt_orbit)].rolling(time = len(orbit_dataset.time)).max()
-
-        # set perma wet to nans if no S1 data
-        dataset['perma_wet'].loc[dict(time = melt_orbit)] = dataset.sel(dict(time = melt_orbit))['perma_wet'].where(~dataset['s1'].sel(dict(time = melt_orbit, band = 'VV')).isnull(), np.nan)
-
-        # set perma wet to 0 if no snow in IMS
-        dataset['perma_wet'].loc[dict(time = melt_orbit)] = dataset.sel(dict(time = melt_orbit))['perma_wet'].where(dataset['ims'].sel(dict(time = melt_orbit)) == 4, 0)
+        # set perma wet to nans if no S1 data and 0 if no snow in IMS
+        fraction[~s1_valid[melt_idx]] = np.nan
+        fraction[~snow_cover[melt_idx]] = 0
+
+        perma_wet[melt_idx] = fraction
 
     # if we have no data just set it to not be flagged perma_wet
-    dataset['perma_wet'] = dataset['perma_wet'].where(~dataset['perma_wet'].isnull(), 0)
+    perma_wet[np.isnan(perma_wet)] = 0
 
     # if less than 50% are wet then keep the save value for wet_snow otherwise set to 1
-    dataset['wet_snow'] = dataset['wet_snow'].where(dataset['perma_wet'] < 0.5, 1)
+    wet_snow[perma_wet >= 0.5] = 1
+
+    return wet_snow, perma_wet, wet_state, melt_flags, melt_max
+
+def _wet_snow_ufunc(wet_flag, alt_wet_flag, freeze_flag, snow_cover, s1_valid, wet_state, melt_flags, melt_max,
+                    **kwargs) -> Tuple[np.ndarray, ...]:
+    """
+    Wrapper of _wet_snow_scan for xr.apply_ufunc (time, orbit and lag as the last axes).
+    """
+    args = [np.moveaxis(arg, -1, 0) for arg in [wet_flag, alt_wet_flag, freeze_flag, snow_cover, s1_valid,
+                                                wet_state, melt_max]]
+    wet_state, melt_max = args[5:]
+    melt_flags = np.moveaxis(melt_flags, [-2, -1], [0, 1])
+
+    wet_snow, perma_wet, wet_state, melt_flags, melt_max = _wet_snow_scan(*args[:5], wet_state = wet_state,
+                                                                          melt_flags = melt_flags, melt_max = melt_max,
+                                                                          **kwargs)
+
+    return np.moveaxis(wet_snow, 0, -1), np.moveaxis(perma_wet, 0, -1), np.moveaxis(wet_state, 0, -1), \
+        np.moveaxis(melt_flags, [0, 1], [-2, -1]), np.moveaxis(melt_max, 0, -1)
+
+def _apply_wet_snow_scan(dataset: xr.Dataset, state: xr.Dataset = None) -> Tuple[xr.DataArray, xr.DataArray, xr.Dataset]:
+    """
+    Run _wet_snow_scan on a dataset's flags starting from state.
+
+    Args:
+    dataset: xarray dataset with wet_flag, alt_wet_flag, freeze_flag, ims and s1
+    state: wet snow state from get_wet_snow_state of the time steps before
+    dataset [default: None for no earlier time steps]
+
+    Returns:
+    wet_snow: wet snow DataArray
+    perma_wet: perma wet DataArray
+    state: wet snow state after the last time step of dataset
+    """
+    # check we have the neccessary variables
+    necessary_vars = set(['wet_flag', 'alt_wet_flag', 'freeze_flag'])
+    assert necessary_vars.issubset(set(dataset.data_vars)),\
+          f"Missing variables {necessary_vars.difference(set(dataset.data_vars))}"
+
+    # dtype of the wet snow state (for chunked datasets)
+    dtype = np.result_type(dataset['wet_flag'].dtype, np.float32)
+
+    # state of every relative orbit of the earlier time steps and this dataset
+    relative_orbits = dataset['relative_orbit'].values
+    template = dataset['wet_flag'].isel(time = 0, drop = True).astype(dtype)
+    if state is None:
+        state = _empty_wet_snow_state(np.unique(relative_orbits), template)
+    else:
+        new_orbits = np.setdiff1d(np.unique(relative_orbits), state['orbit'].values)
+        state = xr.concat([state, _empty_wet_snow_state(new_orbits, template)], dim = 'orbit')
+    orbits = state['orbit'].values
+
+    # time indexes of each relative orbit
+    orbit_idxs = [np.flatnonzero(relative_orbits == orbit) for orbit in orbits]
+
+    # melt season is February through July
+    melt_season = ((dataset['time.month'] > 1) & (dataset['time.month'] < 8)).values
+
+    melt_counts = state['melt_count'].values
+    wet_snow, perma_wet, wet_state, melt_flags, melt_max = xr.apply_ufunc(
+        _wet_snow_ufunc, dataset['wet_flag'], dataset['alt_wet_flag'], dataset['freeze_flag'], dataset['ims'] == 4,
+        dataset['s1'].sel(band = 'VV', drop = True).notnull(), state['wet_state'], state['melt_flags'], state['melt_max'],
+        input_core_dims = [['time']] * 5 + [['orbit'], ['orbit', 'lag'], ['orbit']],
+        output_core_dims = [['time'], ['time'], ['orbit'], ['orbit', 'lag'], ['orbit']],
+        kwargs = {'orbit_idxs': orbit_idxs, 'melt_season': melt_season, 'melt_counts': melt_counts},
+        dask = 'parallelized', output_dtypes = [dtype] * 5)
+
+    # number of flagged melt season images kept for each orbit
+    melt_counts = [min(count + melt_season[idx].sum(), 3) for count, idx in zip(melt_counts, orbit_idxs)]
+
+    dims = template.dims
+    state = xr.Dataset(data_vars = dict(wet_state = wet_state.transpose('orbit', *dims),
+                                        melt_flags = melt_flags.transpose('orbit', 'lag', *dims),
+                                        melt_max = melt_max.transpose('orbit', *dims)),
+                       coords = dict(orbit = orbits, melt_count = ('orbit', melt_counts)))
+
+    return wet_snow, perma_wet, state
+
+def _empty_wet_snow_state(orbits: np.ndarray, template: xr.DataArray) -> xr.Dataset:
+    """
+    Wet snow state of orbits without earlier time steps (dry with no flagged
+    melt season images).
+    """
+    dims = template.dims
+    shape = (len(orbits), *template.shape)
+    return xr.Dataset(data_vars = dict(wet_state = (('orbit', *dims), np.zeros(shape, dtype = template.dtype)),
+                                       melt_flags = (('orbit', 'lag', *dims), np.full((len(orbits), 3, *template.shape), np.nan, dtype = template.dtype)),
+                                       melt_max = (('orbit', *dims), np.full(shape, np.nan, dtype = template.dtype))),
+                      coords = dict(orbit = np.asarray(orbits, dtype = int), melt_count = ('orbit', np.zeros(len(orbits), dtype = int)),
+                                    **{d: template[d] for d in dims if d in template.coords}))
+
+def get_wet_snow_state(dataset: xr.Dataset, state: xr.Dataset = None) -> xr.Dataset:
+    """
+    Get the wet snow state of each relative orbit after the last time step of a
+    dataset. Passing the state to flag_wet_snow of the following time steps
+    continues the time series without its earlier time steps.
+
+    The state is the wet snow state before perma-wet masking, the last 3
+    flagged melt season images and the maximum rolling wet fraction of each
+    relative orbit.
+
+    Args:
+    dataset: xarray dataset with melting, freezing as data vars
+    state: wet snow state of the time steps before dataset [default: None]
+
+    Returns:
+    state: xarray dataset of wet_state, melt_flags and melt_max with an orbit
+    dimension of relative orbits
+    """
+    return _apply_wet_snow_scan(dataset, state = state)[2]
+
+def flag_wet_snow(dataset: xr.Dataset, inplace: bool = False, state: xr.Dataset = None) -> Union[None, xr.Dataset]:
+    """
+    Identifies time steps with wet snow. Sets all time slices, for a relative orbit,
+    as dry until the first melting then sets all time steps, for that relative orbit,
+    as wet until either end of time series or next re-freezing.
+
+    If re-freezing revert to set all as dry until next melt. Repeat to end of time series.
+    
+    If after Feburary 1st until August 1st if last two of four relative orbits
+    were classified as wet we set remained to wet to stop retrievals
+
+    The wet snow state is propagated per pixel on numpy arrays in one pass per
+    relative orbit.
+
+    Args:
+    dataset: xarray dataset with melting, freezing as data vars
+    inplace: return copy of dataset or operate on dataset inplace?
+    state: wet snow state from get_wet_snow_state of earlier time steps to
+    continue from [default: None to start dry]
+
+    Returns:
+    dataset: xarray data with wet_snow data var
+    """
+    # check inplace flag
+    if not inplace:
+        dataset = dataset.copy()
+
+    wet_snow, perma_wet, _ = _apply_wet_snow_scan(dataset, state = state)
 
-    dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = ts)['wet_snow'].where(dataset.sel(time = ts)['ims'] == 4, 0)
+    dataset['wet_snow'] = wet_snow.transpose(*dataset['wet_flag'].dims)
+    dataset['perma_wet'] = perma_wet.transpose(*dataset['wet_flag'].dims)
 
-    return dataset
+    return dataset
\ No newline at end of file
@@ -3,11 +3,14 @@ Main user function to retrieve snow depth with snow depth and wet snow flag
 """
 import os
 from os.path import join
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import xarray as xr
+import netCDF4
 import shapely.geometry
-from typing import Tuple, Union, List
+from typing import Dict, Tuple, Union, List
 import logging
 
 # Add main repo to path
@@ -16,22 +19,28 @@ from os.path import expanduser
 sys.path.append(expanduser('../'))
 
 # import functions for downloading
-from spicy_snow.download.sentinel1 import s1_img_search, hyp3_pipeline, download_hyp3, combine_s1_images
-from spicy_snow.download.forest_cover import download_fcf
-from spicy_snow.download.snow_cover import download_snow_cover
+from spicy_snow.download.sentinel1 import s1_img_search, hyp3_pipeline, download_hyp3, combine_s1_images, \
+    iter_hyp3_jobs, get_hyp3_client
+from spicy_snow.download.forest_cover import download_fcf, get_fcf_fp
+from spicy_snow.download.snow_cover import download_snow_cover, fetch_ims_days
 
 # import functions for pre-processing
-from spicy_snow.processing.s1_preprocessing import merge_partial_s1_images, s1_orbit_averaging,\
+from spicy_snow.processing.s1_preprocessing import merge_partial_s1_images, \
 s1_clip_outliers, subset_s1_images, ims_water_mask, s1_incidence_angle_masking, merge_s1_subsets, \
-add_confidence_angle
+add_confidence_angle, calc_s1_percentiles, stream_s1_percentiles
 
 # import the functions for snow_index calculation
 from spicy_snow.processing.snow_index import calc_delta_VV, calc_delta_cross_ratio, \
-    calc_delta_gamma, clip_delta_gamma_outlier, calc_snow_index, calc_snow_index_to_snow_depth
+    calc_delta_gamma, clip_delta_gamma_outlier, calc_snow_index, calc_snow_index_to_snow_depth, \
+    find_repeat_interval
 
 # import the functions for wet snow flag
 from spicy_snow.processing.wet_snow import id_newly_frozen_snow, id_newly_wet_snow, \
-    id_wet_negative_si, flag_wet_snow
+    id_wet_negative_si, flag_wet_snow, get_wet_snow_state
+
+# import functions for checkpointing stages
+from spicy_snow.utils.checkpoint import get_checkpoint_keys, find_checkpoint, save_checkpoint, load_checkpoint, \
+    get_checkpoint_fp
 
 # setup root logger
 from spicy_snow.utils.spicy_logging import setup_logging
@@ -47,7 +56,11 @@ def retrieve_snow_depth(area: shapely.geometry.Polygon,
                         freezing_snow_thresh: float = 1,
                         wet_SI_thresh: float = 0,
                         outfp: Union[str, Path, bool] = False,
-                        params: List[float] = [2.5, 0.2, 0.55]) -> xr.Dataset:
+                        params: List[float] = [2.5, 0.2, 0.55],
+                        pipeline: bool = False,
+                        checkpoint: bool = False,
+                        chunks: int = None,
+                        target_dates: List[str] = None) -> xr.Dataset:
     """
     Finds, downloads Sentinel-1, forest cover, water mask (not implemented), and 
     snow coverage. Then retrieves snow depth using Lievens et al. 2021 method.
@@ -65,6 +78,20 @@ def retrieve_snow_depth(area: shapely.geometry.Polygon,
     wet_SI_thresh: what threshold to use for negative snow index? Default: 0
     outfp: do you want to save netcdf? default is False and will just return dataset
     params: the A, B, C parameters to use in the model. Current defaults are optimized to north america
+    pipeline: download and warp each hyp3 job as soon as it succeeds and fetch IMS and
+    FCF data at the same time instead of waiting for all jobs to finish. Default: False
+    checkpoint: save the dataset after each stage in work_dir/checkpoints and resume from the
+    last saved stage of a run with the same area, scenes found and parameters. Checkpoints
+    are full copies of the dataset and aren't removed so clear old ones yourself. Default: False
+    chunks: run out of core with dask in spatial chunks of this many pixels (with the full
+    time series in every chunk). With checkpoints each stage is streamed to disk and read
+    back chunk by chunk so memory is bounded by the chunk size. Default: None (in memory)
+    target_dates: only retrieve snow depth for these dates. Needs checkpoint = True. The
+    download, merge and ancillary stages still hold the full time series in memory but
+    the stages after them read the ancillary checkpoint one time step at a time keeping
+    only the rolling state the algorithm needs so their memory doesn't grow with the
+    number of time steps. Only the images acquired in the repeat interval up to each date
+    (the latest image of each relative orbit) are returned. Default: None (all images)
 
     Returns:
     datset: Xarray dataset with 'snow_depth' and 'wet_snow' variables for all Sentinel-1
@@ -87,6 +114,16 @@ def retrieve_snow_depth(area: shapely.geometry.Polygon,
     assert len(params) == 3, f"List of params must be 3 in order A, B, C. Got {params}"
     A, B, C = params
 
+    if chunks is not None:
+        assert isinstance(chunks, int) and chunks > 0, f"Chunks must be a positive number of pixels. Got {chunks}"
+
+    if target_dates is not None:
+        assert chunks is None, "Can't use chunks with target_dates"
+        assert checkpoint, "target_dates streams time steps from the ancillary checkpoint so needs checkpoint = True"
+        target_dates = pd.to_datetime(list(target_dates))
+        assert ((target_dates >= pd.to_datetime(dates[0])) & (target_dates <= pd.to_datetime(dates[1]))).all(), \
+            f"Target dates {target_dates} must be between {dates}"
+
     if type(outfp) != bool:
         outfp = Path(outfp).expanduser().resolve()
         assert outfp.parent.exists(), f"Out filepath {outfp}'s directory does not exist"
@@ -104,7 +141,7 @@ def retrieve_snow_depth(area: shapely.geometry.Polygon,
     if freezing_snow_thresh <= 0:
         log.warning(f"Running with refreeze threshold of {freezing_snow_thresh}. This value is negative but should be positive.")
     
-    ## Downloading Steps
+    ## Search
 
     # get asf_search search results
     search_results = s1_img_search(area, dates)
@@ -113,88 +150,629 @@ def retrieve_snow_depth(area: shapely.geometry.Polygon,
     assert len(search_results) > 3, f"Need at least 4 images to run. Found {len(search_results)} \
     using area: {area} and dates: {dates}."
 
-    # download s1 images into dataset ['s1'] variable name
-    jobs = hyp3_pipeline(search_results, job_name = job_name, existing_job_name = existing_job_name)
-    imgs = download_hyp3(jobs, area, outdir = join(work_dir, 'tmp'), clean = False)
-    ds = combine_s1_images(imgs)
+    ## Checkpoints
 
-    # merge partial images together
-    ds = merge_partial_s1_images(ds)
+    # each stage's key chains the key of the stage before with its parameters. The
+    # scenes found are in the first key so a rerun after new images are published starts again
+    checkpoint_dir = join(work_dir, 'checkpoints')
+    scenes = sorted(search_results['properties.sceneName'])
+    keys = get_checkpoint_keys([('combined', {'area': area.wkt, 'dates': dates, 'scenes': scenes}),
+                                ('merged', {}),
+                                ('ancillary', {}),
+                                ('preprocessed', {}),
+                                ('snow_index', {'A': A, 'B': B, 'ims_masking': ims_masking})])
+    # dask chunks of the out of core mode with the full time series in every chunk
+    ds_chunks = {'time': -1, 'y': chunks, 'x': chunks} if chunks else None
 
-    # download IMS snow cover and add to dataset ['ims'] keyword
-    ds = download_snow_cover(ds, tmp_dir = join(work_dir, 'tmp'), clean = False)
+    if target_dates is not None:
+        # target dates are streamed from the ancillary stage
+        keys = {name: keys[name] for name in ['combined', 'merged', 'ancillary']}
 
-    # download fcf and add to dataset ['fcf'] keyword
-    ds = download_fcf(ds, join(work_dir, 'tmp', 'fcf.tif'))
+    stage, ds = find_checkpoint(checkpoint_dir, keys, chunks = ds_chunks) if checkpoint else (None, None)
+    # stages already done
+    done = list(keys)[:list(keys).index(stage) + 1] if stage else []
 
-    ## Preprocessing Steps
-    log.info("Preprocessing Sentinel-1 images")
+    ## Downloading Steps
+
+    if 'combined' not in done:
+        # download s1 images into dataset ['s1'] variable name
+        if pipeline:
+            # one hyp3 login for submitting and checking on the jobs
+            hyp3 = get_hyp3_client()
+            jobs = hyp3_pipeline(search_results, job_name = job_name, existing_job_name = existing_job_name,
+                                 watch = False, hyp3 = hyp3)
+
+            # fetch IMS days and FCF into their caches while hyp3 jobs run and download
+            times = [pd.to_datetime(granule.split('_')[4]) for granule in search_results['properties.sceneName']]
+            with ThreadPoolExecutor(max_workers = 2) as executor:
+                ims_future = executor.submit(fetch_ims_days, times)
+                fcf_future = executor.submit(get_fcf_fp)
+                imgs = download_hyp3(iter_hyp3_jobs(jobs, hyp3 = hyp3), area, outdir = join(work_dir, 'tmp'), clean = False)
+                ims_future.result()
+                fcf_future.result()
+        else:
+            jobs = hyp3_pipeline(search_results, job_name = job_name, existing_job_name = existing_job_name)
+            imgs = download_hyp3(jobs, area, outdir = join(work_dir, 'tmp'), clean = False)
+        ds = combine_s1_images(imgs, search_results = search_results)
+
+        if ds_chunks:
+            ds = ds.chunk(ds_chunks)
+
+        if checkpoint:
+            ds = _save_stage(ds, checkpoint_dir, 'combined', keys['combined'], chunks = ds_chunks)
+
+    if 'merged' not in done:
+        # merge partial images together
+        ds = merge_partial_s1_images(ds)
+
+        if checkpoint:
+            ds = _save_stage(ds, checkpoint_dir, 'merged', keys['merged'], chunks = ds_chunks)
+
+    if 'ancillary' not in done:
+        # download IMS snow cover and add to dataset ['ims'] keyword
+        ds = download_snow_cover(ds, tmp_dir = join(work_dir, 'tmp'), clean = False)
+
+        # download fcf and add to dataset ['fcf'] keyword
+        ds = download_fcf(ds)
+
+        if checkpoint:
+            ds = _save_stage(ds, checkpoint_dir, 'ancillary', keys['ancillary'], chunks = ds_chunks)
+
+    ## Target Date Steps
+    if target_dates is not None:
+        log.info(f"Streaming Sentinel-1 images for {len(target_dates)} target dates")
+        # read time steps from the ancillary checkpoint one at a time
+        ds.close()
+        ds = xr.open_dataset(get_checkpoint_fp(checkpoint_dir, 'ancillary', keys['ancillary']), decode_coords = 'all')
+        with ds:
+            ds = _retrieve_target_dates(ds, target_dates, (A, B, C), ims_masking = ims_masking,
+                                        wet_snow_thresh = wet_snow_thresh, freezing_snow_thresh = freezing_snow_thresh,
+                                        wet_SI_thresh = wet_SI_thresh)
+        ds.attrs['target_dates'] = [date.strftime('%Y-%m-%d') for date in target_dates]
+
+    else:
+        ## Preprocessing Steps
+        if 'preprocessed' not in done:
+            log.info("Preprocessing Sentinel-1 images")
+
+            ds = _preprocess_s1(ds)
+
+            if ds_chunks:
+                # merging the subsets splits the time series into several chunks
+                ds = ds.chunk(ds_chunks)
+
+            # calculate confidence interval
+            add_confidence_angle(ds, inplace = True)
+
+            if checkpoint:
+                ds = _save_stage(ds, checkpoint_dir, 'preprocessed', keys['preprocessed'], chunks = ds_chunks)
+
+        ## Snow Index Steps
+        if 'snow_index' not in done:
+            log.info("Calculating snow index")
+            # calculate delta CR and delta VV
+            calc_delta_cross_ratio(ds, A = A, inplace = True)
+            calc_delta_VV(ds, inplace = True)
+
+            # calculate delta gamma with delta CR and delta VV with FCF
+            calc_delta_gamma(ds, B = B, inplace = True)
+
+            # clip outliers of delta gamma
+            clip_delta_gamma_outlier(ds, inplace = True)
+
+            # calculate snow_index from delta_gamma
+            calc_snow_index(ds, ims_masking = ims_masking, inplace = True)
+
+            if checkpoint:
+                ds = _save_stage(ds, checkpoint_dir, 'snow_index', keys['snow_index'], chunks = ds_chunks)
+
+        # convert snow index to snow depth
+        calc_snow_index_to_snow_depth(ds, C = C, inplace = True)
+
+        ## Wet Snow Flags
+        log.info("Flag wet snow")
+        # find newly wet snow
+        id_newly_wet_snow(ds, wet_thresh = wet_snow_thresh, inplace = True)
+        id_wet_negative_si(ds, wet_SI_thresh = wet_SI_thresh, inplace = True)
+
+        # find newly frozen snow
+        id_newly_frozen_snow(ds, freeze_thresh = freezing_snow_thresh, inplace = True)
+
+        # make wet_snow flag
+        flag_wet_snow(ds, inplace = True)
+
+    ds.attrs['param_A'] = A
+    ds.attrs['param_B'] = B
+    ds.attrs['param_C'] = C
+
+    # masking and thresholds for append_snow_depth to continue with (netcdf has no booleans)
+    ds.attrs['ims_masking'] = int(ims_masking)
+    ds.attrs['wet_snow_thresh'] = wet_snow_thresh
+    ds.attrs['freezing_snow_thresh'] = freezing_snow_thresh
+    ds.attrs['wet_SI_thresh'] = wet_SI_thresh
+
+    ds.attrs['job_name'] = job_name
+
+    ds.attrs['bounds'] = area.bounds
+
+    if outfp:
+        outfp = str(outfp)
+        
+        if target_dates is not None:
+            ds.to_netcdf(outfp)
+        else:
+            # time is unlimited so append_snow_depth can add new time steps in place
+            ds.to_netcdf(outfp, unlimited_dims = ['time'])
+            _save_wet_snow_state(get_wet_snow_state(ds), outfp)
+
+    return ds
+
+def _preprocess_s1(dataset: xr.Dataset, percentiles: Dict[str, xr.DataArray] = None) -> xr.Dataset:
+    """
+    Mask incidence angle outliers and clip backscatter outliers of each subset
+    of platform and flight direction. The percentiles used to clip each subset
+    are saved in the attributes (s1_percentiles_{subset} as VV, VH 10th then
+    VV, VH 90th percentiles) so appended images can be clipped the same way.
+
+    Args:
+    dataset: dataset of Sentinel-1 images with ims and fcf
+    percentiles: dictionary of subset names and percentiles from
+    calc_s1_percentiles to clip with [default: None to calculate from dataset]
+
+    Returns:
+    dataset: preprocessed dataset
+    """
+    log = logging.getLogger(__name__)
 
     #TODO add water mask
     # ds = ims_water_mask(ds)
 
     # mask out outliers in incidence angle
-    ds = s1_incidence_angle_masking(ds)
-    
+    s1_incidence_angle_masking(dataset, inplace = True)
+
     # subset dataset by flight_dir and platform
-    dict_ds = subset_s1_images(ds)
+    dict_ds = subset_s1_images(dataset)
 
+    used = {}
     for subset_name, subset_ds in dict_ds.items():
-        # average each orbit to overall mean
-        dict_ds[subset_name] = s1_orbit_averaging(subset_ds)
+        if percentiles is not None and subset_name not in percentiles:
+            log.warning(f"No saved percentiles for {subset_name}. Calculating from its {subset_ds.sizes['time']} images")
+        used[subset_name] = percentiles.get(subset_name) if percentiles is not None else None
+        if used[subset_name] is None:
+            used[subset_name] = calc_s1_percentiles(subset_ds)
+
+        # orbit averaging (s1_orbit_averaging) isn't applied. Its result was always
+        # overwritten by the clipping below so retrievals have never used it and
+        # it only cost an extra pass over the data
         # clip outlier values of backscatter to overall mean
-        dict_ds[subset_name] = s1_clip_outliers(subset_ds)
-    
+        dict_ds[subset_name] = s1_clip_outliers(subset_ds, percentiles = used[subset_name])
+
     # recombine subsets
-    ds = merge_s1_subsets(dict_ds)
+    dataset = merge_s1_subsets(dict_ds)
+
+    for subset_name, subset_percentiles in used.items():
+        dataset.attrs[f's1_percentiles_{subset_name}'] = subset_percentiles.values.ravel().tolist()
+
+    return dataset
+
+def _get_s1_percentiles(attrs: dict) -> Dict[str, xr.DataArray]:
+    """
+    Read the percentiles of each subset saved by _preprocess_s1.
+    """
+    percentiles = {}
+    for key, values in attrs.items():
+        if key.startswith('s1_percentiles_'):
+            percentiles[key.replace('s1_percentiles_', '')] = \
+                xr.DataArray(np.reshape(values, (2, 2)), dims = ['quantile', 'band'],
+                             coords = {'quantile': [0.1, 0.9], 'band': ['VV', 'VH']})
+
+    return percentiles
+
+def _save_wet_snow_state(state: xr.Dataset, fp: Union[str, Path]) -> None:
+    """
+    Save the wet snow state of each relative orbit in a wet_snow_state/{orbit}
+    group of a netcdf. Groups of orbits already saved are overwritten.
+    """
+    for orbit in state['orbit'].values:
+        orbit_state = state.sel(orbit = orbit)
+        orbit_state = orbit_state.reset_coords(drop = True).assign_attrs(melt_count = int(orbit_state['melt_count']))
+        orbit_state.to_netcdf(fp, mode = 'a', group = f'wet_snow_state/{orbit}')
+
+def _load_wet_snow_state(fp: Union[str, Path]) -> Union[xr.Dataset, None]:
+    """
+    Load the wet snow state saved by _save_wet_snow_state (None if the netcdf
+    has no wet snow state).
+    """
+    with netCDF4.Dataset(fp) as nc:
+        orbits = list(nc['wet_snow_state'].groups) if 'wet_snow_state' in nc.groups else []
+
+    if not orbits:
+        return None
+
+    states = [xr.load_dataset(fp, group = f'wet_snow_state/{orbit}') for orbit in orbits]
+    state = xr.concat(states, dim = pd.Index([int(orbit) for orbit in orbits], name = 'orbit'), combine_attrs = 'drop')
+
+    return state.assign_coords(melt_count = ('orbit', [s.attrs['melt_count'] for s in states]))
+
+def _append_time_steps(fp: Union[str, Path], dataset: xr.Dataset) -> None:
+    """
+    Append the time steps of dataset to the time variables of a netcdf in
+    place. Values are encoded with each variable's encoding in the netcdf.
+    Netcdfs without an unlimited time dimension are rewritten once with one.
+
+    Args:
+    fp: filepath of netcdf
+    dataset: dataset of time steps after the last time step of the netcdf
+    """
+    log = logging.getLogger(__name__)
+
+    # encoding keys of the saved variables to encode new values with
+    encoding_keys = ['dtype', 'units', 'calendar', '_FillValue', 'scale_factor', 'add_offset']
+    with xr.open_dataset(fp, decode_coords = 'all') as stored:
+        time_vars = {name: (var.dims, {k: v for k, v in var.encoding.items() if k in encoding_keys})
+                     for name, var in stored.variables.items() if 'time' in var.dims}
+
+    with netCDF4.Dataset(fp) as nc:
+        unlimited = nc.dimensions['time'].isunlimited()
+
+    for name in set(time_vars).symmetric_difference(name for name, var in dataset.variables.items() if 'time' in var.dims):
+        log.warning(f"{name} is not in both the saved and appended time steps. Skipping it.")
+
+    if not unlimited:
+        log.info(f"Rewriting {fp} with an unlimited time dimension")
+        with xr.open_dataset(fp, decode_coords = 'all') as stored:
+            stored = stored.load()
+        dataset = xr.concat([stored, dataset], dim = 'time', data_vars = 'minimal', coords = 'minimal',
+                            compat = 'override', join = 'override', combine_attrs = 'override')
+        dataset = dataset[[name for name in stored.data_vars if name in dataset.data_vars]]
+        state = _load_wet_snow_state(fp)
+
+        tmp_fp = Path(fp).with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            dataset.to_netcdf(tmp_fp, unlimited_dims = ['time'])
+            if state is not None:
+                _save_wet_snow_state(state, tmp_fp)
+            os.replace(tmp_fp, fp)
+        finally:
+            if tmp_fp.exists():
+                os.remove(tmp_fp)
+        return
+
+    with netCDF4.Dataset(fp, 'a') as nc:
+        n = nc.dimensions['time'].size
+        for name, (dims, encoding) in time_vars.items():
+            if name not in dataset.variables:
+                continue
+
+            var = dataset[name].variable.transpose(*dims).copy(deep = False)
+            var.encoding = encoding
+            values = xr.conventions.encode_cf_variable(var, name = name).values
+
+            nc_var = nc[name]
+            nc_var.set_auto_maskandscale(False)
+            if nc_var.dtype == str:
+                values = values.astype(object)
+
+            index = tuple(slice(n, n + dataset.sizes['time']) if d == 'time' else slice(None) for d in dims)
+            nc_var[index] = values
+
+def append_snow_depth(fp: Union[str, Path],
+                      end_date: str = None,
+                      work_dir: str = './',
+                      job_name: str = 'spicy-snow-append',
+                      existing_job_name: Union[bool, str] = False,
+                      debug: bool = False,
+                      ims_masking: bool = None,
+                      wet_snow_thresh: float = None,
+                      freezing_snow_thresh: float = None,
+                      wet_SI_thresh: float = None) -> xr.Dataset:
+    """
+    Append Sentinel-1 images acquired since the last time step of a saved
+    retrieval (outfp of retrieve_snow_depth) to it in place.
+
+    Only new granules are downloaded and only the new time steps are
+    calculated. They continue from the saved time steps needed by the
+    algorithm: the previous image of each relative orbit, the previous snow
+    index window and the wet snow state of each relative orbit. New images are
+    clipped with the saved outlier percentiles and use the saved forest cover.
+    The confidence angle is not updated.
+
+    A, B, C, the masking and the thresholds are read from the saved retrieval.
+    Masking and threshold arguments given must match the saved ones (they are
+    only used for retrievals saved without them).
+
+    Args:
+    fp: filepath of netcdf saved by retrieve_snow_depth
+    end_date: date to search for new images until [default: None for today]
+    work_dir: filepath to directory to work in. Will be created if not existing
+    job_name: name for hyp3 job
+    existing_job_name: name for preexisiting hyp3 job to download and avoid resubmitting
+    debug: do you want to get verbose logging?
+    ims_masking: do you want to mask pixels by IMS snow free imagery? Default: saved value or True
+    wet_snow_thresh: what threshold in dB change to use for melting and re-freezing snow? Default: saved value or -2
+    freezing_snow_thresh: what threshold in dB change to use for re-freezing snow id. Default: saved value or +1
+    wet_SI_thresh: what threshold to use for negative snow index? Default: saved value or 0
+
+    Returns:
+    dataset: Xarray dataset of all time steps (opened lazily from fp)
+    """
+    fp = Path(fp).expanduser()
+    assert fp.exists(), f"No retrieval at {fp} to append to"
 
-    # calculate confidence interval
-    ds = add_confidence_angle(ds)
+    if isinstance(work_dir, Path):
+        work_dir = str(work_dir)
+    os.makedirs(work_dir, exist_ok = True)
+
+    setup_logging(log_dir = join(work_dir, 'logs'), debug = debug)
+    log = logging.getLogger(__name__)
+
+    stored = xr.open_dataset(fp, decode_coords = 'all')
+    assert 'target_dates' not in stored.attrs, f"{fp} only has the images of its target dates so can't be appended to"
+    assert 'mosaic_tiles' not in stored.attrs, f"{fp} is a mosaic of tiles so can't be appended to. Append to each tile instead"
+    A, B, C = stored.attrs['param_A'], stored.attrs['param_B'], stored.attrs['param_C']
+
+    # masking and thresholds of the saved retrieval
+    settings = {'ims_masking': ims_masking, 'wet_snow_thresh': wet_snow_thresh,
+                'freezing_snow_thresh': freezing_snow_thresh, 'wet_SI_thresh': wet_SI_thresh}
+    defaults = {'ims_masking': True, 'wet_snow_thresh': -2, 'freezing_snow_thresh': 1, 'wet_SI_thresh': 0}
+    for name, value in settings.items():
+        if name in stored.attrs:
+            saved = bool(stored.attrs[name]) if name == 'ims_masking' else stored.attrs[name]
+            assert value is None or value == saved, f"{name} of {value} doesn't match the saved retrieval's {saved}"
+            settings[name] = saved
+        elif value is None:
+            log.warning(f"No {name} saved in {fp}. Using {defaults[name]}")
+            settings[name] = defaults[name]
+    ims_masking = settings.pop('ims_masking')
+    area = shapely.geometry.box(*stored.attrs['bounds'])
+    times = pd.DatetimeIndex(stored.time.values)
+
+    ## Downloading Steps
+
+    # images since the last saved time step from passes that aren't saved yet
+    end_date = end_date if end_date else pd.Timestamp.today().strftime('%Y-%m-%d')
+    try:
+        search_results = s1_img_search(area, (times[-1].strftime('%Y-%m-%d'), end_date))
+    except ValueError:
+        search_results = pd.DataFrame({'properties.orbit': []})
+    search_results = search_results[~search_results['properties.orbit'].isin(stored['absolute_orbit'].values)]
+    log.info(f'Found {len(search_results)} new results')
+
+    if len(search_results) == 0:
+        return stored
+
+    jobs = hyp3_pipeline(search_results, job_name = job_name, existing_job_name = existing_job_name)
+    imgs = download_hyp3(jobs, area, outdir = join(work_dir, 'tmp'), clean = False)
+    ds = combine_s1_images(imgs, search_results = search_results)
+    ds = merge_partial_s1_images(ds)
+
+    if (ds.time <= times[-1]).any():
+        log.warning(f"Skipping {int((ds.time <= times[-1]).sum())} images from before the last saved time step")
+        ds = ds.sel(time = ds.time > times[-1])
+        if ds.sizes['time'] == 0:
+            return stored
+
+    # images are on the same global grid as the saved retrieval
+    assert ds.sizes['x'] == stored.sizes['x'] and ds.sizes['y'] == stored.sizes['y'] \
+        and np.allclose(ds.x, stored.x) and np.allclose(ds.y, stored.y), "New images are not on the saved grid"
+    ds = ds.assign_coords(x = stored.x, y = stored.y)
+
+    ds = download_snow_cover(ds, tmp_dir = join(work_dir, 'tmp'), clean = False)
+    ds['fcf'] = stored['fcf'].load()
+
+    ## Preprocessing Steps
+    log.info(f"Preprocessing {ds.sizes['time']} new Sentinel-1 images")
+    ds = _preprocess_s1(ds, percentiles = _get_s1_percentiles(stored.attrs))
 
     ## Snow Index Steps
-    log.info("Calculating snow index")
-    # calculate delta CR and delta VV
-    ds = calc_delta_cross_ratio(ds, A = A)
-    ds = calc_delta_VV(ds)
+    log.info("Calculating snow index and wet snow of new images")
+    # repeat interval of all time steps
+    orbits = xr.Dataset(coords = dict(time = np.concatenate([times.values, ds.time.values]),
+                                      relative_orbit = ('time', np.concatenate([stored['relative_orbit'].values,
+                                                                                ds['relative_orbit'].values]))))
+    repeat = find_repeat_interval(orbits)
+
+    # saved time steps in the previous snow index window of the first new image
+    # and the previous image of each relative orbit
+    context_idx = _get_context_idx(times, stored['relative_orbit'].values, ds.time.values[0], repeat,
+                                   orbits = np.unique(ds['relative_orbit'].values))
+    context = stored[['s1', 'ims', 'snow_index']].isel(time = context_idx).load()
+
+    # continue the wet snow state of each orbit (computed once for retrievals saved without it)
+    state = _load_wet_snow_state(fp)
+    if state is None:
+        log.info("No saved wet snow state. Calculating it from the saved time steps")
+        state = get_wet_snow_state(stored)
+
+    ds, state = _continue_time_steps(context, ds, (A, B, C), repeat, state, ims_masking = ims_masking, **settings)
+
+    if 'confidence' in stored.data_vars:
+        ds['confidence'] = stored['confidence'].load()
+
+    ## Save
+    stored.close()
+    _append_time_steps(fp, ds)
+    _save_wet_snow_state(state, fp)
+    log.info(f"Appended {ds.sizes['time']} time steps to {fp}")
+
+    return xr.open_dataset(fp, decode_coords = 'all')
+
+def _retrieve_target_dates(dataset: xr.Dataset,
+                           target_dates: pd.DatetimeIndex,
+                           params: Tuple[float, float, float],
+                           ims_masking: bool = True,
+                           wet_snow_thresh: float = -2,
+                           freezing_snow_thresh: float = 1,
+                           wet_SI_thresh: float = 0) -> xr.Dataset:
+    """
+    Retrieve snow depth of the images of target dates by streaming the time
+    axis in order. The outlier percentiles of each subset are calculated first
+    (stream_s1_percentiles), then each time step is read, preprocessed and
+    continued from the rolling state of the time steps before it: the previous
+    snow index window, the previous image of each relative orbit and the wet
+    snow state. Only the time steps in the repeat interval up to the end of
+    each target date are kept.
 
-    # calculate delta gamma with delta CR and delta VV with FCF
-    ds = calc_delta_gamma(ds, B = B)
+    Orbit averaging isn't applied (as in _preprocess_s1) and the confidence
+    angle isn't calculated.
 
-    # clip outliers of delta gamma
-    ds = clip_delta_gamma_outlier(ds)
+    Args:
+    dataset: dataset of Sentinel-1 images with ims and fcf (e.g. opened lazily from a netcdf)
+    target_dates: dates to retrieve snow depth for
+    params: the A, B, C parameters to use in the model
+    ims_masking: do you want to mask pixels by IMS snow free imagery?
+    wet_snow_thresh: what threshold in dB change to use for melting and re-freezing snow? Default: -2
+    freezing_snow_thresh: what threshold in dB change to use for re-freezing snow id. Default: +2
+    wet_SI_thresh: what threshold to use for negative snow index? Default: 0
 
-    # calculate snow_index from delta_gamma
-    ds = calc_snow_index(ds, ims_masking = ims_masking)
+    Returns:
+    dataset: Xarray dataset of the time steps of the target dates
+    """
+    log = logging.getLogger(__name__)
 
-    # convert snow index to snow depth
-    ds = calc_snow_index_to_snow_depth(ds, C = C)
+    times = pd.DatetimeIndex(dataset.time.values)
+    repeat = find_repeat_interval(dataset.drop_vars(list(dataset.data_vars)))
+    subsets = [f'{platform}-{direction}' for platform, direction in
+               zip(dataset['platform'].values, dataset['flight_dir'].values)]
+
+    # time steps in the repeat interval up to the end of each target date
+    keep = np.zeros(len(times), dtype = bool)
+    for end in target_dates.normalize() + pd.Timedelta('1 day'):
+        keep |= (times >= end - repeat) & (times < end)
+    assert keep.any(), f"No images in the {repeat.days} days before target dates {target_dates}"
+
+    percentiles = stream_s1_percentiles(dataset)
+
+    context, state, steps = None, None, []
+    for i in range(np.flatnonzero(keep)[-1] + 1):
+        if subsets[i] not in percentiles:
+            log.warning(f"Skipping {times[i]} from {subsets[i]}")
+            continue
+
+        step = dataset.isel(time = [i]).load()
+        s1_incidence_angle_masking(step, inplace = True)
+        s1_clip_outliers(step, inplace = True, percentiles = percentiles[subsets[i]])
+
+        step, state = _continue_time_steps(context, step, params, repeat, state, ims_masking = ims_masking,
+                                           wet_snow_thresh = wet_snow_thresh, freezing_snow_thresh = freezing_snow_thresh,
+                                           wet_SI_thresh = wet_SI_thresh)
+        if keep[i]:
+            log.debug(f"Keeping {times[i]}")
+            steps.append(step)
+
+        # drop the time steps the next time step doesn't continue from
+        step = step[['s1', 'ims', 'snow_index']]
+        context = step if context is None else xr.concat([context, step], dim = 'time', coords = 'minimal', compat = 'override')
+        if i + 1 < len(times):
+            context = context.isel(time = _get_context_idx(pd.DatetimeIndex(context.time.values),
+                                                           context['relative_orbit'].values, times[i + 1], repeat))
+
+    return xr.concat(steps, dim = 'time', data_vars = 'minimal', coords = 'minimal', compat = 'override')
+
+def _get_context_idx(times: pd.DatetimeIndex, relative_orbits: np.ndarray, start: np.datetime64,
+                     repeat: pd.Timedelta, orbits: np.ndarray = None) -> List[int]:
+    """
+    Indexes of the earlier time steps that time steps from start continue
+    from: the time steps in the previous snow index window of start and the
+    previous image of each relative orbit.
 
-    ## Wet Snow Flags
-    log.info("Flag wet snow")
-    # find newly wet snow
-    ds = id_newly_wet_snow(ds, wet_thresh = wet_snow_thresh)
-    ds = id_wet_negative_si(ds, wet_SI_thresh = wet_SI_thresh)
+    Args:
+    times: times of the earlier time steps
+    relative_orbits: relative orbits of the earlier time steps
+    start: time of the first time step to continue with
+    repeat: repeat interval of the images
+    orbits: relative orbits to keep the previous image of [default: None for all]
 
-    # find newly frozen snow
-    ds = id_newly_frozen_snow(ds, freeze_thresh = freezing_snow_thresh)
+    Returns:
+    context_idx: sorted indexes of the earlier time steps
+    """
+    context_idx = set(np.flatnonzero(times >= start - (2 * repeat - pd.Timedelta('1 day'))))
+    for orbit in np.unique(relative_orbits) if orbits is None else orbits:
+        orbit_idx = np.flatnonzero(relative_orbits == orbit)
+        if len(orbit_idx):
+            context_idx.add(orbit_idx[-1])
+
+    return sorted(context_idx)
+
+def _continue_time_steps(context: Union[xr.Dataset, None],
+                         dataset: xr.Dataset,
+                         params: Tuple[float, float, float],
+                         repeat: pd.Timedelta,
+                         state: Union[xr.Dataset, None] = None,
+                         ims_masking: bool = True,
+                         wet_snow_thresh: float = -2,
+                         freezing_snow_thresh: float = 1,
+                         wet_SI_thresh: float = 0) -> Tuple[xr.Dataset, xr.Dataset]:
+    """
+    Calculate the snow index, snow depth and wet snow of preprocessed time
+    steps continuing from earlier time steps.
 
-    # make wet_snow flag
-    ds = flag_wet_snow(ds)
+    Args:
+    context: earlier time steps (see _get_context_idx) with s1, ims and snow_index
+    [None for no earlier time steps]
+    dataset: preprocessed time steps after the context with s1, ims and fcf
+    params: the A, B, C parameters to use in the model
+    repeat: repeat interval of the images
+    state: wet snow state of the earlier time steps from get_wet_snow_state [default: None]
+    ims_masking: do you want to mask pixels by IMS snow free imagery?
+    wet_snow_thresh: what threshold in dB change to use for melting and re-freezing snow? Default: -2
+    freezing_snow_thresh: what threshold in dB change to use for re-freezing snow id. Default: +2
+    wet_SI_thresh: what threshold to use for negative snow index? Default: 0
 
-    ds.attrs['param_A'] = A
-    ds.attrs['param_B'] = B
-    ds.attrs['param_C'] = C
+    Returns:
+    dataset: time steps with snow_depth and wet_snow
+    state: wet snow state after the time steps
+    """
+    A, B, C = params
+    start = context.sizes['time'] if context is not None else 0
 
-    ds.attrs['job_name'] = job_name
+    new = dataset[['s1', 'ims']].assign(snow_index = xr.full_like(dataset['s1'].sel(band = 'VV', drop = True), np.nan))
+    combined = xr.concat([context, new], dim = 'time', coords = 'minimal', compat = 'override') if start else new
+    combined['fcf'] = dataset['fcf']
 
-    ds.attrs['bounds'] = area.bounds
+    calc_delta_cross_ratio(combined, A = A, inplace = True)
+    calc_delta_VV(combined, inplace = True)
+    calc_delta_gamma(combined, B = B, inplace = True)
+    clip_delta_gamma_outlier(combined, inplace = True)
+    calc_snow_index(combined, ims_masking = ims_masking, inplace = True, start = start, repeat = repeat)
 
-    if outfp:
-        outfp = str(outfp)
-        
-        ds.to_netcdf(outfp)
+    for var in ['deltaCR', 'deltaVV', 'deltaGamma', 'snow_index']:
+        dataset[var] = combined[var].isel(time = slice(start, None))
 
-    return ds
+    calc_snow_index_to_snow_depth(dataset, C = C, inplace = True)
+
+    id_newly_wet_snow(dataset, wet_thresh = wet_snow_thresh, inplace = True)
+    id_wet_negative_si(dataset, wet_SI_thresh = wet_SI_thresh, inplace = True)
+    id_newly_frozen_snow(dataset, freeze_thresh = freezing_snow_thresh, inplace = True)
+
+    flag_wet_snow(dataset, inplace = True, state = state)
+    state = get_wet_snow_state(dataset, state = state)
+
+    return dataset, state
+
+def _save_stage(dataset: xr.Dataset, checkpoint_dir: str, name: str, key: str,
+                chunks: Dict[str, int] = None) -> xr.Dataset:
+    """
+    Save a stage's checkpoint. With chunks the checkpoint is reopened lazily so
+    the next stages read the stage from disk chunk by chunk instead of
+    recomputing it.
+
+    Args:
+    dataset: dataset of the finished stage
+    checkpoint_dir: directory of checkpoints
+    name: stage name
+    key: stage key from get_checkpoint_keys
+    chunks: dask chunks of the out of core mode [default: None]
+
+    Returns:
+    dataset: dataset to run the next stage on
+    """
+    save_checkpoint(dataset, checkpoint_dir, name, key, chunks = chunks)
+
+    if chunks is None:
+        return dataset
+
+    return load_checkpoint(checkpoint_dir, name, key, chunks = chunks)
 
 def retrieval_from_parameters(dataset: xr.Dataset, 
                               A: float, 
@@ -220,32 +798,37 @@ def retrieval_from_parameters(dataset: xr.Dataset,
 
     # dataset = dataset[['s1','deltaVV','ims','fcf','lidar-sd']]
 
-    # load datast to index
-    dataset = dataset.load()
+    # load datast to index (dask backed datasets stay lazy and run chunk by chunk)
+    if not dataset.chunks:
+        dataset = dataset.load()
+
+    # every step only adds or replaces variables so a shallow copy keeps the
+    # input dataset unchanged while the steps below run inplace
+    dataset = dataset.copy()
 
     # calculate delta CR and delta VV
-    dataset = calc_delta_cross_ratio(dataset, A = A)
+    calc_delta_cross_ratio(dataset, A = A, inplace = True)
 
     # calculate delta gamma with delta CR and delta VV with FCF
-    dataset = calc_delta_gamma(dataset, B = B)
+    calc_delta_gamma(dataset, B = B, inplace = True)
 
     # clip outliers of delta gamma
-    dataset = clip_delta_gamma_outlier(dataset)
+    clip_delta_gamma_outlier(dataset, inplace = True)
 
     # calculate snow_index from delta_gamma
-    dataset = calc_snow_index(dataset)
+    calc_snow_index(dataset, inplace = True)
 
     # convert snow index to snow depth
-    dataset = calc_snow_index_to_snow_depth(dataset, C = C)
+    calc_snow_index_to_snow_depth(dataset, C = C, inplace = True)
 
     # find newly wet snow
-    dataset = id_newly_wet_snow(dataset, wet_thresh = wet_snow_thresh)
-    dataset = id_wet_negative_si(dataset, wet_SI_thresh = wet_SI_thresh)
+    id_newly_wet_snow(dataset, wet_thresh = wet_snow_thresh, inplace = True)
+    id_wet_negative_si(dataset, wet_SI_thresh = wet_SI_thresh, inplace = True)
 
     # find newly frozen snow
-    dataset = id_newly_frozen_snow(dataset, freeze_thresh =  freezing_snow_thresh)
+    id_newly_frozen_snow(dataset, freeze_thresh =  freezing_snow_thresh, inplace = True)
 
     # make wet_snow flag
-    dataset = flag_wet_snow(dataset)
+    flag_wet_snow(dataset, inplace = True)
 
     return dataset
@@ -0,0 +1,297 @@
+"""
+Retrieve snow depth over large areas in grid aligned tiles and mosaic the tiles
+into one netcdf.
+"""
+import os
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import xarray as xr
+import rioxarray
+import shapely.geometry
+import netCDF4
+from typing import Dict, List, Tuple, Union
+
+import logging
+log = logging.getLogger(__name__)
+
+# Add main repo to path
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('../'))
+
+from spicy_snow.retrieval import retrieve_snow_depth
+from spicy_snow.download.sentinel1 import s1_img_search, hyp3_pipeline
+from spicy_snow.download.forest_cover import get_fcf_fp
+from spicy_snow.IO.user_area import snap_area, GRID_RESOLUTION
+
+def get_tiles(area: shapely.geometry.Polygon, tile_size: float = 1, resolution: float = GRID_RESOLUTION) -> Dict[str, shapely.geometry.Polygon]:
+    """
+    Split an area into tiles of a tile_size degree grid. The bounds of the area
+    are snapped outward to the global pixel grid (see snap_area) so the pixels
+    of every tile line up and tiles can be mosaicked without warping.
+    Tiles of the grid that don't intersect the area are dropped.
+
+    Args:
+    area: shapely.geometry.Polygon of area in lat/long
+    tile_size: size of the tile grid in degrees. Must be a multiple of resolution [default: 1]
+    resolution: pixel size in degrees [default: 1/1200 (3 arc seconds ~ 90 m)]
+
+    Returns:
+    tiles: dictionary of tile names and tile polygons ordered from the north west
+    """
+    tile_pixels = int(round(tile_size / resolution))
+    assert tile_pixels > 0 and np.isclose(tile_pixels * resolution, tile_size), \
+        f"Tile size {tile_size} must be a multiple of the resolution {resolution}"
+
+    # area bounds in whole pixels of the global grid
+    bounds = np.array(snap_area(area, resolution = resolution).bounds) / resolution
+    col_min, row_min, col_max, row_max = np.round(bounds).astype(int)
+
+    tiles = {}
+    # tile rows from north to south and columns from west to east
+    for tile_row in range((row_max - 1) // tile_pixels, row_min // tile_pixels - 1, -1):
+        for tile_col in range(col_min // tile_pixels, (col_max - 1) // tile_pixels + 1):
+            # tile clipped to the area's pixels
+            x0, x1 = max(tile_col * tile_pixels, col_min), min((tile_col + 1) * tile_pixels, col_max)
+            y0, y1 = max(tile_row * tile_pixels, row_min), min((tile_row + 1) * tile_pixels, row_max)
+            tile = shapely.geometry.box(x0 * resolution, y0 * resolution, x1 * resolution, y1 * resolution)
+
+            if tile.intersection(area).area == 0:
+                continue
+
+            tiles['_'.join(f'{b:.4f}' for b in tile.bounds)] = tile
+
+    return tiles
+
+def _retrieve_tile(tile: shapely.geometry.Polygon, dates: Tuple[str, str], tile_fp: Path,
+                   work_dir: str, job_name: str, kwargs: dict) -> Path:
+    """
+    Retrieve snow depth of one tile from the hyp3 jobs of job_name and save it
+    to tile_fp. Runs in a worker process so only the filepath is sent back.
+
+    The netcdf is written to a temporary file and renamed so only finished
+    tiles exist at tile_fp.
+    """
+    ds = retrieve_snow_depth(tile, dates, work_dir = work_dir, job_name = job_name,
+                             existing_job_name = job_name, **kwargs)
+
+    tmp_fp = tile_fp.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        ds.to_netcdf(tmp_fp)
+        os.replace(tmp_fp, tile_fp)
+    finally:
+        if tmp_fp.exists():
+            os.remove(tmp_fp)
+
+    return tile_fp
+
+def retrieve_snow_depth_tiled(area: shapely.geometry.Polygon,
+                              dates: Tuple[str, str],
+                              work_dir: str = './',
+                              job_name: str = 'spicy-snow-run',
+                              outfp: Union[str, Path] = None,
+                              tile_size: float = 1,
+                              max_workers: int = 2,
+                              resolution: float = GRID_RESOLUTION,
+                              **kwargs) -> xr.Dataset:
+    """
+    Retrieve snow depth over a large area in grid aligned tiles (see get_tiles)
+    run in parallel worker processes and mosaic the tiles into one netcdf.
+
+    Each tile is saved in work_dir/tiles and tiles already saved by an earlier
+    run are skipped. Sentinel-1 images of the whole area are searched and
+    submitted to hyp3 once under job_name in this process (so the quota prompt
+    works) and every tile downloads its granules from those jobs. Rerunning
+    reuses the submitted jobs. All tiles share the machine wide download
+    caches of IMS and forest cover.
+
+    Worker processes can't prompt for a password so hyp3 credentials need to
+    be in your .netrc.
+
+    Args:
+    area: Shapely geometry of the area
+    dates: Start and end date to search between
+    work_dir: filepath to directory to work in. Will be created if not existing
+    job_name: name for hyp3 job of the whole area
+    outfp: filepath of the mosaic netcdf [default: work_dir/{job_name}.nc]
+    tile_size: size of the tile grid in degrees [default: 1]
+    max_workers: number of tiles to run at once. 1 runs tiles in this process [default: 2]
+    resolution: pixel size in degrees [default: 1/1200 (3 arc seconds ~ 90 m)]
+    kwargs: other keywords passed to retrieve_snow_depth for every tile
+
+    Returns:
+    dataset: mosaic of all tiles (opened lazily from outfp)
+    """
+    assert isinstance(area, shapely.geometry.Polygon), f"Must provide shapely geometry for area. Got {type(area)}"
+    assert 'outfp' not in kwargs, "Use outfp of the mosaic. Tiles are saved in work_dir/tiles."
+
+    work_dir = Path(work_dir).expanduser()
+    tile_dir = work_dir.joinpath('tiles')
+    os.makedirs(tile_dir, exist_ok = True)
+    outfp = Path(outfp).expanduser() if outfp else work_dir.joinpath(f'{job_name}.nc')
+
+    tiles = get_tiles(area, tile_size = tile_size, resolution = resolution)
+    tile_fps = {name: tile_dir.joinpath(f'{job_name}_{name}.nc') for name in tiles}
+    log.info(f"Retrieving {len(tiles)} tiles of {area.bounds}")
+
+    todo = [name for name, fp in tile_fps.items() if not fp.exists()]
+    log.info(f"Skipping {len(tiles) - len(todo)} finished tiles")
+
+    if todo:
+        # fetch the global forest cover layer once before the tiles read it from the cache
+        get_fcf_fp()
+
+        # submit the granules of the whole area once (frames cover many tiles)
+        search_results = s1_img_search(area, dates)
+        log.info(f'Found {len(search_results)} results for all tiles')
+        hyp3_pipeline(search_results, job_name = job_name, existing_job_name = job_name, watch = False)
+
+    args = {name: (tiles[name], dates, tile_fps[name], str(work_dir.joinpath('tiles', name)),
+                   job_name, kwargs) for name in todo}
+    failed = {}
+    if max_workers == 1:
+        for name in todo:
+            try:
+                _retrieve_tile(*args[name])
+            except Exception as e:
+                failed[name] = e
+    else:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            futures = {executor.submit(_retrieve_tile, *args[name]): name for name in todo}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+
+    for name, e in failed.items():
+        log.warning(f"Tile {name} failed: {e!r}")
+
+    done = [fp for name, fp in tile_fps.items() if name not in failed]
+    assert len(done) > 0, f"All {len(tiles)} tiles failed"
+
+    return mosaic_tiles(done, outfp, resolution = resolution)
+
+def _pass_keys(ds: xr.Dataset) -> List:
+    """
+    Key of each time step's Sentinel-1 pass. Images of one pass in different
+    tiles can have different time stamps so passes are matched by relative
+    and absolute orbit when available.
+    """
+    if 'relative_orbit' in ds.coords and 'absolute_orbit' in ds.coords:
+        return list(zip(ds['relative_orbit'].values.tolist(), ds['absolute_orbit'].values.tolist()))
+
+    return list(ds.time.values)
+
+def mosaic_tiles(tile_fps: List[Union[str, Path]], outfp: Union[str, Path], resolution: float = GRID_RESOLUTION) -> xr.Dataset:
+    """
+    Mosaic tiles on the same pixel grid into one netcdf chunked by tile.
+
+    Time steps of the same Sentinel-1 pass are combined into one time step at
+    the earliest time stamp of the pass. Per tile statistics (outlier
+    percentiles and wet snow state) aren't kept so the mosaic can't be
+    appended to with append_snow_depth (append to the tiles instead). Where tiles overlap the first tile in
+    tile_fps with a valid value is kept. Tiles are written one at a time so
+    memory is bounded by the tile size.
+
+    Args:
+    tile_fps: filepaths of the tile netcdfs in order of priority
+    outfp: filepath of the mosaic netcdf
+    resolution: pixel size of the tiles in degrees [default: 1/1200]
+
+    Returns:
+    dataset: mosaic (opened lazily from outfp)
+    """
+    outfp = Path(outfp)
+
+    # bounds, passes and variables of all tiles (only coordinates are read)
+    bounds, passes, variables, coords, attrs = [], {}, {}, {}, None
+    for fp in tile_fps:
+        with xr.open_dataset(fp, decode_coords = 'all') as ds:
+            bounds.append(ds.rio.bounds())
+            if attrs is None:
+                # attributes and chunk size from the first tile
+                attrs, tile_shape = dict(ds.attrs), (ds.sizes['y'], ds.sizes['x'])
+            for i, key in enumerate(_pass_keys(ds)):
+                t = ds.time.values[i]
+                if key not in passes:
+                    # coordinates along time of the first tile with this pass
+                    passes[key] = {c: ds[c].values[i] for c in ds.coords if ds[c].dims == ('time',)}
+                passes[key]['time'] = min(passes[key]['time'], t)
+            for name, var in ds.data_vars.items():
+                if var.dims[-2:] == ('y', 'x') and name not in variables:
+                    variables[name] = (var.dims, var.dtype, {k: v for k, v in var.attrs.items() if k not in ['_FillValue', 'grid_mapping']})
+            if 'band' in ds.coords and 'band' not in coords:
+                coords['band'] = ds['band'].values
+
+    # pixel grid covering all tiles
+    xmin, ymin = np.min(bounds, axis = 0)[:2]
+    xmax, ymax = np.max(bounds, axis = 0)[2:]
+    width, height = int(round((xmax - xmin) / resolution)), int(round((ymax - ymin) / resolution))
+    x = xmin + (np.arange(width) + 0.5) * resolution
+    y = ymax - (np.arange(height) + 0.5) * resolution
+
+    # passes in time order
+    keys = sorted(passes, key = lambda key: passes[key]['time'])
+    time_coords = {c: ('time', [passes[key][c] for key in keys]) for c in passes[keys[0]] if c != 'time'}
+    skeleton = xr.Dataset(coords = dict(time = [passes[key]['time'] for key in keys], y = y, x = x, **coords, **time_coords))
+    skeleton = skeleton.rio.write_crs('EPSG:4326').rio.write_transform()
+    # statistics of the first tile (e.g. outlier percentiles) don't hold for the mosaic
+    skeleton.attrs = {k: v for k, v in attrs.items() if k != 'bounds' and not k.startswith('s1_percentiles_')}
+    skeleton.attrs['bounds'] = (xmin, ymin, xmax, ymax)
+    # tiles don't share their wet snow state or percentiles so append_snow_depth can't continue the mosaic
+    skeleton.attrs['mosaic_tiles'] = len(tile_fps)
+
+    tmp_fp = outfp.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        skeleton.to_netcdf(tmp_fp)
+
+        with netCDF4.Dataset(tmp_fp, 'a') as nc:
+            # one chunk per time step and tile
+            chunks = {'time': 1, 'y': min(tile_shape[0], height), 'x': min(tile_shape[1], width)}
+            if 'band' in coords:
+                chunks['band'] = len(coords['band'])
+
+            fills = {}
+            for name, (dims, dtype, var_attrs) in variables.items():
+                fill = np.nan if np.issubdtype(dtype, np.floating) else netCDF4.default_fillvals[dtype.str[1:]]
+                var = nc.createVariable(name, dtype, dims, zlib = True, complevel = 1,
+                                        chunksizes = [chunks[d] for d in dims], fill_value = fill)
+                var.setncatts(var_attrs)
+                var.grid_mapping = 'spatial_ref'
+                fills[name] = fill
+
+            # compare with fill values rather than masked arrays
+            nc.set_auto_mask(False)
+
+            # write tiles in order filling only pixels without a value
+            for fp in tile_fps:
+                with xr.open_dataset(fp, decode_coords = 'all') as ds:
+                    row = int(round((ymax - ds.rio.bounds()[3]) / resolution))
+                    col = int(round((ds.rio.bounds()[0] - xmin) / resolution))
+                    rows, cols = slice(row, row + ds.sizes['y']), slice(col, col + ds.sizes['x'])
+                    time_idx = [keys.index(key) for key in _pass_keys(ds)]
+
+                    for name in variables:
+                        if name not in ds.data_vars:
+                            continue
+                        data = ds[name].values
+                        if 'time' not in ds[name].dims:
+                            data, idxs = data[None], [None]
+                        else:
+                            idxs = time_idx
+                        for data_t, t in zip(data, idxs):
+                            region = (..., rows, cols) if t is None else (t, ..., rows, cols)
+                            existing = nc[name][region]
+                            valid = existing == existing if np.isnan(fills[name]) else existing != fills[name]
+                            nc[name][region] = np.where(valid, existing, data_t)
+
+        os.replace(tmp_fp, outfp)
+    finally:
+        if tmp_fp.exists():
+            os.remove(tmp_fp)
+
+    log.info(f"Saved mosaic of {len(tile_fps)} tiles to {outfp}")
+
+    return xr.open_dataset(outfp, decode_coords = 'all')
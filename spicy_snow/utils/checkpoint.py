@@ -0,0 +1,167 @@
+"""
+Functions to save and resume intermediate datasets of a retrieval.
+
+Each stage's dataset is saved as a chunked netcdf in a checkpoint directory
+keyed by a hash of the stage's parameters and the key of the stage before it,
+so changing any earlier input invalidates every later checkpoint.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+import xarray as xr
+
+from typing import Dict, List, Tuple, Union
+
+import logging
+log = logging.getLogger(__name__)
+
+# encoding keys kept from variables when saving with chunking
+ENCODING_KEYS = ['dtype', 'scale_factor', 'add_offset', '_FillValue', 'units', 'calendar', 'grid_mapping']
+
+def get_checkpoint_keys(stages: List[Tuple[str, dict]]) -> Dict[str, str]:
+    """
+    Get the key of each stage from its parameters chained with the key of the
+    stage before it.
+
+    Args:
+    stages: list of (stage name, parameters) in the order they are run.
+    Parameters must be json serializable (other values are saved as strings).
+
+    Returns:
+    keys: dictionary of stage names and hex keys in stage order
+    """
+    keys = {}
+    parent = ''
+    for name, params in stages:
+        key = hashlib.sha1()
+        key.update(parent.encode())
+        key.update(json.dumps([name, params], sort_keys = True, default = str).encode())
+        keys[name] = parent = key.hexdigest()
+
+    return keys
+
+def get_checkpoint_fp(checkpoint_dir: Union[str, Path], name: str, key: str) -> Path:
+    """
+    Get the filepath of a stage's checkpoint.
+
+    Args:
+    checkpoint_dir: directory of checkpoints
+    name: stage name
+    key: stage key from get_checkpoint_keys
+
+    Returns:
+    fp: filepath of the checkpoint netcdf
+    """
+    return Path(checkpoint_dir).joinpath(f'{name}-{key[:16]}.nc')
+
+def save_checkpoint(dataset: xr.Dataset, checkpoint_dir: Union[str, Path], name: str, key: str,
+                    chunks: Dict[str, int] = None) -> Path:
+    """
+    Save a stage's dataset as a chunked netcdf. Dask backed datasets are
+    computed and written chunk by chunk.
+
+    The file is written to a temporary file and renamed so an interrupted save
+    never leaves a checkpoint behind.
+
+    Args:
+    dataset: dataset to save
+    checkpoint_dir: directory of checkpoints
+    name: stage name
+    key: stage key from get_checkpoint_keys
+    chunks: dictionary of netcdf chunk sizes of each dimension (-1 for the
+    full dimension) [default: None for one chunk per time step]
+
+    Returns:
+    fp: filepath of the checkpoint netcdf
+    """
+    os.makedirs(checkpoint_dir, exist_ok = True)
+    fp = get_checkpoint_fp(checkpoint_dir, name, key)
+
+    # one chunk per time step of each variable unless given chunks
+    if chunks is None:
+        chunks = {'time': 1}
+
+    encoding = {}
+    for var_name, var in dataset.data_vars.items():
+        encoding[var_name] = {k: v for k, v in var.encoding.items() if k in ENCODING_KEYS}
+        if var.ndim > 1 and any(d in chunks for d in var.dims):
+            sizes = [chunks.get(d, -1) for d in var.dims]
+            encoding[var_name]['chunksizes'] = tuple(var.sizes[d] if size == -1 else min(size, var.sizes[d])
+                                                     for d, size in zip(var.dims, sizes))
+            encoding[var_name]['zlib'] = True
+            encoding[var_name]['complevel'] = 1
+
+    dataset = dataset.assign_attrs(checkpoint_stage = name, checkpoint_key = key)
+
+    tmp_fp = fp.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        dataset.to_netcdf(tmp_fp, encoding = encoding, format = 'NETCDF4')
+        os.replace(tmp_fp, fp)
+    finally:
+        if tmp_fp.exists():
+            os.remove(tmp_fp)
+
+    log.debug(f"Saved {name} checkpoint to {fp}")
+
+    return fp
+
+def load_checkpoint(checkpoint_dir: Union[str, Path], name: str, key: str,
+                    chunks: Dict[str, int] = None) -> Union[xr.Dataset, None]:
+    """
+    Load a stage's checkpoint if it exists and is valid. Unreadable checkpoints
+    or checkpoints of another key are removed.
+
+    Args:
+    checkpoint_dir: directory of checkpoints
+    name: stage name
+    key: stage key from get_checkpoint_keys
+    chunks: open the checkpoint lazily as a dask backed dataset with these
+    chunks instead of loading it into memory [default: None]
+
+    Returns:
+    dataset: checkpoint dataset or None if there is no valid checkpoint
+    """
+    fp = get_checkpoint_fp(checkpoint_dir, name, key)
+    if not fp.exists():
+        return None
+
+    try:
+        if chunks is None:
+            dataset = xr.load_dataset(fp, decode_coords = 'all')
+        else:
+            dataset = xr.open_dataset(fp, decode_coords = 'all', chunks = chunks)
+        assert dataset.attrs.get('checkpoint_key') == key, f"Checkpoint key {dataset.attrs.get('checkpoint_key')} is not {key}"
+    except (OSError, ValueError, AssertionError) as e:
+        log.warning(f"Removing invalid checkpoint {fp}: {e}")
+        os.remove(fp)
+        return None
+
+    for attr in ['checkpoint_stage', 'checkpoint_key']:
+        dataset.attrs.pop(attr, None)
+
+    return dataset
+
+def find_checkpoint(checkpoint_dir: Union[str, Path], keys: Dict[str, str],
+                    chunks: Dict[str, int] = None) -> Tuple[Union[str, None], Union[xr.Dataset, None]]:
+    """
+    Find the last stage with a valid checkpoint to resume from.
+
+    Args:
+    checkpoint_dir: directory of checkpoints
+    keys: dictionary of stage names and keys in stage order from get_checkpoint_keys
+    chunks: open the checkpoint lazily with these dask chunks [default: None]
+
+    Returns:
+    stage: name of the last stage with a checkpoint (None if no stage has one)
+    dataset: checkpoint dataset of that stage (None if no stage has one)
+    """
+    for name in reversed(list(keys)):
+        dataset = load_checkpoint(checkpoint_dir, name, keys[name], chunks = chunks)
+        if dataset is not None:
+            log.info(f"Resuming from {name} checkpoint")
+            return name, dataset
+
+    return None, None
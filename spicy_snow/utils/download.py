@@ -1,15 +1,55 @@
 """
 Utility functions for downloading files
 """
+import os
 import sys
 import time
 from os.path import basename, exists
+from pathlib import Path
 import gzip
+import hashlib
+import json
+import shutil
+import stat
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.request import urlretrieve
+import numpy as np
+import requests
+from tqdm import tqdm
+
+from typing import Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on windows so the cache is only safe within one process
+    fcntl = None
 
 import logging
 log = logging.getLogger(__name__)
 
+def get_cache_dir(subdir: str = None) -> Path:
+    """
+    Get the directory for files reused between runs. Set by the SPICY_SNOW_CACHE
+    environment variable [default: ~/.cache/spicy-snow].
+
+    Args:
+    subdir: optional sub directory of the cache directory
+
+    Returns:
+    cache_dir: path of the (created) cache directory
+    """
+    cache_dir = Path(os.environ.get('SPICY_SNOW_CACHE', '~/.cache/spicy-snow')).expanduser()
+
+    if subdir:
+        cache_dir = cache_dir.joinpath(subdir)
+
+    cache_dir.mkdir(parents = True, exist_ok = True)
+
+    return cache_dir
+
 def reporthook(count, block_size, total_size):
     """
     Hook for urlib downloads to get progress readout.
@@ -26,34 +66,464 @@ def reporthook(count, block_size, total_size):
                     (percent, progress_size / (1024 * 1024), speed, duration))
     sys.stdout.flush()
 
-def url_download(url, out_fp, overwrite = False, verbose = True):
+# one pooled keep-alive session shared by all downloads
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
     """
-    Downloads url with a progress bar and overwrite check.
+    Get the requests session shared by all downloads so connections are
+    kept alive and reused between files and threads.
+
+    Returns:
+    session: shared requests.Session
     """
-    # check if file already exists
-    if not exists(out_fp) or overwrite == True:
-        # progress bar for your download?
-        if verbose:
-            log.info(f'Downloading {basename(out_fp)}.')
-            urlretrieve(url, out_fp, reporthook)
-            log.info('')
-        # or not?
-        else:
-            urlretrieve(url, out_fp)
-    # if already exists. skip download.
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections = 16, pool_maxsize = 32)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def _retry(func, retries: int, backoff: float, desc: str):
+    """
+    Call func until it succeeds, waiting backoff * 2^attempt seconds between
+    failed attempts of connection errors and server (5xx) errors.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                requests.HTTPError) as e:
+            server_error = not isinstance(e, requests.HTTPError) or e.response.status_code >= 500
+            if attempt == retries or not server_error:
+                raise
+            wait = backoff * 2 ** attempt
+            log.debug(f"{desc} failed ({e}). Retrying in {wait} seconds.")
+            time.sleep(wait)
+
+def _download_stream(session: requests.Session, url: str, part_fp: str, chunk_size: int,
+                     progress: tqdm = None, timeout: float = 60) -> requests.structures.CaseInsensitiveDict:
+    """
+    Download url to part_fp, continuing from the end of part_fp with a Range
+    request if it already has data. Starts again if the server ignores the range.
+    """
+    start = os.path.getsize(part_fp) if exists(part_fp) else 0
+    headers = {'Range': f'bytes={start}-'} if start else {}
+
+    with session.get(url, headers = headers, stream = True, timeout = timeout) as response:
+        if response.status_code == 416 and start:
+            # part_fp already has every byte
+            return response.headers
+        response.raise_for_status()
+
+        resumed = response.status_code == 206
+        if start and not resumed:
+            log.debug(f"Server ignored range request for {url}. Starting again.")
+            if progress is not None:
+                progress.update(-start)
+        with open(part_fp, 'ab' if resumed else 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+
+        return response.headers
+
+def _download_segment(session: requests.Session, url: str, part_fp: str, segment: Tuple[int, int],
+                      chunk_size: int, progress: tqdm = None, timeout: float = 60) -> None:
+    """
+    Download the inclusive byte range segment of url into its place in part_fp.
+    """
+    first, last = segment
+    headers = {'Range': f'bytes={first}-{last}'}
+
+    with session.get(url, headers = headers, stream = True, timeout = timeout) as response:
+        response.raise_for_status()
+        assert response.status_code == 206, f"Server did not return a range of {url}"
+
+        written = 0
+        with open(part_fp, 'r+b') as f:
+            f.seek(first)
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                written += len(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+
+    if written != last - first + 1:
+        if progress is not None:
+            progress.update(-written)
+        raise requests.exceptions.ChunkedEncodingError(f"Incomplete range {first}-{last} of {url}")
+
+def _download_segments(session: requests.Session, url: str, part_fp: str, size: int, segments: int,
+                       chunk_size: int, retries: int, backoff: float, progress: tqdm = None) -> None:
+    """
+    Download url to part_fp in parallel byte range segments. Finished segments
+    are recorded next to part_fp so an interrupted download only downloads the
+    unfinished segments again.
+    """
+    bounds = np.linspace(0, size, segments + 1).astype(int)
+    ranges = [(int(first), int(last) - 1) for first, last in zip(bounds[:-1], bounds[1:])]
+
+    done_fp = f'{part_fp}.segments'
+    done = set()
+    if exists(part_fp) and exists(done_fp) and os.path.getsize(part_fp) == size:
+        with open(done_fp) as f:
+            done = set(tuple(r) for r in json.load(f) if tuple(r) in ranges)
     else:
+        with open(part_fp, 'wb') as f:
+            f.truncate(size)
+    if progress is not None:
+        progress.update(sum(last - first + 1 for first, last in done))
+
+    lock = threading.Lock()
+    def download(segment):
+        _retry(lambda: _download_segment(session, url, part_fp, segment, chunk_size, progress),
+               retries, backoff, f"Downloading {segment} of {url}")
+        with lock:
+            done.add(segment)
+            with open(done_fp, 'w') as f:
+                json.dump(sorted(done), f)
+
+    with ThreadPoolExecutor(max_workers = segments) as executor:
+        futures = [executor.submit(download, segment) for segment in ranges if segment not in done]
+        for future in as_completed(futures):
+            future.result()
+
+    os.remove(done_fp)
+
+def url_download(url, out_fp, overwrite = False, verbose = True, segments: int = 4,
+                 min_segment_size: int = 2**26, chunk_size: int = 2**16, retries: int = 5,
+                 backoff: float = 1, session: requests.Session = None):
+    """
+    Downloads url with a progress bar and overwrite check.
+
+    http(s) downloads use a shared keep-alive session and are written to
+    out_fp.part which is renamed to out_fp when complete so an interrupted
+    download is never mistaken for a finished one. An existing .part file is
+    resumed with a Range request. Files larger than segments * min_segment_size
+    are downloaded in parallel byte ranges if the server accepts them. Failed
+    connections and server errors are retried with exponential backoff.
+
+    Other urls (file://, ftp://) are downloaded with urlretrieve.
+
+    Args:
+    url: url to download
+    out_fp: filepath to save to
+    overwrite: download even if out_fp exists [default: False]
+    verbose: show a progress bar
+    segments: maximum number of parallel byte ranges [default: 4]
+    min_segment_size: minimum size in bytes of each byte range [default: 64 MB]
+    chunk_size: bytes to read at once [default: 64 kB]
+    retries: number of times to retry failed requests [default: 5]
+    backoff: seconds to wait before the first retry, doubling each retry [default: 1]
+    session: requests session to use [default: shared session from get_session]
+
+    Returns:
+    headers: response headers or None if out_fp already existed
+    """
+    # check if file already exists. skip download.
+    if exists(out_fp) and not overwrite:
         if verbose:
             log.info(f'{basename(out_fp)} already exists. Skipping.')
+        return None
+
+    if not str(url).startswith(('http://', 'https://')):
+        tmp_fp = f'{out_fp}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            if verbose:
+                log.info(f'Downloading {basename(out_fp)}.')
+            _, headers = urlretrieve(url, tmp_fp, reporthook if verbose else None)
+            os.replace(tmp_fp, out_fp)
+        finally:
+            if exists(tmp_fp):
+                os.remove(tmp_fp)
+        return headers
+
+    session = session or get_session()
+    part_fp = f'{out_fp}.part'
+
+    # size and range support to choose between one stream and segments
+    head = _retry(lambda: session.head(url, allow_redirects = True, timeout = 60), retries, backoff, f"HEAD of {url}")
+    size = int(head.headers.get('Content-Length', 0)) if head.ok else 0
+    ranges = head.ok and head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    n_segments = int(np.clip(size // max(min_segment_size, 1), 1, segments)) if ranges else 1
+
+    with tqdm(total = size or None, unit = 'B', unit_scale = True, desc = basename(out_fp),
+              disable = not verbose) as progress:
+        if n_segments > 1:
+            log.debug(f"Downloading {url} in {n_segments} segments")
+            _download_segments(session, url, part_fp, size, n_segments, chunk_size, retries, backoff, progress)
+            headers = head.headers
+        else:
+            if exists(part_fp):
+                progress.update(os.path.getsize(part_fp))
+
+            def download():
+                headers = _download_stream(session, url, part_fp, chunk_size, progress)
+                # resume from the end if the connection closed early
+                if size and os.path.getsize(part_fp) < size:
+                    raise requests.exceptions.ChunkedEncodingError(f"Connection to {url} closed early")
+                return headers
+            headers = _retry(download, retries, backoff, f"Downloading {url}")
+
+    if size:
+        assert os.path.getsize(part_fp) == size, f"Downloaded {os.path.getsize(part_fp)} of {size} bytes of {url}"
+    os.replace(part_fp, out_fp)
+
+    return headers
 
 def decompress(infile, tofile):
     """
-    Decompress gzipped infile to outfile location.
+    Decompress gzipped infile (filepath or binary file object) to outfile location.
+
+    Decompression is streamed in chunks so memory use is bounded and tofile is
+    only created once fully written.
     """
 
     log.debug(f"decompressing {infile} to {tofile}")
 
-    with open(infile, 'rb') as inf, open(tofile, 'wb') as ouf:
-        decom_str = gzip.decompress(inf.read())
-        ouf.write(decom_str)
+    tmp_fp = f'{tofile}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with gzip.open(infile, 'rb') as inf, open(tmp_fp, 'wb') as ouf:
+            shutil.copyfileobj(inf, ouf, length = 2**20)
+        os.replace(tmp_fp, tofile)
+    finally:
+        if exists(tmp_fp):
+            os.remove(tmp_fp)
+
+    return tofile
+
+# hits and misses of cached_download in this process
+_cache_stats = {'hits': 0, 'misses': 0, 'bytes_downloaded': 0, 'bytes_reused': 0, 'evictions': 0}
+_cache_lock = threading.Lock()
+_url_locks = {}
+
+def get_cache_stats() -> dict:
+    """
+    Get the hit and miss statistics of cached_download in this process.
+
+    Returns:
+    stats: dictionary of hits, misses, bytes_downloaded, bytes_reused and evictions
+    """
+    with _cache_lock:
+        return dict(_cache_stats)
+
+def reset_cache_stats() -> None:
+    """
+    Reset the statistics of cached_download to 0.
+    """
+    with _cache_lock:
+        for key in _cache_stats:
+            _cache_stats[key] = 0
+
+@contextmanager
+def _cache_file_lock(lock_fp: Path, thread_lock: threading.Lock):
+    """
+    Hold thread_lock and an exclusive lock on lock_fp so only one thread of
+    every process using the cache runs the block at a time.
+    """
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(lock_fp, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _read_cache_index(index_fp: Path) -> dict:
+    """
+    Read the {url: entry} index of the download cache.
+    """
+    if not index_fp.exists():
+        return {}
+    with open(index_fp) as f:
+        return json.load(f)
+
+def _write_cache_index(index_fp: Path, index: dict) -> None:
+    """
+    Atomically write the index of the download cache.
+    """
+    tmp_fp = index_fp.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_fp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_fp, index_fp)
+
+def _file_sha256(fp: str) -> str:
+    """
+    sha256 hex digest of a file read in chunks.
+    """
+    sha = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _get_etag(url: str) -> str:
+    """
+    ETag of url from a HEAD request or None if the server does not give one.
+    """
+    try:
+        return get_session().head(url, allow_redirects = True, timeout = 60).headers.get('ETag')
+    except Exception as e:
+        log.debug(f"Unable to get ETag of {url}: {e}")
+        return None
+
+def _evict(index: dict, blob_dir: Path, max_size: float, keep: str) -> None:
+    """
+    Remove least recently used files from the cache until it is smaller than
+    max_size. The file with sha256 keep is never removed.
+    """
+    # several urls can share one file so size the unique files
+    blobs = {}
+    for entry in index.values():
+        last = blobs.get(entry['sha256'], {'last_access': 0})['last_access']
+        blobs[entry['sha256']] = {'size': entry['size'], 'blob': entry['blob'],
+                                  'last_access': max(last, entry['last_access'])}
+
+    total = sum(b['size'] for b in blobs.values())
+    for sha, blob in sorted(blobs.items(), key = lambda b: b[1]['last_access']):
+        if total <= max_size:
+            break
+        if sha == keep:
+            continue
+        log.debug(f"Evicting {blob['blob']} from the download cache")
+        blob_fp = blob_dir.joinpath(blob['blob'])
+        if blob_fp.exists():
+            os.remove(blob_fp)
+        for url in [url for url, entry in index.items() if entry['sha256'] == sha]:
+            del index[url]
+        total -= blob['size']
+        _cache_stats['evictions'] += 1
+
+def cached_download(url: str, out_fp: str = None, verbose: bool = True, revalidate: bool = False,
+                    verify: bool = False, max_size: float = None) -> Path:
+    """
+    Download url through the machine wide download cache.
+
+    Files are stored once by the sha256 of their content in the downloads
+    directory of the spicy-snow cache directory and indexed by url and ETag so
+    every work directory reuses them. Cached files are read-only and the least
+    recently used files are removed when the cache is larger than max_size.
+    The index is updated under a file lock shared by every process using the
+    cache and only one process downloads a url at a time.
+
+    Args:
+    url: url to download
+    out_fp: optional filepath to link (or copy) the cached file to
+    verbose: show download progress
+    revalidate: check the ETag of the url and download again if it changed [default: False]
+    verify: check the sha256 of a cached file before using it [default: False]
+    max_size: size limit of the cache in bytes. Set by the SPICY_SNOW_CACHE_SIZE
+    environment variable [default: no limit]
+
+    Returns:
+    fp: out_fp if given or else the filepath of the cached file
+    """
+    if max_size is None:
+        max_size = float(os.environ.get('SPICY_SNOW_CACHE_SIZE', 'inf'))
+
+    cache_dir = get_cache_dir('downloads')
+    blob_dir = get_cache_dir('downloads/blobs')
+    index_fp = cache_dir.joinpath('index.json')
+
+    index_lock = cache_dir.joinpath('index.lock')
+    url_hash = hashlib.sha1(url.encode()).hexdigest()
+    with _cache_lock:
+        url_lock = _url_locks.setdefault(url, threading.Lock())
+
+    def check_cache(verify_hit):
+        """
+        Cached entry of url and if it is complete and (optionally) unchanged
+        """
+        with _cache_file_lock(index_lock, _cache_lock):
+            index = _read_cache_index(index_fp)
+            entry = index.get(url)
+            hit = entry is not None and blob_dir.joinpath(entry['blob']).exists() and \
+                blob_dir.joinpath(entry['blob']).stat().st_size == entry['size']
+            if hit:
+                # most recently used so other processes evict it last
+                entry['last_access'] = time.time()
+                _write_cache_index(index_fp, index)
+        if hit and verify_hit and verify:
+            hit = _file_sha256(blob_dir.joinpath(entry['blob'])) == entry['sha256']
+        if hit and verify_hit and revalidate:
+            etag = _get_etag(url)
+            hit = etag is None or etag == entry['etag']
+        return entry, hit
+
+    def record(entry, hit):
+        """
+        Count and index entry. False if a cached file was evicted since it was checked
+        """
+        with _cache_file_lock(index_lock, _cache_lock):
+            if hit and not blob_dir.joinpath(entry['blob']).exists():
+                return False
+
+            _cache_stats['hits' if hit else 'misses'] += 1
+            _cache_stats['bytes_reused' if hit else 'bytes_downloaded'] += entry['size']
+
+            # other processes may have added files so update the index on disk
+            index = _read_cache_index(index_fp)
+            entry['last_access'] = time.time()
+            index[url] = entry
+            _evict(index, blob_dir, max_size, keep = entry['sha256'])
+            _write_cache_index(index_fp, index)
+        return True
+
+    while True:
+        entry, hit = check_cache(verify_hit = True)
+        if hit and record(entry, hit):
+            break
+        elif hit:
+            continue
+
+        # one downloader of url at a time so the temp file (named by url so an
+        # interrupted download is resumed) isn't written by two processes
+        with _cache_file_lock(cache_dir.joinpath(f'{url_hash}.lock'), url_lock):
+            # another process may have downloaded it while waiting
+            if not (revalidate or verify):
+                entry, hit = check_cache(verify_hit = False)
+
+            if not hit:
+                if verbose:
+                    log.info(f'{basename(url)} not in download cache.')
+                tmp_fp = cache_dir.joinpath(f"{url_hash}.download")
+                headers = url_download(url, tmp_fp, overwrite = True, verbose = verbose)
+                try:
+                    sha = _file_sha256(tmp_fp)
+                    entry = {'sha256': sha, 'size': os.path.getsize(tmp_fp),
+                             'etag': headers.get('ETag') if headers else None,
+                             'blob': sha + ''.join(Path(basename(url).split('?')[0]).suffixes)}
+                    os.chmod(tmp_fp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    os.replace(tmp_fp, blob_dir.joinpath(entry['blob']))
+                finally:
+                    if exists(tmp_fp):
+                        os.remove(tmp_fp)
+
+            # indexed before other downloaders of url check the cache
+            if record(entry, hit):
+                break
+
+    if verbose and hit:
+        log.info(f'{basename(url)} found in download cache.')
+
+    fp = blob_dir.joinpath(entry['blob'])
+    if out_fp is None:
+        return fp
+
+    # link so the work directory does not need a second copy
+    if exists(out_fp):
+        os.remove(out_fp)
+    try:
+        os.link(fp, out_fp)
+    except OSError:
+        shutil.copyfile(fp, out_fp)
 
-        return tofile
\ No newline at end of file
+    return Path(out_fp)
@@ -12,7 +12,9 @@ import netrc
 import os.path
 import ssl
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from getpass import getpass
 
 try:
@@ -169,8 +171,9 @@ def cmr_read_in_chunks(file_object, chunk_size=1024 * 1024):
         yield data
 
 
-def get_login_response(url, credentials, token):
-    opener = build_opener(HTTPCookieProcessor())
+def get_login_response(url, credentials, token, opener=None):
+    if opener is None:
+        opener = build_opener(HTTPCookieProcessor())
 
     req = Request(url)
     if token:
@@ -208,58 +211,135 @@ def get_login_response(url, credentials, token):
     return response
 
 
-def cmr_download(urls, force=False, quiet=False):
-    """Download files from list of urls."""
+# opener with the Earthdata login cookies shared by every download
+_cmr_opener = None
+_cmr_login = None
+_cmr_lock = threading.Lock()
+
+
+def get_cmr_opener():
+    """Get the cookie-aware opener shared by all CMR downloads."""
+    global _cmr_opener
+    with _cmr_lock:
+        if _cmr_opener is None:
+            _cmr_opener = build_opener(HTTPCookieProcessor())
+        return _cmr_opener
+
+
+def _cmr_request(url, token):
+    req = Request(url)
+    if token:
+        req.add_header('Authorization', 'Bearer {0}'.format(token))
+    return req
+
+
+def _cmr_save(response, out_fp):
+    """Stream a response to out_fp.part and rename it. Returns bytes written."""
+    size = 0
+    part_fp = out_fp + '.part'
+    with open(part_fp, 'wb') as out_file:
+        for data in cmr_read_in_chunks(response):
+            out_file.write(data)
+            size += len(data)
+    os.replace(part_fp, out_fp)
+    return size
+
+
+def cmr_download(urls, force=False, quiet=False, out_dir='.', max_workers=4,
+                 credentials=None, token=None):
+    """
+    Download files from list of urls to out_dir with max_workers at once.
+
+    The Earthdata login runs once per process and its cookies are shared by
+    every download. Files already in out_dir are skipped unless force. Files
+    are written to a .part file and renamed so only complete files are
+    skipped.
+
+    Returns a dictionary of the number of downloaded, skipped and failed
+    files, bytes downloaded, seconds and throughput in bytes per second.
+    """
+    global _cmr_login
+
+    stats = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'seconds': 0, 'throughput': 0}
     if not urls:
-        return
+        return stats
 
+    os.makedirs(out_dir, exist_ok=True)
     url_count = len(urls)
     if not quiet:
         print('Downloading {0} files...'.format(url_count))
-    credentials = None
-    token = None
 
-    for index, url in enumerate(urls, start=1):
-        if not credentials and not token:
-            p = urlparse(url)
-            if p.scheme == 'https':
-                credentials, token = get_login_credentials()
+    todo = []
+    for url in urls:
+        out_fp = os.path.join(out_dir, url.split('/')[-1])
+        if not force and os.path.exists(out_fp):
+            stats['skipped'] += 1
+            if not quiet:
+                print('{0}: File exists, skipping'.format(url.split('/')[-1]))
+        else:
+            todo.append((url, out_fp))
+
+    if not todo:
+        return stats
 
-        filename = url.split('/')[-1]
-        if not quiet:
-            print('{0}/{1}: {2}'.format(str(index).zfill(len(str(url_count))),
-                                        url_count, filename))
+    if not credentials and not token and _cmr_login:
+        credentials, token = _cmr_login
+    if not credentials and not token and urlparse(todo[0][0]).scheme == 'https':
+        credentials, token = get_login_credentials()
 
+    opener = get_cmr_opener()
+    lock = threading.Lock()
+    time_initial = time.time()
+
+    def download(url, out_fp, login=False):
         try:
-            response = get_login_response(url, credentials, token)
-            length = int(response.headers['content-length'])
-            try:
-                if not force and length == os.path.getsize(filename):
-                    if not quiet:
-                        print('  File exists, skipping')
-                    continue
-            except OSError:
-                pass
-            count = 0
-            chunk_size = min(max(length, 1), 1024 * 1024)
-            max_chunks = int(math.ceil(length / chunk_size))
-            time_initial = time.time()
-            with open(filename, 'wb') as out_file:
-                for data in cmr_read_in_chunks(response, chunk_size=chunk_size):
-                    out_file.write(data)
-                    if not quiet:
-                        count = count + 1
-                        time_elapsed = time.time() - time_initial
-                        download_speed = get_speed(time_elapsed, count * chunk_size)
-                        output_progress(count, max_chunks, status=download_speed)
-            if not quiet:
-                print()
+            if login:
+                # log in and keep the cookies in the shared opener
+                response = get_login_response(url, credentials, token, opener=opener)
+            else:
+                response = opener.open(_cmr_request(url, token))
+            size = _cmr_save(response, out_fp)
         except HTTPError as e:
-            print('HTTP error {0}, {1}'.format(e.code, e.reason))
+            print('HTTP error {0}, {1}: {2}'.format(e.code, e.reason, url))
+            with lock:
+                stats['failed'] += 1
+            return
         except URLError as e:
-            print('URL error: {0}'.format(e.reason))
-        except IOError:
-            raise
+            print('URL error: {0}: {1}'.format(e.reason, url))
+            with lock:
+                stats['failed'] += 1
+            return
+
+        with lock:
+            stats['downloaded'] += 1
+            stats['bytes'] += size
+            if not quiet:
+                done = stats['downloaded'] + stats['failed']
+                print('{0}/{1}: {2}  {3}'.format(str(done).zfill(len(str(len(todo)))), len(todo),
+                                                 os.path.basename(out_fp),
+                                                 get_speed(time.time() - time_initial, stats['bytes'])))
+
+    # the first download logs in (once per process) so the rest reuse its cookies
+    login = (credentials or token) and _cmr_login != (credentials, token)
+    start = 0
+    if login:
+        download(*todo[0], login=True)
+        _cmr_login = (credentials, token)
+        start = 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download, url, out_fp) for url, out_fp in todo[start:]]
+        for future in as_completed(futures):
+            future.result()
+
+    stats['seconds'] = time.time() - time_initial
+    stats['throughput'] = stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else 0
+    if not quiet:
+        print('Downloaded {0} files ({1:.1f} MB) in {2:.1f} s at {3}. {4} skipped, {5} failed.'.format(
+            stats['downloaded'], stats['bytes'] / 1e6, stats['seconds'],
+            get_speed(stats['seconds'], stats['bytes']) or '-', stats['skipped'], stats['failed']))
+
+    return stats
 
 
 def cmr_filter_urls(search_results):
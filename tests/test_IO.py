@@ -1,16 +1,18 @@
 import unittest
 
 import numpy as np
+from numpy.testing import assert_allclose
 import pandas as pd
 from datetime import datetime
 import shapely.geometry
 import xarray as xr
+import rioxarray as rxa
 
 import sys
 from os.path import expanduser
 sys.path.append(expanduser('.'))
 from spicy_snow.IO.user_dates import get_input_dates
-from spicy_snow.IO.user_area import get_input_area
+from spicy_snow.IO.user_area import get_input_area, get_area_grid, snap_area, clip_to_bounds, GRID_ORIGIN
 
 class TestIoHelperFunctions(unittest.TestCase):
     """
@@ -68,6 +70,57 @@ class TestIoHelperFunctions(unittest.TestCase):
 
         self.assertEqual(get_input_area(img = ds), area)
     
+    def test_area_grid(self):
+
+        area = shapely.geometry.box(-116.2, 43.5, -116.1, 43.55)
+        shape, transform = get_area_grid(area)
+
+        # 3 arc second pixels from the upper left corner of the area
+        self.assertEqual(shape, (60, 120))
+        self.assertEqual((transform.a, transform.e), (1 / 1200, -1 / 1200))
+        assert_allclose((transform.c, transform.f), (-116.2, 43.55))
+
+        # partial pixels are included so the grid covers the area
+        shape, transform = get_area_grid(area, resolution = 0.003)
+        self.assertEqual(shape, (17, 34))
+        assert_allclose((transform.c, transform.f), (-116.202, 43.551))
+
+    def test_clip_to_bounds(self):
+
+        # 30 m UTM image with pixel centres from 500015 to 502985 and 4800015 to 4802985
+        img = xr.DataArray(np.ones((100, 100)), dims = ['y', 'x'],
+                           coords = {'y': 4803000 - 15 - 30 * np.arange(100), 'x': 500015 + 30 * np.arange(100)})
+        img = img.rio.write_crs('EPSG:32611')
+
+        # clipped in the image's CRS with a 2 pixel margin
+        clipped = clip_to_bounds(img, (501000, 4801000, 502000, 4802000), crs = 'EPSG:32611')
+        self.assertEqual(clipped.x.min(), 500945)
+        self.assertEqual(clipped.x.max(), 502055)
+        self.assertEqual(clipped.y.min(), 4800945)
+        self.assertEqual(clipped.y.max(), 4802055)
+
+        # lat/long bounds are transformed to the image's CRS
+        clipped = clip_to_bounds(img, (-117.0, 43.35, -116.99, 43.36))
+        self.assertLess(clipped.size, img.size)
+
+        # images outside the bounds are returned unclipped
+        clipped = clip_to_bounds(img, (-116.2, 43.5, -116.1, 43.55))
+        self.assertEqual(clipped.shape, img.shape)
+
+    def test_snap_area(self):
+
+        # bounds snapped outward to the global grid's pixel edges
+        area = shapely.geometry.box(-116.20001, 43.5004, -116.1, 43.54999)
+        assert_allclose(snap_area(area).bounds, (-116.200833333, 43.5, -116.1, 43.55))
+
+        # overlapping areas share pixel centres
+        grids = [get_area_grid(shapely.geometry.box(*bounds)) for bounds in
+                 [(-116.2003, 43.5, -116.1, 43.6), (-116.15, 43.4512, -116.0021, 43.57)]]
+        for (shape, transform) in grids:
+            cols = (transform.c - GRID_ORIGIN[0]) / transform.a
+            rows = (transform.f - GRID_ORIGIN[1]) / transform.e
+            assert_allclose([cols, rows], np.round([cols, rows]), atol = 1e-6)
+
     def test_area_assertions(self):
 
         self.assertRaises(AssertionError, get_input_area, [-181, 41, -113, 43])
@@ -0,0 +1,157 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+import shapely.geometry
+import tempfile
+from pathlib import Path
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow import retrieval
+from spicy_snow.retrieval import retrieve_snow_depth, append_snow_depth
+from test_checkpoint import make_s1_dataset
+
+class TestAppend(unittest.TestCase):
+    """
+    Test appending new images to a saved retrieval and retrieving target dates
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.work_dir = Path(self.tmp_dir.name)
+        self.area = shapely.geometry.box(-116.2, 43.5, -116.1, 43.6)
+
+        s1 = make_s1_dataset(periods = 24)
+
+        def search(area, dates):
+            # images between the dates with the absolute orbit of each image
+            found = s1.sel(time = slice(*dates))
+            if found.sizes['time'] == 0:
+                raise ValueError("No search results found.")
+            return pd.DataFrame({'properties.sceneName': [f'S1A_{i}' for i in found['absolute_orbit'].values],
+                                 'properties.orbit': found['absolute_orbit'].values})
+
+        def combine(imgs, search_results = None):
+            return s1.sel(time = s1['absolute_orbit'].isin(search_results['properties.orbit'].values))
+
+        def add_ims(ds, **kwargs):
+            return ds.assign(ims = (('time', 'y', 'x'), np.full((ds.sizes['time'], 20, 20), 4, dtype = np.uint8)))
+
+        def add_fcf(ds):
+            return ds.assign(fcf = (('y', 'x'), np.linspace(0, 1, 400, dtype = np.float32).reshape(20, 20)))
+
+        patches = [patch.object(retrieval, 's1_img_search', side_effect = search),
+                   patch.object(retrieval, 'hyp3_pipeline'), patch.object(retrieval, 'download_hyp3'),
+                   patch.object(retrieval, 'combine_s1_images', side_effect = combine),
+                   patch.object(retrieval, 'download_snow_cover', side_effect = add_ims),
+                   patch.object(retrieval, 'download_fcf', side_effect = add_fcf)]
+        self.mocks = {p.attribute: p.start() for p in patches}
+        self.addCleanup(lambda: [p.stop() for p in patches])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_matches_full(self, ds, expected):
+        self.assertEqual(list(ds.time.values), list(expected.time.values))
+        self.assertEqual(list(ds.relative_orbit.values), list(expected.relative_orbit.values))
+        for var in ['s1', 'deltaGamma', 'snow_index', 'snow_depth', 'wet_flag', 'wet_snow', 'perma_wet']:
+            xr.testing.assert_allclose(ds[var].load(), expected[var].transpose(*ds[var].dims), atol = 1e-6)
+
+    def test_append(self):
+        """
+        Test appending new images matches a retrieval of all images
+        """
+        expected = retrieve_snow_depth(self.area, ('2020-01-01', '2020-06-01'), work_dir = self.work_dir.joinpath('full'),
+                                       checkpoint = False)
+        # the melt season starts before the new images and has perma wet pixels
+        self.assertTrue((expected['perma_wet'].isel(time = slice(9, None)) >= 0.5).any())
+
+        fp = self.work_dir.joinpath('spicy.nc')
+        retrieve_snow_depth(self.area, ('2020-01-01', '2020-02-20'), work_dir = self.work_dir, outfp = fp, checkpoint = False)
+        with netCDF4.Dataset(fp) as nc:
+            self.assertTrue(nc.dimensions['time'].isunlimited())
+            self.assertEqual(sorted(nc['wet_snow_state'].groups), ['20', '93'])
+
+        # masking and thresholds must match the saved retrieval's
+        with self.assertRaises(AssertionError):
+            append_snow_depth(fp, end_date = '2020-06-01', work_dir = self.work_dir, wet_snow_thresh = -3)
+        with self.assertRaises(AssertionError):
+            append_snow_depth(fp, end_date = '2020-06-01', work_dir = self.work_dir, ims_masking = False)
+
+        ds = append_snow_depth(fp, end_date = '2020-06-01', work_dir = self.work_dir, wet_snow_thresh = -2)
+        self.assert_matches_full(ds, expected)
+        self.assertEqual((ds.attrs['ims_masking'], ds.attrs['wet_snow_thresh']), (1, -2))
+        ds.close()
+
+        # only the new passes are downloaded
+        search_results = self.mocks['combine_s1_images'].call_args.kwargs['search_results']
+        self.assertEqual(list(search_results['properties.orbit']), list(range(9, 24)))
+
+        # nothing new to append
+        ds = append_snow_depth(fp, end_date = '2020-06-01', work_dir = self.work_dir)
+        self.assertEqual(self.mocks['hyp3_pipeline'].call_count, 3)
+        self.assertEqual(ds.sizes['time'], 24)
+        ds.close()
+
+    def test_append_in_steps(self):
+        """
+        Test repeated appends and appending to a netcdf without saved state
+        """
+        expected = retrieve_snow_depth(self.area, ('2020-01-01', '2020-06-01'), work_dir = self.work_dir.joinpath('full'),
+                                       checkpoint = False)
+
+        # retrieval saved with a fixed time dimension and no wet snow state
+        fp = self.work_dir.joinpath('spicy.nc')
+        retrieve_snow_depth(self.area, ('2020-01-01', '2020-01-20'), work_dir = self.work_dir, checkpoint = False).to_netcdf(fp)
+
+        for end_date in ['2020-02-01', '2020-03-01', '2020-03-10', '2020-06-01']:
+            append_snow_depth(fp, end_date = end_date, work_dir = self.work_dir).close()
+
+        with xr.open_dataset(fp, decode_coords = 'all') as ds:
+            self.assert_matches_full(ds, expected)
+
+    def test_target_dates(self):
+        """
+        Test streaming target dates matches the same time steps of a retrieval of all images
+        """
+        dates = ('2020-01-01', '2020-06-01')
+        expected = retrieve_snow_depth(self.area, dates, work_dir = self.work_dir.joinpath('full'), checkpoint = False)
+
+        fp = self.work_dir.joinpath('target.nc')
+        ds = retrieve_snow_depth(self.area, dates, work_dir = self.work_dir.joinpath('target'), outfp = fp,
+                                 target_dates = ['2020-03-01', '2020-04-20'], checkpoint = True)
+
+        # latest image of each relative orbit up to each target date
+        times = pd.DatetimeIndex(expected.time.values)
+        keep = ((times >= '2020-02-19') & (times < '2020-03-02')) | ((times >= '2020-04-09') & (times < '2020-04-21'))
+        self.assertEqual(keep.sum(), 4)
+        self.assertNotIn('confidence', ds)
+        self.assertEqual(ds.attrs['target_dates'], ['2020-03-01', '2020-04-20'])
+
+        # outlier percentiles are taken from histograms so allow for small differences
+        expected = expected.isel(time = keep)
+        self.assertEqual(list(ds.time.values), list(expected.time.values))
+        for var in ['s1', 'deltaGamma', 'snow_index', 'snow_depth', 'wet_flag', 'wet_snow', 'perma_wet']:
+            xr.testing.assert_allclose(ds[var], expected[var].transpose(*ds[var].dims), atol = 1e-3)
+
+        # resumed from the checkpoint of the downloads
+        retrieve_snow_depth(self.area, dates, work_dir = self.work_dir.joinpath('target'), target_dates = ['2020-03-01'], checkpoint = True)
+        self.assertEqual(self.mocks['combine_s1_images'].call_count, 2)
+
+        with self.assertRaises(AssertionError):
+            append_snow_depth(fp, end_date = '2020-07-01', work_dir = self.work_dir)
+
+        with self.assertRaises(AssertionError):
+            retrieve_snow_depth(self.area, dates, work_dir = self.work_dir, target_dates = ['2020-07-01'], checkpoint = True)
+
+        # streaming needs the ancillary checkpoint
+        with self.assertRaises(AssertionError):
+            retrieve_snow_depth(self.area, dates, work_dir = self.work_dir, target_dates = ['2020-03-01'])
+
+if __name__ == '__main__':
+    unittest.main()
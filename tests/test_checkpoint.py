@@ -0,0 +1,212 @@
+import unittest
+from unittest.mock import patch
+from importlib.util import find_spec
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import shapely.geometry
+import tempfile
+from pathlib import Path
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow import retrieval
+from spicy_snow.retrieval import retrieve_snow_depth
+from spicy_snow.utils.checkpoint import get_checkpoint_keys, save_checkpoint, load_checkpoint, \
+    find_checkpoint, get_checkpoint_fp
+
+def make_s1_dataset(periods = 12):
+    """
+    Synthetic combined Sentinel-1 dataset of two orbits every 6 days
+    """
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2020-01-01T01:00', periods = periods, freq = '6D')
+    s1 = np.stack([rng.normal(-10, 1, (periods, 20, 20)), rng.normal(-18, 1, (periods, 20, 20)),
+                   rng.uniform(0.5, 0.9, (periods, 20, 20))], axis = 1)
+    ds = xr.Dataset(
+        data_vars = dict(s1 = (['time', 'band', 'y', 'x'], s1)),
+        coords = dict(
+            time = times,
+            band = ['VV', 'VH', 'inc'],
+            x = np.linspace(-116.2, -116.1, 20),
+            y = np.linspace(43.6, 43.5, 20),
+            relative_orbit = ('time', np.resize([20, 93], periods)),
+            absolute_orbit = ('time', np.arange(periods)),
+            platform = ('time', np.resize(['S1A'], periods)),
+            flight_dir = ('time', np.resize(['descending', 'ascending'], periods))),
+        attrs = dict(s1_units = 'dB', resolution = '90'))
+    return ds.rio.write_crs('EPSG:4326')
+
+class TestCheckpoint(unittest.TestCase):
+    """
+    Test saving and resuming stage checkpoints
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_dir = Path(self.tmp_dir.name).joinpath('checkpoints')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_keys(self):
+        """
+        Test changing a stage's parameters changes its key and every later key
+        """
+        stages = [('a', {'x': 1}), ('b', {}), ('c', {'y': 2})]
+        keys = get_checkpoint_keys(stages)
+        self.assertEqual(list(keys), ['a', 'b', 'c'])
+        self.assertEqual(keys, get_checkpoint_keys(stages))
+
+        changed = get_checkpoint_keys([('a', {'x': 1}), ('b', {}), ('c', {'y': 3})])
+        self.assertEqual([keys[k] == changed[k] for k in keys], [True, True, False])
+
+        changed = get_checkpoint_keys([('a', {'x': 2}), ('b', {}), ('c', {'y': 2})])
+        self.assertFalse(any(keys[k] == changed[k] for k in keys))
+
+    def test_save_load(self):
+        """
+        Test checkpoints round trip chunked by time and invalid ones are removed
+        """
+        ds = make_s1_dataset()
+        keys = get_checkpoint_keys([('combined', {}), ('merged', {})])
+        self.assertEqual(find_checkpoint(self.checkpoint_dir, keys), (None, None))
+
+        fp = save_checkpoint(ds, self.checkpoint_dir, 'combined', keys['combined'])
+        self.assertEqual(list(self.checkpoint_dir.glob('*.tmp')), [])
+        xr.testing.assert_identical(load_checkpoint(self.checkpoint_dir, 'combined', keys['combined']), ds)
+
+        raw = xr.open_dataset(fp)
+        self.assertEqual(raw['s1'].encoding['chunksizes'], (1, 3, 20, 20))
+        raw.close()
+
+        # spatial chunks with the full time series for the out of core mode
+        fp = save_checkpoint(ds, self.checkpoint_dir, 'combined', keys['combined'], chunks = {'time': -1, 'y': 8, 'x': 8})
+        raw = xr.open_dataset(fp)
+        self.assertEqual(raw['s1'].encoding['chunksizes'], (12, 3, 8, 8))
+        raw.close()
+
+        # last saved stage is resumed
+        save_checkpoint(ds.isel(time = slice(0, 4)), self.checkpoint_dir, 'merged', keys['merged'])
+        stage, loaded = find_checkpoint(self.checkpoint_dir, keys)
+        self.assertEqual(stage, 'merged')
+        self.assertEqual(loaded.sizes['time'], 4)
+
+        # truncated checkpoint is removed and the stage before is used
+        fp = get_checkpoint_fp(self.checkpoint_dir, 'merged', keys['merged'])
+        fp.write_bytes(fp.read_bytes()[:100])
+        self.assertEqual(find_checkpoint(self.checkpoint_dir, keys)[0], 'combined')
+        self.assertFalse(fp.exists())
+
+    def patch_downloads(self):
+        """
+        Replace the search and downloads of retrieve_snow_depth with the synthetic dataset
+        """
+        def add_ims(ds, **kwargs):
+            return ds.assign(ims = (('time', 'y', 'x'), np.full((ds.sizes['time'], 20, 20), 4, dtype = np.uint8)))
+
+        def add_fcf(ds):
+            return ds.assign(fcf = (('y', 'x'), np.full((20, 20), 0.25, dtype = np.float32)))
+
+        downloads = {'s1_img_search': pd.DataFrame({'properties.sceneName': ['a'] * 4}),
+                     'hyp3_pipeline': None, 'download_hyp3': None}
+        patches = [patch.object(retrieval, name, return_value = value) for name, value in downloads.items()]
+        patches += [patch.object(retrieval, 'combine_s1_images', side_effect = lambda *args, **kwargs: make_s1_dataset()),
+                    patch.object(retrieval, 'download_snow_cover', side_effect = add_ims),
+                    patch.object(retrieval, 'download_fcf', side_effect = add_fcf)]
+        mocks = [p.start() for p in patches]
+        self.addCleanup(lambda: [p.stop() for p in patches])
+        return mocks[3], mocks[5]
+
+    def test_retrieval_resume(self):
+        """
+        Test a failed retrieval resumes from the last saved stage
+        """
+        area = shapely.geometry.box(-116.2, 43.5, -116.1, 43.6)
+        dates = ('2020-01-01', '2020-03-01')
+        combine, download_fcf = self.patch_downloads()
+
+        work_dir = Path(self.tmp_dir.name)
+        expected = retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('full'), checkpoint = False)
+        self.assertFalse(work_dir.joinpath('full', 'checkpoints').exists())
+        self.assertTrue(expected['snow_depth'].notnull().any())
+
+        # failure after preprocessing
+        with patch.object(retrieval, 'calc_snow_index', side_effect = RuntimeError):
+            with self.assertRaises(RuntimeError):
+                retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('run'), checkpoint = True)
+        self.assertEqual(combine.call_count, 2)
+        self.assertEqual(len(list(work_dir.joinpath('run', 'checkpoints').glob('*.nc'))), 4)
+
+        # rerun starts from the preprocessed dataset
+        ds = retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('run'), checkpoint = True)
+        self.assertEqual(combine.call_count, 2)
+        self.assertEqual(download_fcf.call_count, 2)
+        for var in ['snow_depth', 'wet_snow', 'snow_index']:
+            xr.testing.assert_allclose(ds[var], expected[var])
+
+        # new parameters only redo the snow index
+        retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('run'), params = [2, 0.2, 0.55], checkpoint = True)
+        self.assertEqual(combine.call_count, 2)
+        self.assertEqual(len(list(work_dir.joinpath('run', 'checkpoints').glob('snow_index-*.nc'))), 2)
+
+        # new area starts from the beginning
+        retrieve_snow_depth(shapely.geometry.box(-116.2, 43.5, -116.1, 43.7), dates, work_dir = work_dir.joinpath('run'), checkpoint = True)
+        self.assertEqual(combine.call_count, 3)
+
+        # new images published since the last run start from the beginning
+        retrieval.s1_img_search.return_value = pd.DataFrame({'properties.sceneName': ['a'] * 4 + ['b']})
+        retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('run'), checkpoint = True)
+        self.assertEqual(combine.call_count, 4)
+
+    def test_pipeline_client(self):
+        """
+        Test the pipelined download logs in to hyp3 once and shares the client
+        """
+        area = shapely.geometry.box(-116.2, 43.5, -116.1, 43.6)
+        self.patch_downloads()
+        retrieval.s1_img_search.return_value = pd.DataFrame({'properties.sceneName': [
+            f'S1A_IW_GRDH_1SDV_2020010{d}T010203_2020010{d}T010228_030000_036000_ABCD' for d in range(1, 5)]})
+
+        with patch.object(retrieval, 'get_hyp3_client') as client, patch.object(retrieval, 'iter_hyp3_jobs') as iter_jobs, \
+                patch.object(retrieval, 'fetch_ims_days'), patch.object(retrieval, 'get_fcf_fp'):
+            retrieve_snow_depth(area, ('2020-01-01', '2020-03-01'), work_dir = self.tmp_dir.name, pipeline = True)
+
+        client.assert_called_once()
+        self.assertIs(retrieval.hyp3_pipeline.call_args.kwargs['hyp3'], client.return_value)
+        self.assertIs(iter_jobs.call_args.kwargs['hyp3'], client.return_value)
+
+    @unittest.skipUnless(find_spec('dask'), 'dask is not installed')
+    def test_retrieval_chunks(self):
+        """
+        Test the out of core mode matches the in memory retrieval
+        """
+        area = shapely.geometry.box(-116.2, 43.5, -116.1, 43.6)
+        dates = ('2020-01-01', '2020-03-01')
+        self.patch_downloads()
+
+        work_dir = Path(self.tmp_dir.name)
+        expected = retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('memory'), checkpoint = False)
+
+        outfp = work_dir.joinpath('chunked.nc')
+        ds = retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('chunked'), chunks = 8, outfp = outfp, checkpoint = True)
+        self.assertTrue(ds['snow_depth'].chunks)
+        self.assertEqual(ds['snow_depth'].chunksizes['x'], (8, 8, 4))
+
+        # stages are read back from checkpoints chunked by space with the full time series
+        raw = xr.open_dataset(next(work_dir.joinpath('chunked', 'checkpoints').glob('preprocessed-*.nc')))
+        self.assertEqual(raw['s1'].encoding['chunksizes'][1:], (3, 8, 8))
+        raw.close()
+
+        # outlier percentiles are taken from histograms so allow for small differences
+        saved = xr.load_dataset(outfp)
+        for var in ['snow_depth', 'wet_snow']:
+            xr.testing.assert_allclose(saved[var], expected[var], atol = 1e-3)
+
+        with self.assertRaises(AssertionError):
+            retrieve_snow_depth(area, dates, work_dir = work_dir.joinpath('chunked'), chunks = -8)
+
+if __name__ == '__main__':
+    unittest.main()
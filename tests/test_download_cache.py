@@ -0,0 +1,200 @@
+import unittest
+from unittest.mock import patch
+
+import os
+import json
+import multiprocessing
+import tempfile
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.utils import download
+from spicy_snow.utils.download import cached_download, get_cache_stats, reset_cache_stats
+
+def download_in_process(urls):
+    """
+    Download urls through the cache (run in a worker process)
+    """
+    return [cached_download(url, verbose = False).read_bytes() for url in urls]
+
+class ETagHandler(SimpleHTTPRequestHandler):
+    """
+    File server that records requests and sends the file contents as ETag
+    """
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        ETagHandler.requests.append(('GET', self.path))
+        super().do_GET()
+
+    def do_HEAD(self):
+        ETagHandler.requests.append(('HEAD', self.path))
+        super().do_HEAD()
+
+    def end_headers(self):
+        fp = Path(self.directory).joinpath(self.path.lstrip('/'))
+        if fp.exists():
+            self.send_header('ETag', f'"{fp.read_bytes().hex()[:16]}"')
+        super().end_headers()
+
+class TestDownloadCache(unittest.TestCase):
+    """
+    Test the machine wide download cache against a local file server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.serve_dir = tempfile.TemporaryDirectory()
+        handler = partial(ETagHandler, directory = cls.serve_dir.name)
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.serve_dir.cleanup()
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'SPICY_SNOW_CACHE': self.cache_dir.name})
+        self.env.start()
+        ETagHandler.requests.clear()
+        reset_cache_stats()
+
+        for name, size in [('a.tif', 1000), ('b.tif', 2000), ('c.tif', 3000)]:
+            Path(self.serve_dir.name).joinpath(name).write_bytes(name.encode() * size)
+        # same content as a.tif from another url
+        Path(self.serve_dir.name).joinpath('copy_of_a.tif').write_bytes(b'a.tif' * 1000)
+
+    def tearDown(self):
+        self.env.stop()
+        self.cache_dir.cleanup()
+
+    def gets(self):
+        return [path for method, path in ETagHandler.requests if method == 'GET']
+
+    def blobs(self):
+        return list(Path(self.cache_dir.name).joinpath('downloads', 'blobs').glob('*'))
+
+    def test_hits_and_misses(self):
+        """
+        Test files are downloaded once, linked to out_fp and counted
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_fp = Path(tmp_dir).joinpath('a.tif')
+            self.assertEqual(cached_download(f'{self.url}/a.tif', out_fp, verbose = False), out_fp)
+            self.assertEqual(out_fp.read_bytes(), b'a.tif' * 1000)
+
+            # another work directory reuses the cached file
+            other_fp = Path(tmp_dir).joinpath('other', 'a.tif')
+            other_fp.parent.mkdir()
+            cached_download(f'{self.url}/a.tif', other_fp, verbose = False)
+            self.assertEqual(other_fp.read_bytes(), b'a.tif' * 1000)
+
+        self.assertEqual(self.gets(), ['/a.tif'])
+        self.assertEqual(get_cache_stats(), {'hits': 1, 'misses': 1, 'bytes_downloaded': 5000,
+                                             'bytes_reused': 5000, 'evictions': 0})
+
+        # files are stored once by content and read-only
+        fp = cached_download(f'{self.url}/copy_of_a.tif', verbose = False)
+        self.assertEqual(self.blobs(), [fp])
+        self.assertFalse(fp.stat().st_mode & 0o222)
+
+        index = json.loads(Path(self.cache_dir.name).joinpath('downloads', 'index.json').read_text())
+        self.assertEqual(set(index), {f'{self.url}/a.tif', f'{self.url}/copy_of_a.tif'})
+        self.assertEqual(index[f'{self.url}/a.tif']['etag'], f'"{(b"a.tif" * 1000).hex()[:16]}"')
+
+    def test_integrity(self):
+        """
+        Test incomplete or corrupted cached files are downloaded again
+        """
+        fp = cached_download(f'{self.url}/b.tif', verbose = False)
+        os.chmod(fp, 0o644)
+
+        # truncated file
+        fp.write_bytes(b'b.tif' * 10)
+        self.assertEqual(cached_download(f'{self.url}/b.tif', verbose = False).read_bytes(), b'b.tif' * 2000)
+        self.assertEqual(get_cache_stats()['misses'], 2)
+
+        # corrupted file of the same size is only caught when verifying
+        os.chmod(fp, 0o644)
+        fp.write_bytes(b'x.tif' * 2000)
+        self.assertEqual(cached_download(f'{self.url}/b.tif', verbose = False).read_bytes(), b'x.tif' * 2000)
+        self.assertEqual(cached_download(f'{self.url}/b.tif', verbose = False, verify = True).read_bytes(), b'b.tif' * 2000)
+        self.assertEqual(get_cache_stats()['misses'], 3)
+
+    def test_revalidate(self):
+        """
+        Test changed files are downloaded again when revalidating their ETag
+        """
+        cached_download(f'{self.url}/c.tif', verbose = False)
+        Path(self.serve_dir.name).joinpath('c.tif').write_bytes(b'new' * 10)
+
+        # without revalidating the cached file is used
+        self.assertEqual(cached_download(f'{self.url}/c.tif', verbose = False).read_bytes(), b'c.tif' * 3000)
+        self.assertEqual(len(ETagHandler.requests), 2)
+
+        self.assertEqual(cached_download(f'{self.url}/c.tif', verbose = False, revalidate = True).read_bytes(), b'new' * 10)
+        self.assertEqual(self.gets(), ['/c.tif', '/c.tif'])
+
+        # unchanged ETag only makes a HEAD request
+        n_requests = len(ETagHandler.requests)
+        cached_download(f'{self.url}/c.tif', verbose = False, revalidate = True)
+        self.assertEqual(ETagHandler.requests[n_requests:], [('HEAD', '/c.tif')])
+
+    def test_eviction(self):
+        """
+        Test least recently used files are removed over the size limit
+        """
+        max_size = 21000
+        cached_download(f'{self.url}/a.tif', verbose = False, max_size = max_size)
+        cached_download(f'{self.url}/b.tif', verbose = False, max_size = max_size)
+        # a.tif is now more recently used than b.tif
+        cached_download(f'{self.url}/a.tif', verbose = False, max_size = max_size)
+        self.assertEqual(len(self.blobs()), 2)
+
+        fp = cached_download(f'{self.url}/c.tif', verbose = False, max_size = max_size)
+        self.assertEqual(sorted(fp.stat().st_size for fp in self.blobs()), [5000, 15000])
+        self.assertEqual(get_cache_stats()['evictions'], 1)
+
+        # the newest file is kept even if larger than the limit
+        fp = cached_download(f'{self.url}/c.tif', verbose = False, max_size = 1)
+        self.assertEqual(self.blobs(), [fp])
+
+        # size limit from the environment
+        with patch.dict('os.environ', {'SPICY_SNOW_CACHE_SIZE': '1'}):
+            fp = cached_download(f'{self.url}/b.tif', verbose = False)
+        self.assertEqual(self.blobs(), [fp])
+
+    @unittest.skipUnless(download.fcntl is not None and 'fork' in multiprocessing.get_all_start_methods(),
+                         'needs file locks and forked workers')
+    def test_processes(self):
+        """
+        Test processes sharing the cache download each url once and keep every index entry
+        """
+        names = ['a.tif', 'b.tif', 'c.tif', 'copy_of_a.tif']
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            results = pool.map(download_in_process, [[f'{self.url}/{name}' for name in names[i:] + names[:i]]
+                                                     for i in range(4)] * 2)
+
+        for result in results:
+            self.assertEqual(sorted(result), sorted(Path(self.serve_dir.name).joinpath(name).read_bytes() for name in names))
+        self.assertEqual(sorted(self.gets()), sorted(f'/{name}' for name in names))
+
+        index = json.loads(Path(self.cache_dir.name).joinpath('downloads', 'index.json').read_text())
+        self.assertEqual(set(index), {f'{self.url}/{name}' for name in names})
+        self.assertEqual(list(Path(self.cache_dir.name).joinpath('downloads').glob('*.download')), [])
+
+if __name__ == '__main__':
+    unittest.main()
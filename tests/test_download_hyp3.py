@@ -0,0 +1,246 @@
+import unittest
+from numpy.testing import assert_allclose
+
+import numpy as np
+import xarray as xr
+import rioxarray
+import shapely.geometry
+import tempfile
+import threading
+import time
+from datetime import datetime
+from functools import partial
+from unittest.mock import patch
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+import hyp3_sdk as sdk
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.download.sentinel1 import download_hyp3, hyp3_pipeline, iter_hyp3_jobs
+from spicy_snow.IO.user_area import get_area_grid
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """
+    File server that records requested paths instead of logging them
+    """
+    requests = []
+    times = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        QuietHandler.requests.append(self.path)
+        QuietHandler.times.append(time.monotonic())
+        super().do_GET()
+
+class FakeJob:
+    """
+    Minimal stand in for a completed hyp3_sdk Job
+    """
+    def __init__(self, granule, url):
+        self.job_parameters = {'granules': [granule]}
+        self.files = [{'url': url}]
+
+class FakeHyP3:
+    """
+    Stand in for a HyP3 client whose jobs finish on a schedule. schedule maps
+    each granule to the refresh its job succeeds on (or None to fail on the
+    first refresh).
+    """
+    def __init__(self, url, schedule):
+        self.url = url
+        self.schedule = schedule
+        self.refreshes = []
+        self.watched = False
+
+    def submit_rtc_job(self, granule, name = None, **kwargs):
+        job = sdk.Job('RTC_GAMMA', granule, datetime.now(), 'PENDING', 'user', name = name,
+                      job_parameters = {'granules': [granule]})
+        return sdk.Batch([job])
+
+    def find_jobs(self, name = None):
+        return sdk.Batch([sdk.Job('RTC_GAMMA', granule, datetime.now(), 'SUCCEEDED', 'user', name = name,
+                                  job_parameters = {'granules': [granule]}) for granule in self.schedule])
+
+    def check_credits(self):
+        return 1000
+
+    def watch(self, jobs):
+        self.watched = True
+
+    def refresh(self, jobs):
+        self.refreshes.append(time.monotonic())
+        refreshed = []
+        for job in jobs:
+            granule = job.job_parameters['granules'][0]
+            finish = self.schedule[granule]
+            if finish is None:
+                status, files = 'FAILED', None
+            elif len(self.refreshes) >= finish:
+                status, files = 'SUCCEEDED', [{'url': f'{self.url}/{granule}.zip'}]
+            else:
+                status, files = 'RUNNING', None
+            refreshed.append(sdk.Job('RTC_GAMMA', job.job_id, job.request_time, status, 'user',
+                                     name = job.name, job_parameters = job.job_parameters, files = files))
+        return sdk.Batch(refreshed)
+
+class TestDownloadHyp3(unittest.TestCase):
+    """
+    Test downloading and ingesting hyp3 products from a local file server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.serve_dir = tempfile.TemporaryDirectory()
+        cls.granules = [f'S1A_IW_GRDH_1SDV_202001{d:02}T010203_202001{d:02}T010228_030000_036000_ABCD' for d in [1, 7, 13, 19]]
+
+        # 30 m UTM scenes covering more than the area with values by band and granule
+        x = 560000 + np.arange(400) * 30 + 15
+        y = 4830000 - np.arange(400) * 30 - 15
+        for i, granule in enumerate(cls.granules):
+            for j, band in enumerate(['VV', 'VH', 'inc_map']):
+                data = np.full((1, 400, 400), 0.1 * (i + 1) + j, dtype = np.float32)
+                img = xr.DataArray(data, dims = ['band', 'y', 'x'], coords = dict(band = [1], x = x, y = y))
+                img = img.rio.write_crs('EPSG:32611').rio.write_nodata(np.nan)
+                img.rio.to_raster(Path(cls.serve_dir.name).joinpath(f'{granule}_{band}.tif'))
+
+        handler = partial(QuietHandler, directory = cls.serve_dir.name)
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+        cls.area = shapely.geometry.box(-116.2, 43.55, -116.15, 43.6)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.serve_dir.cleanup()
+
+    def setUp(self):
+        # fresh download cache for every test
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'SPICY_SNOW_CACHE': self.cache_dir.name})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.cache_dir.cleanup()
+
+    def jobs(self):
+        # repeated granule should only be downloaded once
+        granules = self.granules + self.granules[:1]
+        return [FakeJob(g, f'{self.url}/{g}.zip') for g in granules]
+
+    def test_download_hyp3(self):
+        """
+        Test concurrent download returns every granule in job order on one grid
+        """
+        QuietHandler.requests.clear()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imgs = download_hyp3(self.jobs(), self.area, outdir = tmp_dir, clean = False, max_workers = 3)
+
+            self.assertEqual(list(imgs.keys()), self.granules)
+            self.assertEqual(len(list(Path(tmp_dir).glob('*.tif'))), 12)
+
+        # each file requested once
+        self.assertEqual(len(QuietHandler.requests), 12)
+        self.assertEqual(len(set(QuietHandler.requests)), 12)
+
+        first = imgs[self.granules[0]]
+        self.assertEqual(list(first.band.values), ['VV', 'VH', 'inc'])
+        self.assertEqual(first.rio.crs.to_epsg(), 4326)
+
+        # images are warped directly onto the area's grid
+        shape, transform = get_area_grid(self.area)
+        self.assertEqual(first.shape[1:], shape)
+        assert_allclose(first.rio.transform(), transform)
+
+        # windowed reads still cover the whole grid
+        self.assertFalse(first.isnull().any())
+
+        for i, granule in enumerate(self.granules):
+            da = imgs[granule]
+            xr.testing.assert_equal(da.x, first.x)
+            xr.testing.assert_equal(da.y, first.y)
+            for j, band in enumerate(['VV', 'VH', 'inc']):
+                values = da.sel(band = band).values
+                assert_allclose(values[~np.isnan(values)], 0.1 * (i + 1) + j, rtol = 1e-6)
+
+    def test_download_hyp3_workers(self):
+        """
+        Test the number of workers does not change the results and clean removes tifs
+        """
+        QuietHandler.requests.clear()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial = download_hyp3(self.jobs(), self.area, outdir = Path(tmp_dir).joinpath('serial'), max_workers = 1)
+            parallel = download_hyp3(self.jobs(), self.area, outdir = Path(tmp_dir).joinpath('parallel'), max_workers = 8)
+
+            self.assertFalse(Path(tmp_dir).joinpath('parallel').exists())
+
+        # second run is linked from the download cache
+        self.assertEqual(len(QuietHandler.requests), 12)
+
+        self.assertEqual(list(serial.keys()), list(parallel.keys()))
+        for granule in serial:
+            xr.testing.assert_identical(serial[granule], parallel[granule])
+
+    def test_pipelined_download(self):
+        """
+        Test jobs are yielded and downloaded as they succeed while others still run
+        """
+        QuietHandler.requests.clear()
+        QuietHandler.times.clear()
+
+        # jobs finish over three refreshes and one fails
+        schedule = dict(zip(self.granules, [2, 1, 3, None]))
+        hyp3 = FakeHyP3(self.url, schedule)
+        search_results = {'properties.sceneName': self.granules}
+        jobs = hyp3_pipeline(search_results, 'test', watch = False, hyp3 = hyp3)
+        self.assertFalse(hyp3.watched)
+        self.assertTrue(all(job.status_code == 'PENDING' for job in jobs))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imgs = download_hyp3(iter_hyp3_jobs(jobs, hyp3 = hyp3, interval = 0.5), self.area,
+                                 outdir = tmp_dir, clean = False)
+
+        # succeeded jobs in the order they finished without the failed job
+        self.assertEqual(list(imgs.keys()), [self.granules[i] for i in [1, 0, 2]])
+        self.assertEqual(len(hyp3.refreshes), 3)
+
+        # first granule was downloaded before the last job succeeded
+        first = min(t for path, t in zip(QuietHandler.requests, QuietHandler.times) if self.granules[1] in path)
+        self.assertLess(first, hyp3.refreshes[-1])
+
+        # same images as downloading the finished jobs at once
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            done = [FakeJob(g, f'{self.url}/{g}.zip') for g in imgs]
+            expected = download_hyp3(done, self.area, outdir = tmp_dir)
+        for granule in imgs:
+            xr.testing.assert_identical(imgs[granule], expected[granule])
+
+    def test_existing_jobs(self):
+        """
+        Test only the existing jobs of the searched granules are reused
+        """
+        hyp3 = FakeHyP3(self.url, dict.fromkeys(self.granules, 1))
+        jobs = hyp3_pipeline({'properties.sceneName': self.granules[1:3]}, 'test', existing_job_name = 'test', hyp3 = hyp3)
+        self.assertEqual([job.job_parameters['granules'][0] for job in jobs], self.granules[1:3])
+
+    def test_iter_hyp3_jobs_timeout(self):
+        """
+        Test jobs that never finish raise an error after the timeout
+        """
+        hyp3 = FakeHyP3(self.url, {self.granules[0]: 100})
+        jobs = hyp3.submit_rtc_job(self.granules[0])
+        with self.assertRaises(TimeoutError):
+            list(iter_hyp3_jobs(jobs, hyp3 = hyp3, interval = 0.01, timeout = 0.05))
+
+if __name__ == '__main__':
+    unittest.main()
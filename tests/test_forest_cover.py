@@ -0,0 +1,107 @@
+import unittest
+from unittest.mock import patch
+from numpy.testing import assert_allclose
+
+import numpy as np
+import xarray as xr
+import rioxarray
+import tempfile
+from pathlib import Path
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.download import forest_cover
+from spicy_snow.download.forest_cover import download_fcf
+from spicy_snow.utils import download
+
+class TestForestCover(unittest.TestCase):
+    """
+    Test reading forest cover fraction from a local global layer
+    """
+
+    def setUp(self):
+        self.serve_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'SPICY_SNOW_CACHE': self.cache_dir.name})
+        self.env.start()
+
+        # 0.01 degree tree cover percent layer around Boise, ID
+        x = -117 + np.arange(200) * 0.01 + 0.005
+        y = 45 - np.arange(200) * 0.01 - 0.005
+        data = np.random.default_rng(0).integers(0, 101, (1, 200, 200)).astype(np.uint8)
+        self.layer = xr.DataArray(data, dims = ['band', 'y', 'x'], coords = dict(band = [1], x = x, y = y))
+        self.layer = self.layer.rio.write_crs('EPSG:4326')
+        fcf_fp = Path(self.serve_dir.name).joinpath('fcf.tif')
+        self.layer.rio.to_raster(fcf_fp, tiled = True, blockxsize = 64, blockysize = 64)
+
+        self.url = patch.object(forest_cover, 'FCF_URL', fcf_fp.as_uri())
+        self.url.start()
+        self.urlretrieve = patch.object(download, 'urlretrieve', wraps = download.urlretrieve)
+        self.urlretrieve_mock = self.urlretrieve.start()
+
+        x = np.linspace(-116.2, -116.1, 20)
+        y = np.linspace(43.6, 43.5, 20)
+        s1 = xr.DataArray(np.zeros((2, 1, 20, 20)), dims = ['time', 'band', 'y', 'x'],
+                          coords = dict(time = [0, 1], band = ['VV'], x = x, y = y)).rio.write_crs('EPSG:4326')
+        self.dataset = s1.to_dataset(name = 's1')
+
+    def tearDown(self):
+        self.urlretrieve.stop()
+        self.url.stop()
+        self.env.stop()
+        self.serve_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_download_fcf(self):
+        """
+        Test fcf is read from the cached layer and matches reprojecting the full layer
+        """
+        ds = download_fcf(self.dataset)
+        self.assertEqual(ds['fcf'].dims, ('y', 'x'))
+        self.assertEqual(ds['fcf'].dtype, np.float32)
+
+        expected = self.layer.rio.reproject_match(self.dataset['s1']).squeeze('band') / 100
+        assert_allclose(ds['fcf'].values, expected.values, rtol = 1e-6)
+        xr.testing.assert_equal(ds['fcf'].x, self.dataset.x)
+
+        # global layer is cached once per machine and read-only
+        cached = list(Path(self.cache_dir.name).joinpath('downloads', 'blobs').glob('*'))
+        self.assertEqual(len(cached), 1)
+        self.assertEqual(cached[0].suffix, '.tif')
+        self.assertFalse(cached[0].stat().st_mode & 0o222)
+
+        # second dataset reuses the cached layer
+        download_fcf(self.dataset)
+        self.assertEqual(self.urlretrieve_mock.call_count, 1)
+
+    def test_fcf_netcdf(self):
+        """
+        Test fcf is saved as uint8 percent in netcdf
+        """
+        ds = download_fcf(self.dataset)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            nc_fp = Path(tmp_dir).joinpath('fcf.nc')
+            ds.to_netcdf(nc_fp)
+
+            raw = xr.open_dataset(nc_fp, mask_and_scale = False)
+            self.assertEqual(raw['fcf'].dtype, np.uint8)
+            assert_allclose(raw['fcf'].values, np.round(ds['fcf'].values * 100))
+
+            loaded = xr.load_dataset(nc_fp)
+            assert_allclose(loaded['fcf'].values, ds['fcf'].values, atol = 1e-6)
+
+    def test_fcf_no_cache(self):
+        """
+        Test fcf is saved to out_fp when not caching
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_fp = Path(tmp_dir).joinpath('fcf.tif')
+            ds = download_fcf(self.dataset, out_fp, cache = False)
+            self.assertTrue(out_fp.exists())
+
+        self.assertEqual(len(list(Path(self.cache_dir.name).glob('*'))), 0)
+        self.assertTrue((ds['fcf'] <= 1).all())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import unittest
+from unittest.mock import patch
+
+import base64
+import json
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.utils import nsidc
+from spicy_snow.utils.nsidc import cmr_search, cmr_download
+
+CREDENTIALS = base64.b64encode(b'user:pass').decode('ascii')
+
+class MockCMRHandler(BaseHTTPRequestHandler):
+    """
+    Mock CMR search and Earthdata protected data server. Data files need a
+    session cookie that is set after logging in to the mock URS with basic
+    authentication.
+    """
+    files = {}
+    logins = 0
+    requests = []
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def redirect(self, location, cookie = None):
+        self.send_response(302)
+        self.send_header('Location', location)
+        if cookie:
+            self.send_header('Set-Cookie', f'{cookie}; Path=/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_body(self, body, headers = {}):
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        cookies = self.headers.get('Cookie', '')
+        with MockCMRHandler.lock:
+            MockCMRHandler.requests.append(url.path)
+
+        if url.path == '/search/granules.json':
+            # one page of results then an empty page
+            host = f'http://{self.headers["Host"]}'
+            entries = [] if self.headers.get('cmr-scroll-id') else \
+                [{'links': [{'href': f'{host}/data/{name}', 'rel': 'http://esipfed.org/ns/fedsearch/1.1/data#'}]}
+                 for name in MockCMRHandler.files]
+            self.send_body(json.dumps({'feed': {'entry': entries}}).encode(),
+                           {'cmr-scroll-id': 'scroll', 'cmr-hits': str(len(MockCMRHandler.files))})
+
+        elif url.path == '/urs/authorize':
+            if 'urs=ok' in cookies:
+                self.redirect(f'/callback?redirect={query["redirect"][0]}')
+            elif self.headers.get('Authorization') == f'Basic {CREDENTIALS}':
+                with MockCMRHandler.lock:
+                    MockCMRHandler.logins += 1
+                self.redirect(f'/callback?redirect={query["redirect"][0]}', 'urs=ok')
+            else:
+                self.send_error(401, 'Unauthorized')
+
+        elif url.path == '/callback':
+            self.redirect(query['redirect'][0], 'session=ok')
+
+        elif url.path.startswith('/data/'):
+            name = url.path.split('/')[-1]
+            if name not in MockCMRHandler.files:
+                self.send_error(404, 'Not Found')
+            elif 'session=ok' in cookies:
+                self.send_body(MockCMRHandler.files[name])
+            else:
+                self.redirect(f'/urs/authorize?redirect={url.path}')
+
+        else:
+            self.send_error(404, 'Not Found')
+
+class TestCMRDownload(unittest.TestCase):
+    """
+    Test concurrent CMR downloads against a mock CMR and Earthdata server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockCMRHandler)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        MockCMRHandler.files = {f'SNEX20_QSI_SD_{i}.tif': bytes([i]) * (1000 + i) for i in range(12)}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        MockCMRHandler.logins = 0
+        MockCMRHandler.requests.clear()
+        self.out_dir = tempfile.TemporaryDirectory()
+
+        # new process wide login and search urls of the mock server
+        self.patches = [patch.object(nsidc, '_cmr_opener', None), patch.object(nsidc, '_cmr_login', None),
+                        patch.object(nsidc, 'CMR_FILE_URL', f'{self.url}/search/granules.json?provider=NSIDC_ECS')]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.out_dir.cleanup()
+
+    def search(self):
+        return cmr_search('SNEX20_QSI_SD', '1', '2020-02-09T00:00:00Z', '2021-03-20T23:59:59Z', quiet = True)
+
+    def test_cmr_download(self):
+        """
+        Test files are downloaded concurrently to out_dir with one login
+        """
+        urls = self.search()
+        self.assertEqual(len(urls), 12)
+
+        stats = cmr_download(urls, quiet = True, out_dir = self.out_dir.name, max_workers = 4, credentials = CREDENTIALS)
+        self.assertEqual(MockCMRHandler.logins, 1)
+        self.assertEqual((stats['downloaded'], stats['skipped'], stats['failed']), (12, 0, 0))
+        self.assertEqual(stats['bytes'], sum(len(data) for data in MockCMRHandler.files.values()))
+        self.assertGreater(stats['throughput'], 0)
+
+        for name, data in MockCMRHandler.files.items():
+            self.assertEqual(Path(self.out_dir.name).joinpath(name).read_bytes(), data)
+        self.assertEqual(list(Path(self.out_dir.name).glob('*.part')), [])
+
+        # later downloads reuse the login of this process and skip existing files
+        Path(self.out_dir.name).joinpath('SNEX20_QSI_SD_3.tif').unlink()
+        MockCMRHandler.requests.clear()
+        stats = cmr_download(urls, quiet = True, out_dir = self.out_dir.name)
+        self.assertEqual((stats['downloaded'], stats['skipped'], stats['failed']), (1, 11, 0))
+        self.assertEqual(MockCMRHandler.logins, 1)
+        self.assertEqual(MockCMRHandler.requests, ['/data/SNEX20_QSI_SD_3.tif'])
+
+        # force downloads everything again
+        stats = cmr_download(urls, force = True, quiet = True, out_dir = self.out_dir.name, max_workers = 8)
+        self.assertEqual(stats['downloaded'], 12)
+        self.assertEqual(MockCMRHandler.logins, 1)
+
+    def test_cmr_download_failures(self):
+        """
+        Test missing files are counted as failed without stopping other downloads
+        """
+        urls = self.search() + [f'{self.url}/data/missing.tif']
+        with patch('builtins.print'):
+            stats = cmr_download(urls, quiet = True, out_dir = self.out_dir.name, credentials = CREDENTIALS)
+        self.assertEqual((stats['downloaded'], stats['failed']), (12, 1))
+        self.assertFalse(Path(self.out_dir.name).joinpath('missing.tif').exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from numpy.testing import assert_allclose
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.processing.param_stats import calc_sufficient_stats, calc_c_scores, calc_optimal_c, \
+    bootstrap_stats
+
+class TestParameterStats(unittest.TestCase):
+    """
+    Test functionality of parameter scoring functions
+    """
+
+    @classmethod
+    def setUpTestData(self):
+        snow_index = xr.DataArray(np.random.gamma(2, 1, (2, 3, 200)), dims = ['A', 'B', 'pixel'],
+                                  coords = dict(A = [1, 2], B = [0, 0.5, 1]))
+        snow_index[0, 0, :10] = np.nan
+
+        lidar = xr.DataArray(snow_index.values[1, 1] * 0.6 + np.random.randn(200) * 0.3, dims = ['pixel'])
+        lidar[20:25] = np.nan
+
+        return snow_index, lidar
+
+    def test_c_scores(self):
+        """
+        Test rmse, bias and pearson r from sufficient statistics against
+        calculating them from the snow depths of each C
+        """
+        snow_index, lidar = self.setUpTestData()
+        C = np.round(np.arange(-0.5, 1.01, 0.1), 2)
+
+        stats = calc_sufficient_stats(snow_index, lidar)
+        self.assertEqual(stats['n'].dims, ('A', 'B'))
+        self.assertEqual(stats['n'].sel(A = 1, B = 0), 185)
+
+        scores = calc_c_scores(stats, C)
+        self.assertEqual(scores['rmse'].dims, ('A', 'B', 'C'))
+
+        for a, b, c in zip(np.repeat([1, 2], 3), np.tile([0, 0.5, 1], 2), [-0.5, 0.2, 0.5, 1, 0.3, 0.9]):
+            x, y = snow_index.sel(A = a, B = b).values, lidar.values
+            valid = ~np.isnan(x) & ~np.isnan(y)
+            sd, y = x[valid] * c, y[valid]
+
+            score = scores.sel(A = a, B = b, C = c)
+            assert_allclose(score['rmse'], np.sqrt(np.mean((sd - y) ** 2)))
+            assert_allclose(score['bias'], np.mean(sd - y))
+            assert_allclose(score['pearsonr'], np.corrcoef(sd, y)[0, 1])
+
+        # correlation is undefined for constant snow depths
+        self.assertTrue(scores['pearsonr'].sel(C = 0).isnull().all())
+
+    def test_optimal_c(self):
+        """
+        Test analytic optimal C against the lowest rmse of a fine C grid
+        """
+        snow_index, lidar = self.setUpTestData()
+        stats = calc_sufficient_stats(snow_index, lidar)
+
+        optimal = calc_optimal_c(stats)
+        scores = calc_c_scores(stats, np.linspace(0, 2, 20001))
+
+        assert_allclose(optimal['C'], scores['rmse'].idxmin('C'), atol = 1e-4)
+        assert_allclose(optimal['rmse'], scores['rmse'].min('C'), rtol = 1e-6)
+        self.assertTrue((optimal['rmse'] <= scores['rmse'].min('C')).all())
+
+        # sufficient statistics of two sites sum to those of the combined pixels
+        combined = calc_sufficient_stats(xr.concat([snow_index, snow_index], 'pixel'), xr.concat([lidar, lidar], 'pixel'))
+        xr.testing.assert_allclose(combined, stats * 2)
+
+    def test_bootstrap_stats(self):
+        """
+        Test bootstrap statistics against resampling each iteration and is
+        reproducible with a seed for any memory limit
+        """
+        snow_index, lidar = self.setUpTestData()
+        C = xr.DataArray([0.2, 0.6, 1], dims = ['C'], coords = dict(C = [0.2, 0.6, 1]))
+        sds = snow_index * C
+
+        stats = bootstrap_stats(sds, lidar, iterations = 20, seed = 3)
+        self.assertEqual(stats['rmse'].dims, ('A', 'B', 'C', 'iteration'))
+        self.assertEqual(stats['rmse'].shape, (2, 3, 3, 20))
+
+        # small memory limit uses many batches and parameter chunks
+        small = bootstrap_stats(sds, lidar, iterations = 20, seed = 3, max_memory = 1e4)
+        xr.testing.assert_allclose(stats, small)
+
+        # pixels valid for all parameters and lidar
+        valid = sds.notnull().all(['A', 'B', 'C']).values & lidar.notnull().values
+        n = valid.sum()
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(3).spawn(20)]
+
+        for i in [0, 7, 19]:
+            idx = rngs[i].integers(0, n, n)
+            y = lidar.values[valid][idx]
+            for a, b, c in [(1, 0.5, 0.2), (2, 1, 1)]:
+                sd = sds.sel(A = a, B = b, C = c).values[valid][idx]
+                stat = stats.sel(A = a, B = b, C = c, iteration = i)
+                assert_allclose(stat['rmse'], np.sqrt(np.mean((sd - y) ** 2)))
+                assert_allclose(stat['mae'], np.mean(np.abs(sd - y)))
+                assert_allclose(stat['pearsonr'], np.corrcoef(sd, y)[0, 1])
+
+        # different seeds give different resamples
+        self.assertFalse(stats['rmse'].equals(bootstrap_stats(sds, lidar, iterations = 20, seed = 4)['rmse']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+from numpy.testing import assert_allclose
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.processing.snow_index import calc_delta_VV, calc_delta_cross_ratio,\
+    calc_delta_gamma, clip_delta_gamma_outlier, calc_snow_index, calc_snow_index_to_snow_depth
+from spicy_snow.processing.param_sweep import sweep_snow_index, sweep_parameters
+
+class TestParameterSweep(unittest.TestCase):
+    """
+    Test functionality of parameter sweep functions
+    """
+
+    @classmethod
+    def setUpTestDataset(self):
+        times = pd.date_range('2020-01-01', periods = 12, freq = '12D')
+        times = sorted(np.concatenate([times, times + pd.Timedelta(days = 6, hours = 3)]))
+        n = len(times)
+
+        backscatter = np.random.randn(10, 10, n, 3) * 3 - 12
+        backscatter[np.random.rand(10, 10, n, 3) < 0.05] = np.nan
+        ims = np.full((10, 10, n), 4)
+        ims[np.random.rand(10, 10, n) < 0.1] = 2
+        x = np.linspace(0, 9, 10)
+        y = np.linspace(10, 19, 10)
+
+        test_ds = xr.Dataset(
+            data_vars = dict(
+                s1 = (["x", "y", "time", "band"], backscatter),
+                ims = (["x", "y", "time"], ims),
+                fcf = (["x", "y"], np.random.rand(10, 10)),
+            ),
+            coords = dict(
+                x = (["x"], x),
+                y = (["y"], y),
+                band = ['VV', 'VH', 'inc'],
+                time = times,
+                relative_orbit = (["time"], np.resize([24, 1], n))))
+
+        return calc_delta_VV(test_ds)
+
+    def test_sweep_matches_retrieval(self):
+        """
+        Test every (A, B, C) of the sweep against the snow depth of the full
+        retrieval chain.
+        """
+        test_ds = self.setUpTestDataset()
+        A, B, C = [1, 2.5], [0, 0.5, 1], [0.2, 0.8]
+        time = test_ds.time.values[17]
+
+        # random subset of pixels
+        mask = xr.DataArray(np.random.rand(10, 10) > 0.3, dims = ['y', 'x'])
+
+        sd = sweep_parameters(test_ds, A, B, C, time, mask = mask)
+
+        self.assertEqual(sd.dims, ('A', 'B', 'C', 'pixel'))
+        self.assertEqual(sd.shape, (2, 3, 2, mask.values.sum()))
+
+        pixel_sel = dict(x = xr.DataArray(sd['x'].values, dims = 'pixel'),
+                         y = xr.DataArray(sd['y'].values, dims = 'pixel'))
+
+        for a in A:
+            ds = calc_delta_cross_ratio(test_ds, A = a)
+            for b in B:
+                ds = calc_delta_gamma(ds, B = b)
+                ds = clip_delta_gamma_outlier(ds)
+                ds = calc_snow_index(ds)
+                for c in C:
+                    ds = calc_snow_index_to_snow_depth(ds, C = c)
+                    expected = ds['snow_depth'].sel(time = time).sel(pixel_sel)
+                    assert_allclose(sd.sel(A = a, B = b, C = c), expected)
+
+    def test_sweep_snow_index_options(self):
+        """
+        Test nearest time selection, missing deltaVV and no ims masking
+        """
+        test_ds = self.setUpTestDataset()
+
+        si = sweep_snow_index(test_ds, 2, 0.5, test_ds.time.values[9] + pd.Timedelta('1 hour'), ims_masking = False)
+        self.assertEqual(si['time'].values, test_ds.time.values[9])
+        self.assertEqual(si.shape, (1, 1, 100))
+
+        ds = calc_delta_cross_ratio(test_ds, A = 2)
+        ds = clip_delta_gamma_outlier(calc_delta_gamma(ds, B = 0.5))
+        ds = calc_snow_index(ds, ims_masking = False)
+        expected = ds['snow_index'].isel(time = 9).transpose('x', 'y').values.ravel()
+        assert_allclose(si.isel(A = 0, B = 0), expected)
+
+        # deltaVV is calculated from s1 if not present
+        si_no_vv = sweep_snow_index(test_ds.drop_vars('deltaVV'), 2, 0.5, test_ds.time.values[9], ims_masking = False)
+        assert_allclose(si_no_vv, si)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import pickle
+from importlib.util import find_spec
 
 from numpy.testing import assert_allclose
 
@@ -12,7 +13,7 @@ from os.path import expanduser
 sys.path.append(expanduser('./'))
 from spicy_snow.processing.s1_preprocessing import s1_power_to_dB, s1_dB_to_power, \
     merge_partial_s1_images, s1_clip_outliers, s1_orbit_averaging, subset_s1_images, \
-    merge_s1_subsets, s1_incidence_angle_masking
+    merge_s1_subsets, s1_incidence_angle_masking, add_confidence_angle, _histogram_quantile
 
 class TestSentinel1PreProcessing(unittest.TestCase):
     """
@@ -234,6 +235,31 @@ class TestSentinel1PreProcessing(unittest.TestCase):
         for i in np.unique(ave_means.relative_orbit):
             assert_allclose(ave_means['s1'].sel(time = ave_means.relative_orbit == i).mean(dim = 'time'), overall_means)
 
+    @unittest.skipUnless(find_spec('dask'), 'dask is not installed')
+    def test_orbit_averaging_chunked(self):
+        """
+        Test orbit averaging of a dask backed dataset (with dask orbit coordinates) matches in memory
+        """
+        test_ds = self.setUpTestDataset()
+        chunked = s1_orbit_averaging(test_ds.chunk({'time': 5}))
+        self.assertTrue(chunked['s1'].chunks)
+        xr.testing.assert_allclose(chunked.compute(), s1_orbit_averaging(test_ds))
+
+    def test_histogram_quantile(self):
+        """
+        Test histogram percentiles (used for chunked datasets) are close to the exact percentiles
+        """
+        rng = np.random.default_rng(0)
+        s1 = xr.DataArray(rng.normal(-12, 4, (2, 30, 40, 40)), dims = ['band', 'time', 'y', 'x'],
+                          coords = dict(band = ['VV', 'VH']))
+        s1[0, :5] = np.nan
+
+        expected = s1.quantile([0.1, 0.9], dim = ['x', 'y', 'time'])
+        thresh = _histogram_quantile(s1, [0.1, 0.9], dim = ['x', 'y', 'time'])
+        self.assertEqual(thresh.dims, expected.dims)
+        # within two bins of the ~50 dB range
+        assert_allclose(thresh, expected, atol = 2 * 50 / 2**16)
+
     def test_orbit_averaging_errors(self):
         test_ds = self.setUpTestDataset()
         
@@ -312,6 +338,47 @@ class TestSentinel1PreProcessing(unittest.TestCase):
 
         self.assertTrue(~ds['s1'].sel(time = test_ds.time[0], x= 0, y = 1, band = 'VV').isnull())
 
+    def test_input_not_modified(self):
+        """
+        Test functions leave the input dataset unchanged when not inplace
+        """
+        test_ds = self.setUpTestDataset()
+        test_ds['absolute_orbit'] = ('time', np.repeat(np.arange(10), [2, 3] * 5))
+        test_ds.attrs['s1_units'] = 'dB'
+        original = test_ds.copy(deep = True)
+
+        for func in [s1_dB_to_power, s1_orbit_averaging, s1_clip_outliers, 
+                     s1_incidence_angle_masking, merge_partial_s1_images, add_confidence_angle]:
+            ds = func(test_ds)
+            self.assertIsNot(ds, test_ds, func.__name__)
+            xr.testing.assert_identical(test_ds, original)
+
+        # inplace flag modifies the dataset without returning it
+        self.assertIsNone(s1_dB_to_power(test_ds, inplace = True))
+        self.assertEqual(test_ds.attrs['s1_units'], 'amp')
+        assert_allclose(test_ds['s1'].sel(band = 'VV'), 10 ** (original['s1'].sel(band = 'VV') / 10))
+
+        # merging drops images so always returns a new dataset
+        with self.assertRaises(TypeError):
+            merge_partial_s1_images(test_ds, inplace = True)
+
+    def test_confidence_angle(self):
+        """
+        Test confidence angle is the mean angle of normalized amplitude changes
+        """
+        test_ds = self.setUpTestDataset()
+        test_ds.attrs['s1_units'] = 'dB'
+
+        ds = add_confidence_angle(test_ds)
+
+        amp = 10 ** (test_ds['s1'].transpose('time', 'band', 'x', 'y').values / 10)
+        dVV, dVH = np.diff(amp[:, 0], axis = 0), np.diff(amp[:, 1], axis = 0)
+        angle = np.angle(np.abs(dVV / dVV.mean()) + np.abs(dVH / dVH.mean()) * 1j).mean(axis = 0)
+
+        self.assertEqual(ds['confidence'].dims, ('x', 'y'))
+        assert_allclose(ds['confidence'].values, angle)
+        self.assertTrue('confidence' not in test_ds)
+
         
         
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import tempfile
+from unittest.mock import patch
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.download.sentinel1 import resolve_granule_metadata, combine_s1_images
+
+class TestGranuleMetadata(unittest.TestCase):
+    """
+    Test resolving Sentinel-1 granule metadata offline with a stub resolver
+    """
+
+    granules = ['S1A_IW_GRDH_1SDV_20200101T010203_20200101T010228_030000_036000_ABCD',
+                'S1B_IW_GRDH_1SDV_20200107T010203_20200107T010228_019000_024000_ABCD',
+                'S1A_IW_GRDH_1SDV_20200113T130203_20200113T130228_030175_036100_ABCD',
+                'S1B_IW_GRDH_1SDV_20200119T130203_20200119T130228_019175_024100_ABCD']
+
+    metadata = pd.DataFrame({'flight_dir': ['descending', 'descending', 'ascending', 'ascending'],
+                             'relative_orbit': [71, 71, 20, 20],
+                             'absolute_orbit': [30000, 19000, 30175, 19175]},
+                            index = pd.Index(granules, name = 'granule'))
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'SPICY_SNOW_CACHE': self.cache_dir.name})
+        self.env.start()
+        self.calls = []
+
+    def tearDown(self):
+        self.env.stop()
+        self.cache_dir.cleanup()
+
+    def resolver(self, granules):
+        # stub of search_granule_metadata recording each call
+        self.calls.append(list(granules))
+        return self.metadata[self.metadata.index.isin(granules)]
+
+    def search_results(self, granules):
+        # asf_search results columns as returned by s1_img_search
+        metadata = self.metadata.loc[granules]
+        return pd.DataFrame({'properties.sceneName': granules,
+                             'properties.flightDirection': metadata['flight_dir'].str.upper().values,
+                             'properties.pathNumber': metadata['relative_orbit'].values,
+                             'properties.orbit': metadata['absolute_orbit'].values})
+
+    def test_resolve_metadata(self):
+        """
+        Test metadata is taken from search results, then cache, then one resolver call
+        """
+        # search results have 2 granules so the other 2 are looked up together
+        metadata = resolve_granule_metadata(self.granules, self.search_results(self.granules[:2]), resolver = self.resolver)
+        pd.testing.assert_frame_equal(metadata, self.metadata, check_dtype = False)
+        self.assertEqual(self.calls, [self.granules[2:]])
+
+        # all granules are cached for the next run
+        metadata = resolve_granule_metadata(self.granules[::-1], resolver = self.resolver)
+        pd.testing.assert_frame_equal(metadata, self.metadata.iloc[::-1], check_dtype = False)
+        self.assertEqual(len(self.calls), 1)
+
+        # no cache and no search results
+        resolve_granule_metadata(self.granules, resolver = self.resolver, cache = False)
+        self.assertEqual(self.calls[-1], self.granules)
+
+        # resolver not finding a granule
+        self.assertRaises(AssertionError, resolve_granule_metadata, self.granules + ['S1A_missing'],
+                          resolver = self.resolver, cache = False)
+
+    def test_combine_s1_images(self):
+        """
+        Test combining images adds metadata coordinates without remote calls
+        """
+        das = {}
+        for granule in self.granules[::-1]:
+            das[granule] = xr.DataArray(np.random.rand(3, 5, 5) + 0.1, dims = ['band', 'y', 'x'],
+                                        coords = dict(band = ['VV', 'VH', 'inc'], y = np.arange(5), x = np.arange(5)))
+
+        ds = combine_s1_images(das, search_results = self.search_results(self.granules), metadata_resolver = self.resolver)
+
+        self.assertEqual(self.calls, [])
+        self.assertEqual(ds.attrs['s1_units'], 'dB')
+        self.assertEqual(list(ds['flight_dir'].values), list(self.metadata['flight_dir']))
+        self.assertEqual(list(ds['relative_orbit'].values), list(self.metadata['relative_orbit']))
+        self.assertEqual(list(ds['absolute_orbit'].values), list(self.metadata['absolute_orbit']))
+        self.assertEqual(list(ds['platform'].values), ['S1A', 'S1B', 'S1A', 'S1B'])
+        self.assertTrue(ds.time.to_index().is_monotonic_increasing)
+
+if __name__ == '__main__':
+    unittest.main()
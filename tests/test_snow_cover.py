@@ -0,0 +1,210 @@
+import unittest
+from unittest.mock import patch
+from numpy.testing import assert_array_equal
+
+import gzip
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray
+import tempfile
+import urllib.request
+from pathlib import Path
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.download import snow_cover
+from spicy_snow.download.snow_cover import get_ims_day_data, download_snow_cover, get_resampling_index, \
+    fetch_ims_days
+from spicy_snow.utils.download import decompress
+from rasterio.warp import transform_bounds
+
+IMS_CRS = '+proj=stere +lat_0=90 +lat_ts=60 +lon_0=-80 +k=1 +x_0=0 +y_0=0 +a=6378137 +b=6356257 +units=m +no_defs'
+
+class TestSnowCover(unittest.TestCase):
+    """
+    Test downloading, caching and reprojecting IMS snow cover from local files
+    """
+
+    def setUp(self):
+        self.serve_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'SPICY_SNOW_CACHE': self.cache_dir.name})
+        self.env.start()
+
+        # 1 km polar stereographic grid around Boise, ID with snow (4) on days 2
+        # and 6, no snow (2) on day 5 and random snow cover on day 8
+        x = -3010000 + np.arange(-50, 50) * 1000 + 500
+        y = -4142000 - np.arange(-50, 50) * 1000 - 500
+        random = np.random.default_rng(0).choice([2, 4], (1, 100, 100))
+        for doy, value in [(2, 4), (5, 2), (6, 4), (8, random)]:
+            ims = xr.DataArray(np.full((1, 100, 100), value, dtype = np.int8), dims = ['time', 'y', 'x'],
+                               coords = dict(time = [0], x = x, y = y), name = 'IMS_Surface_Values')
+            ims.x.attrs = dict(standard_name = 'projection_x_coordinate', units = 'm')
+            ims.y.attrs = dict(standard_name = 'projection_y_coordinate', units = 'm')
+            ims = ims.rio.write_crs(IMS_CRS).rio.write_transform()
+            nc_fp = Path(self.serve_dir.name).joinpath(f'ims2020{doy:03}_1km_v1.3.nc')
+            ims.to_dataset().to_netcdf(nc_fp)
+            with open(nc_fp, 'rb') as f, gzip.open(f'{nc_fp}.gz', 'wb') as gz:
+                gz.write(f.read())
+
+        self.url = patch.object(snow_cover, 'IMS_URL', Path(self.serve_dir.name).as_uri() + '/ims{year}{doy}_1km_v1.3.nc.gz')
+        self.url.start()
+
+        # count requests made to the (local) IMS archive
+        self.requests = []
+        urlopen = urllib.request.urlopen
+        def counting_urlopen(url, *args, **kwargs):
+            self.requests.append(url)
+            return urlopen(url, *args, **kwargs)
+        self.urlopen = patch('urllib.request.urlopen', counting_urlopen)
+        self.urlopen.start()
+
+    def tearDown(self):
+        self.urlopen.stop()
+        self.url.stop()
+        self.env.stop()
+        self.serve_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_decompress(self):
+        """
+        Test streaming decompression from a filepath and a file object
+        """
+        data = np.random.default_rng(0).bytes(3 * 2**20 + 17)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gz_fp = Path(tmp_dir).joinpath('data.gz')
+            with gzip.open(gz_fp, 'wb') as f:
+                f.write(data)
+
+            decompress(gz_fp, Path(tmp_dir).joinpath('from_path'))
+            with open(gz_fp, 'rb') as f:
+                decompress(f, Path(tmp_dir).joinpath('from_file'))
+
+            self.assertEqual(Path(tmp_dir).joinpath('from_path').read_bytes(), data)
+            self.assertEqual(Path(tmp_dir).joinpath('from_file').read_bytes(), data)
+
+            # no partial files left behind
+            self.assertEqual(len(list(Path(tmp_dir).glob('*.tmp'))), 0)
+
+    def test_ims_day_cache(self):
+        """
+        Test missing days use the next available day and cached days are not
+        downloaded again
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ims = get_ims_day_data(2020, '003', tmp_dir)
+            self.assertEqual(len(self.requests), 3)
+            self.assertTrue(self.requests[-1].endswith('ims2020005_1km_v1.3.nc.gz'))
+            self.assertTrue((ims == 2).all())
+
+            # saved by the requested day
+            self.assertTrue(Path(tmp_dir).joinpath('ims2020003_1km_v1.3.nc').exists())
+
+            cached = get_ims_day_data(2020, '003', tmp_dir)
+            self.assertEqual(len(self.requests), 3)
+            xr.testing.assert_identical(ims, cached)
+
+            with self.assertRaises(AssertionError):
+                get_ims_day_data(2020, '010', tmp_dir, max_days = 2)
+
+    def test_ims_window(self):
+        """
+        Test only the window around the bounds is read and it matches the full grid
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            full = get_ims_day_data(2020, '008', tmp_dir)
+            bounds = (-116.2, 43.5, -116.1, 43.6)
+            ims = get_ims_day_data(2020, '008', tmp_dir, bounds = bounds, margin = 2)
+
+            # ~8 x 11 km area (rotated in polar stereographic) and a 2 pixel margin
+            self.assertLess(ims.size, 25 ** 2)
+            self.assertEqual(full.size, 100 ** 2)
+            xr.testing.assert_identical(ims, full.sel(x = ims.x, y = ims.y))
+            self.assertEqual(ims.rio.crs, full.rio.crs)
+
+            # window covers the area in polar stereographic with the margin
+            xmin, ymin, xmax, ymax = transform_bounds('EPSG:4326', full.rio.crs, *bounds, densify_pts = 21)
+            left, bottom, right, top = ims.rio.bounds()
+            self.assertTrue(left <= xmin - 2000 and right >= xmax + 2000)
+            self.assertTrue(bottom <= ymin - 2000 and top >= ymax + 2000)
+
+            # resampling the window is the same as resampling the full grid
+            s1 = xr.DataArray(np.zeros((30, 30)), dims = ['y', 'x'],
+                              coords = dict(x = np.linspace(-116.2, -116.1, 30), y = np.linspace(43.6, 43.5, 30)))
+            s1 = s1.rio.write_crs('EPSG:4326')
+            xr.testing.assert_identical(ims.rio.reproject_match(s1), full.rio.reproject_match(s1))
+
+            with self.assertRaises(AssertionError):
+                get_ims_day_data(2020, '008', tmp_dir, bounds = (10, 40, 11, 41))
+
+    def test_resampling_index(self):
+        """
+        Test the nearest neighbour index matches reprojecting with GDAL and is cached
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ims = get_ims_day_data(2020, '008', tmp_dir).isel(time = 0)
+
+        # grid partially outside of the IMS grid
+        s1 = xr.DataArray(np.zeros((40, 50)), dims = ['y', 'x'],
+                          coords = dict(x = np.linspace(-116.6, -116.0, 50), y = np.linspace(44.2, 43.5, 40)))
+        s1 = s1.rio.write_crs('EPSG:4326')
+
+        index = get_resampling_index(ims, s1)
+        self.assertEqual(index.shape, (40, 50))
+        self.assertTrue((index == -1).any())
+        self.assertEqual(len(list(Path(self.cache_dir.name).joinpath('resampling').glob('*.npy'))), 1)
+
+        # GDAL approximates the transformation (to 1/8 pixel) so pixels near
+        # the edges of source pixels can differ
+        expected = ims.rio.reproject_match(s1, nodata = 0)
+        resampled = np.where(index >= 0, ims.values.ravel()[index], 0)
+        self.assertLess(np.mean(resampled != expected.values), 0.02)
+        assert_array_equal(resampled == 0, expected.values == 0)
+
+        # cached index is reused and different grids get their own index
+        assert_array_equal(get_resampling_index(ims, s1), index)
+        get_resampling_index(ims, s1.isel(x = slice(1, None)))
+        self.assertEqual(len(list(Path(self.cache_dir.name).joinpath('resampling').glob('*.npy'))), 2)
+
+    def test_download_snow_cover(self):
+        """
+        Test each day is downloaded once and reused from the cache between runs
+        """
+        x = np.linspace(-116.2, -116.1, 12)
+        y = np.linspace(43.6, 43.5, 12)
+        times = pd.to_datetime(['2020-01-02T01:00', '2020-01-02T13:00', '2020-01-05T01:00', '2020-01-06T01:00'])
+        s1 = xr.DataArray(np.zeros((4, 1, 12, 12)), dims = ['time', 'band', 'y', 'x'],
+                          coords = dict(time = times, band = ['VV'], x = x, y = y)).rio.write_crs('EPSG:4326')
+        dataset = s1.to_dataset(name = 's1')
+
+        # days fetched ahead of time (e.g. while Sentinel-1 downloads) are not downloaded again
+        fps = fetch_ims_days(times)
+        self.assertEqual(len(fps), 3)
+        self.assertEqual(len(self.requests), 3)
+
+        ds = download_snow_cover(dataset)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(ds['ims'].dims, ('time', 'y', 'x'))
+        self.assertEqual(ds['ims'].dtype, np.uint8)
+        self.assertEqual(ds['ims'].sizes['time'], 4)
+        assert_values = [4, 4, 2, 4]
+        for time, value in zip(times, assert_values):
+            self.assertTrue((ds['ims'].sel(time = time) == value).all())
+        xr.testing.assert_equal(ds['ims'].x, dataset.x)
+
+        # second run of the same days only reads the cache
+        again = download_snow_cover(dataset)
+        self.assertEqual(len(self.requests), 3)
+        xr.testing.assert_identical(ds, again)
+
+        # matches reprojecting each day with GDAL
+        dataset = dataset.isel(time = [0]).assign_coords(time = pd.to_datetime(['2020-01-08']))
+        ds = download_snow_cover(dataset)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            expected = get_ims_day_data(2020, '008', tmp_dir).rio.reproject_match(dataset['s1'])
+        self.assertLess(np.mean(ds['ims'].values != expected.values), 0.02)
+
+if __name__ == '__main__':
+    unittest.main()
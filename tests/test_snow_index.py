@@ -100,6 +100,35 @@ class TestSnowIndex(unittest.TestCase):
         
         assert_allclose(ds1['deltaCR'].isel(time = 2), real3_2_diff)
     
+    def test_delta_vv_cr_multiple_orbits(self):
+        """
+        Test deltaVV and deltaCR against per orbit differencing with interleaved
+        orbits and an orbit with a single image
+        """
+        test_ds = self.setUpTestDataset()
+        orbits = np.resize([24, 65, 24, 3, 65], 25)
+        orbits[7] = 99
+        test_ds = test_ds.assign_coords(relative_orbit = ('time', orbits))
+
+        test_A = 2.5
+        ds = calc_delta_VV(test_ds)
+        ds = calc_delta_cross_ratio(ds, A = test_A)
+
+        CR_ds = test_ds['s1'].sel(band = 'VH') * test_A - test_ds['s1'].sel(band = 'VV')
+
+        for orbit in np.unique(orbits):
+            orbit_times = test_ds.time[test_ds.relative_orbit == orbit]
+
+            # first image of each orbit has no previous image
+            self.assertTrue(ds['deltaVV'].sel(time = orbit_times[0]).isnull().all())
+            self.assertTrue(ds['deltaCR'].sel(time = orbit_times[0]).isnull().all())
+
+            real_vv = test_ds['s1'].sel(time = orbit_times, band = 'VV').diff(dim = 'time')
+            assert_allclose(ds['deltaVV'].sel(time = orbit_times[1:]), real_vv)
+
+            real_cr = CR_ds.sel(time = orbit_times).diff(dim = 'time')
+            assert_allclose(ds['deltaCR'].sel(time = orbit_times[1:]), real_cr)
+
     def test_delta_cr_errors(self):
         """
         test that if units are amplitude calc_delta_vv raises AssertionErro
@@ -539,6 +568,52 @@ class TestSnowIndex(unittest.TestCase):
 
         assert ds['snow_index'].sel(time = '2020-01-02', x = 5, y = 5) != 0
 
+    def test_snow_index_matches_loop(self):
+        """
+        Test the numpy snow index recursion against the label based loop of
+        calc_prev_snow_index over each time step.
+        """
+        def loop_snow_index(dataset, ims_masking = True):
+            dataset = dataset.copy(deep = True)
+            dataset['snow_index'] = xr.zeros_like(dataset['deltaGamma'])
+            repeat = find_repeat_interval(dataset)
+            for ct in dataset.time.values:
+                prev_si = calc_prev_snow_index(dataset, ct, repeat)
+                prev_si = prev_si.where(~prev_si.isnull(), 0)
+                dataset['snow_index'].loc[dict(time = ct)] = prev_si + dataset['deltaGamma'].sel(time = ct)
+                if ims_masking:
+                    dataset['snow_index'].loc[dict(time = ct)] = dataset['snow_index'].sel(time = ct).where(dataset['ims'].sel(time = ct) == 4, 0)
+                dataset['snow_index'].loc[dict(time = ct)] = \
+                    dataset['snow_index'].sel(time = ct).where((dataset['snow_index'].sel(time = ct).isnull()) | (dataset['snow_index'].sel(time = ct) > 0), 0)
+            return dataset
+
+        for repeat_days, orbits in [(6, [24, 1]), (12, [24, 1, 95])]:
+            times = pd.date_range('2020-01-01', periods = 18, freq = f'{repeat_days}D')
+            times = sorted(np.concatenate([times + pd.Timedelta(days = i, hours = 3 * i) for i in range(len(orbits))]))
+            n = len(times)
+
+            deltaGamma = np.random.randn(10, 10, n)
+            deltaGamma[np.random.rand(10, 10, n) < 0.1] = np.nan
+            deltaGamma[:, :, :len(orbits)] = np.nan
+            ims = np.full((10, 10, n), 4)
+            ims[np.random.rand(10, 10, n) < 0.1] = 2
+
+            test_ds = xr.Dataset(
+                data_vars = dict(
+                    deltaGamma = (["x", "y", "time"], deltaGamma),
+                    ims = (["x", "y", "time"], ims),
+                ),
+                coords = dict(
+                    time = times,
+                    relative_orbit = (["time"], np.resize(orbits, n))))
+
+            for ims_masking in [True, False]:
+                expected = loop_snow_index(test_ds, ims_masking = ims_masking)
+                ds = calc_snow_index(test_ds, ims_masking = ims_masking)
+
+                self.assertEqual(ds['snow_index'].dims, expected['snow_index'].dims)
+                assert_allclose(ds['snow_index'], expected['snow_index'])
+
     def test_snow_index_to_depth(self):
 
         backscatter = np.random.randn(10, 10, 3, 3)
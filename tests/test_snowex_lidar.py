@@ -0,0 +1,109 @@
+import unittest
+from numpy.testing import assert_allclose
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray
+import tempfile
+from glob import glob
+from os.path import join
+from rasterio.enums import Resampling
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.download.snowex_lidar import make_site_ds, get_site_extent
+
+class TestMakeSiteDs(unittest.TestCase):
+    """
+    Test assembling lidar tifs of a site into one dataset
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.lidar_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+
+        # 3 m UTM tifs of each flight with the second flight offset by 37 pixels
+        for img_type in ['SD', 'VH', 'DEM']:
+            for date, offset in [('20200201', 0), ('20210301', 37)]:
+                x = 560000 + (np.arange(300) + offset) * 3 + 1.5
+                y = 4830000 - (np.arange(250) + offset) * 3 - 1.5
+                img = xr.DataArray(rng.random((1, 250, 300)).astype(np.float32), dims = ['band', 'y', 'x'],
+                                   coords = dict(band = [1], x = x, y = y))
+                img = img.rio.write_crs('EPSG:32611').rio.write_nodata(-9999)
+                img.rio.to_raster(join(cls.lidar_dir.name, f'SNEX20_QSI_{img_type}_3M_USIDBS_{date}_{date}.tif'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.lidar_dir.cleanup()
+
+    def files(self, img_type):
+        return sorted(glob(join(self.lidar_dir.name, f'*_{img_type}_*.tif')))
+
+    def test_make_site_ds(self):
+        """
+        Test every flight is warped onto one EPSG:4326 grid covering all tifs
+        """
+        ds = make_site_ds('USIDBS', self.lidar_dir.name, max_workers = 3)
+        self.assertEqual(set(ds.data_vars), {'lidar-sd', 'lidar-vh', 'lidar-dem'})
+        self.assertEqual(list(ds.time.values), list(pd.to_datetime(['2020-02-01', '2021-03-01'])))
+        self.assertEqual(ds.rio.crs.to_epsg(), 4326)
+
+        # same as reprojecting a single flight on its own
+        single = make_site_ds('USIDBS', self.lidar_dir.name, dates = ['2020-02-01'])
+        self.assertEqual(single.sizes['time'], 1)
+        expected = rioxarray.open_rasterio(self.files('SD')[0]).squeeze('band', drop = True).rio.reproject('EPSG:4326')
+        assert_allclose(single['lidar-sd'].isel(time = 0).values, expected.values)
+
+        # the grid of both flights covers the offset second flight
+        left, bottom, right, top = ds.rio.bounds()
+        s_left, s_bottom, s_right, s_top = single.rio.bounds()
+        self.assertTrue(left <= s_left and top >= s_top and right > s_right and bottom < s_bottom)
+        for img_type in ['SD', 'VH', 'DEM']:
+            for i, fp in enumerate(self.files(img_type)):
+                valid = ds['lidar-' + img_type.lower()].isel(time = i) != -9999
+                self.assertGreater(valid.mean(), 0.5)
+
+        # extent from the tif headers and filenames matches the warped dataset
+        area, dates = get_site_extent('USIDBS', self.lidar_dir.name)
+        assert_allclose(area.bounds, ds.rio.bounds())
+        self.assertEqual(list(dates), list(ds.time.values))
+
+        # results do not depend on the number of workers
+        xr.testing.assert_identical(ds, make_site_ds('USIDBS', self.lidar_dir.name, max_workers = 1))
+
+        with self.assertRaises(AssertionError):
+            make_site_ds('USIDMC', self.lidar_dir.name)
+
+    def test_make_site_ds_target(self):
+        """
+        Test tifs are averaged straight onto a target grid
+        """
+        # ~65 m grid partly outside of the first flight
+        x = np.arange(-116.2546, -116.2420, 0.0008)
+        y = np.arange(43.6200, 43.6110, -0.0006)
+        target = xr.Dataset({'snow_depth': (('time', 'y', 'x'), np.zeros((1, len(y), len(x))))},
+                            coords = dict(time = [0], x = x, y = y)).rio.write_crs('EPSG:4326')
+
+        ds = make_site_ds('USIDBS', self.lidar_dir.name, target = target)
+        self.assertEqual(ds['lidar-sd'].shape, (2, len(y), len(x)))
+        xr.testing.assert_equal(ds.x, target.x)
+        xr.testing.assert_equal(ds.y, target.y)
+
+        # only the window of each tif is read but matches warping the whole tif
+        for img_type in ['SD', 'DEM']:
+            for i, fp in enumerate(self.files(img_type)):
+                img = rioxarray.open_rasterio(fp).squeeze('band', drop = True)
+                expected = img.rio.reproject_match(target, resampling = Resampling.average)
+                assert_allclose(ds['lidar-' + img_type.lower()].isel(time = i).values, expected.values, rtol = 1e-5)
+
+        # averaging 3 m pixels into ~65 m pixels smooths uniform noise
+        sd = ds['lidar-sd'].where(ds['lidar-sd'] != -9999)
+        self.assertGreater(float(sd.notnull().mean()), 0.5)
+        self.assertTrue((sd.isel(time = 0).isnull() & sd.isel(time = 1).notnull()).any())
+        self.assertLess(float(sd.std()), 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+from unittest.mock import patch
+from numpy.testing import assert_allclose
+
+import multiprocessing
+import numpy as np
+import pandas as pd
+import xarray as xr
+import shapely.geometry
+import tempfile
+from pathlib import Path
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow import tiling
+from spicy_snow.tiling import get_tiles, retrieve_snow_depth_tiled
+from spicy_snow.retrieval import append_snow_depth
+from spicy_snow.IO.user_area import get_area_grid
+
+RES = 0.01
+
+# relative and absolute orbit of each pass and its day
+PASSES = [(20, 100, '2020-01-01'), (93, 105, '2020-01-04'), (20, 110, '2020-01-13')]
+
+def fake_retrieval(area, dates, work_dir = './', job_name = None, existing_job_name = None, **kwargs):
+    """
+    Retrieval of a tile with snow depth of x + y + pass number. Passes are a
+    few seconds apart in each tile and tiles west of -116 miss the second pass.
+    """
+    (height, width), transform = get_area_grid(area, resolution = RES)
+    x = transform.c + (np.arange(width) + 0.5) * RES
+    y = transform.f - (np.arange(height) + 0.5) * RES
+    xx, yy = np.meshgrid(x, y)
+
+    xmin = area.bounds[0]
+    passes = [p for i, p in enumerate(PASSES) if not (i == 1 and xmin < -116)]
+    offset = pd.Timedelta(seconds = int(abs(xmin * 10)) % 7)
+    times = [pd.to_datetime(day) + offset for _, _, day in passes]
+    snow_depth = np.stack([xx + yy + PASSES.index(p) for p in passes])
+
+    ds = xr.Dataset(
+        data_vars = dict(snow_depth = (['time', 'y', 'x'], snow_depth),
+                         s1 = (['time', 'band', 'y', 'x'], np.repeat(snow_depth[:, None], 2, axis = 1)),
+                         fcf = (['y', 'x'], (xx - yy).astype(np.float32))),
+        coords = dict(time = times, band = ['VV', 'VH'], y = y, x = x,
+                      relative_orbit = ('time', [p[0] for p in passes]),
+                      absolute_orbit = ('time', [p[1] for p in passes]),
+                      flight_dir = ('time', ['ascending'] * len(passes))),
+        attrs = {'param_A': 2.5, 'bounds': area.bounds, 's1_percentiles_S1A-ascending': [-20, -25, -5, -10]})
+
+    return ds.rio.write_crs('EPSG:4326')
+
+class TestTiling(unittest.TestCase):
+    """
+    Test tiled retrievals and mosaicking
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.area = shapely.geometry.box(-116.234, 43.21, -115.42, 43.88)
+        patches = [patch.object(tiling, 'get_fcf_fp'), patch.object(tiling, 's1_img_search'),
+                   patch.object(tiling, 'hyp3_pipeline')]
+        self.mocks = {p.attribute: p.start() for p in patches}
+        self.addCleanup(lambda: [p.stop() for p in patches])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_tiles(self):
+        """
+        Test tiles are aligned to the tile and pixel grid and cover the area
+        """
+        tiles = get_tiles(self.area, tile_size = 0.5, resolution = RES)
+        self.assertEqual(len(tiles), 6)
+
+        # north west tile first and snapped outward to pixels
+        first = list(tiles.values())[0]
+        assert_allclose(first.bounds, (-116.24, 43.5, -116, 43.88))
+        assert_allclose(shapely.unary_union(list(tiles.values())).bounds, (-116.24, 43.21, -115.42, 43.88))
+
+        for tile in tiles.values():
+            assert_allclose(np.array(tile.bounds) / RES, np.round(np.array(tile.bounds) / RES), atol = 1e-6)
+
+        # tiles not touching a non rectangular area are dropped
+        triangle = shapely.geometry.Polygon([(-116.2, 43.2), (-115.1, 43.2), (-115.1, 44.4)])
+        self.assertEqual(len(get_tiles(triangle, tile_size = 0.5, resolution = RES)), 6)
+
+        with self.assertRaises(AssertionError):
+            get_tiles(self.area, tile_size = 0.015, resolution = RES)
+
+    def run_tiled(self, **kwargs):
+        return retrieve_snow_depth_tiled(self.area, ('2020-01-01', '2020-02-01'), work_dir = self.tmp_dir.name,
+                                         job_name = 'test', tile_size = 0.5, resolution = RES, **kwargs)
+
+    def test_mosaic(self):
+        """
+        Test tiles are mosaicked onto one grid with passes combined across tiles
+        """
+        with patch.object(tiling, 'retrieve_snow_depth', side_effect = fake_retrieval) as retrieval:
+            ds = self.run_tiled(max_workers = 1)
+        self.assertEqual(retrieval.call_count, 6)
+
+        # hyp3 jobs of the whole area are submitted once and shared by every tile
+        self.mocks['s1_img_search'].assert_called_once_with(self.area, ('2020-01-01', '2020-02-01'))
+        self.mocks['hyp3_pipeline'].assert_called_once()
+        self.assertEqual(self.mocks['hyp3_pipeline'].call_args.kwargs['existing_job_name'], 'test')
+        self.assertEqual({(c.kwargs['job_name'], c.kwargs['existing_job_name']) for c in retrieval.call_args_list},
+                         {('test', 'test')})
+
+        # one time step per pass at the first time of the pass
+        self.assertEqual(ds.sizes['time'], 3)
+        self.assertEqual(list(ds.absolute_orbit.values), [100, 105, 110])
+        self.assertEqual(list(ds.time.values), list(pd.to_datetime([day for _, _, day in PASSES])))
+
+        # grid covers the area without gaps
+        self.assertEqual((ds.sizes['y'], ds.sizes['x']), (67, 82))
+        assert_allclose(ds.rio.bounds(), (-116.24, 43.21, -115.42, 43.88), atol = 1e-9)
+        self.assertEqual(ds.rio.crs.to_epsg(), 4326)
+        xx, yy = np.meshgrid(ds.x, ds.y)
+
+        for i in range(3):
+            expected = xx + yy + i
+            if i == 1:
+                expected[:, ds.x.values < -116] = np.nan
+            assert_allclose(ds['snow_depth'].isel(time = i).values, expected)
+            assert_allclose(ds['s1'].isel(time = i, band = 1).values, expected)
+        assert_allclose(ds['fcf'].values, xx - yy, rtol = 1e-6)
+        self.assertEqual(ds.attrs['param_A'], 2.5)
+        self.assertNotIn('s1_percentiles_S1A-ascending', ds.attrs)
+        self.assertEqual(ds.attrs['mosaic_tiles'], 6)
+        with self.assertRaises(AssertionError):
+            append_snow_depth(Path(self.tmp_dir.name).joinpath('test.nc'), work_dir = self.tmp_dir.name)
+
+        # chunked by tile
+        self.assertEqual(ds['snow_depth'].encoding['chunksizes'], (1, 38, 24))
+        ds.close()
+
+    def test_skip_and_failures(self):
+        """
+        Test finished tiles are skipped and failed tiles are retried
+        """
+        def failing_retrieval(area, *args, **kwargs):
+            if area.bounds[0] >= -116:
+                raise AssertionError('Need at least 4 images to run')
+            return fake_retrieval(area, *args, **kwargs)
+
+        with patch.object(tiling, 'retrieve_snow_depth', side_effect = failing_retrieval):
+            ds = self.run_tiled(max_workers = 1)
+        self.assertEqual(np.isnan(ds['fcf'].sel(x = slice(-116, None))).all(), True)
+        ds.close()
+        self.assertEqual(len(list(Path(self.tmp_dir.name).joinpath('tiles').glob('*.nc'))), 2)
+
+        with patch.object(tiling, 'retrieve_snow_depth', side_effect = fake_retrieval) as retrieval:
+            ds = self.run_tiled(max_workers = 1)
+        self.assertEqual(retrieval.call_count, 4)
+        self.assertFalse(np.isnan(ds['fcf']).any())
+        ds.close()
+
+        with patch.object(tiling, 'retrieve_snow_depth', side_effect = AssertionError):
+            with self.assertRaises(AssertionError):
+                retrieve_snow_depth_tiled(shapely.geometry.box(-110, 40, -109.5, 40.5), ('2020-01-01', '2020-02-01'),
+                                          work_dir = self.tmp_dir.name, tile_size = 0.5, resolution = RES, max_workers = 1)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', 'patched retrieval needs forked workers')
+    def test_parallel(self):
+        """
+        Test worker processes give the same mosaic
+        """
+        with patch.object(tiling, 'retrieve_snow_depth', side_effect = fake_retrieval):
+            serial = self.run_tiled(max_workers = 1, outfp = Path(self.tmp_dir.name).joinpath('serial.nc')).load()
+            for fp in Path(self.tmp_dir.name).joinpath('tiles').glob('*.nc'):
+                fp.unlink()
+            parallel = self.run_tiled(max_workers = 3).load()
+        xr.testing.assert_identical(serial, parallel)
+
+if __name__ == '__main__':
+    unittest.main()
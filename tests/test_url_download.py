@@ -0,0 +1,230 @@
+import unittest
+
+import re
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+import numpy as np
+import requests
+
+import sys
+from os.path import expanduser
+sys.path.append(expanduser('./'))
+from spicy_snow.utils.download import url_download
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Keep-alive file server of in memory files with byte range support that
+    records requests and can fail or close connections early
+    """
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    requests = []
+    # number of requests to fail with 503 and to cut off after half the bytes
+    fail = 0
+    cut = 0
+    ranges = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_file_headers(self):
+        data = RangeHandler.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return None, None
+
+        if RangeHandler.fail > 0:
+            RangeHandler.fail -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None, None
+
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and RangeHandler.ranges:
+            first = int(match.group(1))
+            last = int(match.group(2)) if match.group(2) else len(data) - 1
+            if first >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None, None
+            body = data[first:last + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{len(data)}')
+        else:
+            body = data
+            self.send_response(200)
+
+        if RangeHandler.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"test"')
+        self.end_headers()
+        return body, data
+
+    def do_HEAD(self):
+        RangeHandler.requests.append(('HEAD', self.path, None, self.client_address[1]))
+        self.send_file_headers()
+
+    def do_GET(self):
+        RangeHandler.requests.append(('GET', self.path, self.headers.get('Range'), self.client_address[1]))
+        body, data = self.send_file_headers()
+        if body is None:
+            return
+
+        if RangeHandler.cut > 0:
+            RangeHandler.cut -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+class TestUrlDownload(unittest.TestCase):
+    """
+    Test resumable, segmented downloads against a local http server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+        rng = np.random.default_rng(0)
+        RangeHandler.files = {f'/{name}.tif': rng.bytes(size) for name, size in
+                              [('small', 10_000), ('large', 1_000_003)]}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        RangeHandler.requests.clear()
+        RangeHandler.fail, RangeHandler.cut, RangeHandler.ranges = 0, 0, True
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.tmp_dir.cleanup()
+
+    def download(self, name, **kwargs):
+        out_fp = Path(self.tmp_dir.name).joinpath(f'{name}.tif')
+        kwargs = dict(verbose = False, backoff = 0, session = self.session) | kwargs
+        url_download(f'{self.url}/{name}.tif', out_fp, **kwargs)
+        return out_fp
+
+    def gets(self):
+        return [r for r in RangeHandler.requests if r[0] == 'GET']
+
+    def test_download(self):
+        """
+        Test files are downloaded, renamed from .part and reuse one connection
+        """
+        out_fp = self.download('small')
+        self.assertEqual(out_fp.read_bytes(), RangeHandler.files['/small.tif'])
+        self.assertEqual(list(Path(self.tmp_dir.name).glob('*.part*')), [])
+
+        # existing files are skipped unless overwriting
+        self.download('small')
+        self.assertEqual(len(self.gets()), 1)
+        self.download('small', overwrite = True)
+        self.download('large', segments = 1)
+        self.assertEqual(len(self.gets()), 3)
+
+        # one kept alive connection for every request
+        self.assertEqual(len(set(r[3] for r in RangeHandler.requests)), 1)
+
+    def test_resume(self):
+        """
+        Test partial downloads are resumed with a range request
+        """
+        data = RangeHandler.files['/large.tif']
+        part_fp = Path(self.tmp_dir.name).joinpath('large.tif.part')
+        part_fp.write_bytes(data[:400_000])
+
+        out_fp = self.download('large', segments = 1)
+        self.assertEqual(out_fp.read_bytes(), data)
+        self.assertEqual([r[2] for r in self.gets()], ['bytes=400000-'])
+
+        # server without range support sends the whole file again
+        RangeHandler.requests.clear()
+        RangeHandler.ranges = False
+        part_fp.write_bytes(data[:400_000])
+        self.assertEqual(self.download('large', overwrite = True).read_bytes(), data)
+        self.assertEqual([r[2] for r in self.gets()], ['bytes=400000-'])
+
+    def test_retry(self):
+        """
+        Test server errors and closed connections are retried and resumed
+        """
+        data = RangeHandler.files['/large.tif']
+
+        RangeHandler.fail = 3
+        self.assertEqual(self.download('small').read_bytes(), RangeHandler.files['/small.tif'])
+
+        # closed connection resumes where it stopped
+        RangeHandler.requests.clear()
+        RangeHandler.cut = 1
+        self.assertEqual(self.download('large', segments = 1).read_bytes(), data)
+        # (up to one chunk of the bytes read before the connection closed is lost)
+        ranges = [r[2] for r in self.gets()]
+        self.assertEqual(ranges[0], None)
+        self.assertGreater(int(re.match(r'bytes=(\d+)-$', ranges[1]).group(1)), len(data) // 2 - 2**16)
+
+        # gives up after the retries
+        RangeHandler.fail = 10
+        with self.assertRaises(requests.HTTPError):
+            self.download('small', overwrite = True, retries = 2)
+        RangeHandler.fail = 0
+
+        # missing files are not retried
+        RangeHandler.requests.clear()
+        with self.assertRaises(requests.HTTPError):
+            self.download('missing')
+        self.assertEqual(len(self.gets()), 1)
+
+    def test_segments(self):
+        """
+        Test large files are downloaded in parallel byte ranges
+        """
+        data = RangeHandler.files['/large.tif']
+        out_fp = self.download('large', segments = 4, min_segment_size = 100_000)
+        self.assertEqual(out_fp.read_bytes(), data)
+
+        ranges = sorted(r[2] for r in self.gets())
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0], 'bytes=0-249999')
+        self.assertEqual(list(Path(self.tmp_dir.name).glob('*.part*')), [])
+
+        # a segment cut off is retried
+        RangeHandler.requests.clear()
+        RangeHandler.cut = 1
+        out_fp = self.download('large', segments = 4, min_segment_size = 100_000, overwrite = True)
+        self.assertEqual(out_fp.read_bytes(), data)
+        self.assertEqual(len(self.gets()), 5)
+
+        # interrupted segmented downloads only download the unfinished segments
+        RangeHandler.requests.clear()
+        part_fp = Path(self.tmp_dir.name).joinpath('large.tif.part')
+        part_fp.write_bytes(data[:500_001] + bytes(len(data) - 500_001))
+        Path(f'{part_fp}.segments').write_text('[[0, 249999], [250000, 500000]]')
+        out_fp = self.download('large', segments = 4, min_segment_size = 100_000, overwrite = True)
+        self.assertEqual(out_fp.read_bytes(), data)
+        self.assertEqual(sorted(r[2] for r in self.gets()), ['bytes=500001-750001', 'bytes=750002-1000002'])
+
+        # small files use one stream
+        RangeHandler.requests.clear()
+        self.download('small', segments = 4, min_segment_size = 100_000)
+        self.assertEqual([r[2] for r in self.gets()], [None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import pickle
+from numpy.testing import assert_allclose
 
 import sys
 from os.path import expanduser
@@ -11,7 +12,50 @@ sys.path.append(expanduser('.'))
 from spicy_snow.processing.snow_index import calc_delta_gamma, clip_delta_gamma_outlier, calc_snow_index
 
 from spicy_snow.processing.wet_snow import id_newly_wet_snow, id_newly_frozen_snow,\
-    id_wet_negative_si, flag_wet_snow
+    id_wet_negative_si, flag_wet_snow, get_wet_snow_state
+
+def loop_flag_wet_snow(dataset):
+    """
+    Per time step implementation of flag_wet_snow used to check the numpy scan.
+    """
+    dataset = dataset.copy(deep = True)
+    dataset['wet_snow'] = xr.zeros_like(dataset['wet_flag'])
+    dataset['perma_wet'] = xr.zeros_like(dataset['wet_flag'])
+
+    for orbit in np.unique(dataset['relative_orbit'].values):
+        orbit_dataset = dataset.sel(time = dataset.relative_orbit == orbit)
+        prev_time = None
+        for ts in orbit_dataset.time:
+            if prev_time is not None:
+                dataset['wet_snow'].loc[dict(time = ts)] = dataset.sel(time = prev_time)['wet_snow']
+            step = dataset.sel(time = ts)
+            wet_snow = xr.where(~step['wet_flag'].isnull(), step['wet_snow'] + step['wet_flag'], np.nan)
+            wet_snow = xr.where(~step['alt_wet_flag'].isnull(), wet_snow + step['alt_wet_flag'], np.nan)
+            wet_snow = wet_snow.where((wet_snow < 1) | wet_snow.isnull(), 1)
+            wet_snow = xr.where(~step['freeze_flag'].isnull(), wet_snow - step['freeze_flag'], np.nan)
+            wet_snow = wet_snow.where((wet_snow > 0) | wet_snow.isnull(), 0)
+            wet_snow = wet_snow.where(step['ims'] == 4, 0)
+            wet_snow = wet_snow.where(~step['s1'].sel(band = 'VV').isnull(), np.nan)
+            dataset['wet_snow'].loc[dict(time = ts)] = wet_snow
+            prev_time = ts
+
+        melt_season = (dataset['time.month'] > 1) & (dataset['time.month'] < 8)
+        melt_orbit = (melt_season & (dataset.relative_orbit == orbit))
+        if melt_orbit.sum() < 4:
+            continue
+
+        perma_wet = dataset['wet_flag'].loc[dict(time = melt_orbit)] + dataset['alt_wet_flag'].loc[dict(time = melt_orbit)]
+        perma_wet = perma_wet.where((perma_wet <= 1) | perma_wet.isnull(), 1)
+        perma_wet = perma_wet.rolling(time = 4).mean()
+        perma_wet = perma_wet.rolling(time = len(orbit_dataset.time), min_periods = 1).max()
+        perma_wet = perma_wet.where(~dataset['s1'].sel(dict(time = melt_orbit, band = 'VV')).isnull(), np.nan)
+        perma_wet = perma_wet.where(dataset['ims'].sel(dict(time = melt_orbit)) == 4, 0)
+        dataset['perma_wet'].loc[dict(time = melt_orbit)] = perma_wet
+
+    dataset['perma_wet'] = dataset['perma_wet'].where(~dataset['perma_wet'].isnull(), 0)
+    dataset['wet_snow'] = dataset['wet_snow'].where(dataset['perma_wet'] < 0.5, 1)
+
+    return dataset
 
 class TestWetSnowFlags(unittest.TestCase):
     """
@@ -611,6 +655,87 @@ class TestWetSnowFlags(unittest.TestCase):
         self.assertEqual(ds['wet_snow'].sel(time = ds.time[7]).loc[dict(x = 3, y = 3)], 0)
 
         self.assertTrue(np.isnan(ds['wet_snow'].loc[dict(time = ds.time[15], x = 4, y = 4)].values))
-        
+
+    def test_flag_wet_snow_matches_loop(self):
+        """
+        Test the numpy wet snow scan against the per time step loop on the
+        class fixture and on random flags over two melt seasons.
+        """
+        ds = id_newly_wet_snow(self.test_ds)
+        ds = id_wet_negative_si(ds)
+        ds = id_newly_frozen_snow(ds)
+
+        expected = loop_flag_wet_snow(ds)
+        ds = flag_wet_snow(ds)
+
+        for var in ['wet_snow', 'perma_wet']:
+            self.assertEqual(ds[var].dims, expected[var].dims)
+            assert_allclose(ds[var], expected[var])
+
+        times = pd.date_range("2019-10-01", end = '2021-07-30', freq = '6D')
+        n = len(times)
+        wet_flag = (np.random.rand(10, 10, n) < 0.2).astype(float)
+        alt_wet_flag = (np.random.rand(10, 10, n) < 0.2).astype(float)
+        freeze_flag = (np.random.rand(10, 10, n) < 0.2).astype(float)
+        s1 = np.random.randn(10, 10, n, 3)
+        s1[np.random.rand(10, 10, n) < 0.05, 0] = np.nan
+        wet_flag[np.random.rand(10, 10, n) < 0.05] = np.nan
+        freeze_flag[np.random.rand(10, 10, n) < 0.05] = np.nan
+        ims = np.full((10, 10, n), 4, dtype = int)
+        ims[np.random.rand(10, 10, n) < 0.05] = 2
+
+        ds = xr.Dataset(data_vars = dict(
+                        wet_flag = (["x", "y", "time"], wet_flag),
+                        alt_wet_flag = (["x", "y", "time"], alt_wet_flag),
+                        freeze_flag = (["x", "y", "time"], freeze_flag),
+                        s1 = (["x", "y", "time", "band"], s1),
+                        ims = (["x", "y", "time"], ims)
+                    ),
+            coords = dict(
+                        time = times,
+                        band = ["VV", "VH", "inc"],
+                        relative_orbit = (["time"], np.resize([1, 24, 95], n)))
+        )
+
+        expected = loop_flag_wet_snow(ds)
+        ds = flag_wet_snow(ds)
+
+        for var in ['wet_snow', 'perma_wet']:
+            assert_allclose(ds[var], expected[var])
+
+    def test_flag_wet_snow_state(self):
+        """
+        Test continuing flag_wet_snow from the state of earlier time steps
+        matches flagging the whole time series.
+        """
+        rng = np.random.default_rng(1)
+        times = pd.date_range("2019-10-01", end = '2021-07-30', freq = '6D')
+        n = len(times)
+        flags = {name: (rng.random((n, 6, 6)) < 0.2).astype(float) for name in ['wet_flag', 'alt_wet_flag', 'freeze_flag']}
+        flags['wet_flag'][rng.random((n, 6, 6)) < 0.05] = np.nan
+        s1 = rng.normal(size = (n, 3, 6, 6))
+        s1[:, 0][rng.random((n, 6, 6)) < 0.05] = np.nan
+        ims = np.where(rng.random((n, 6, 6)) < 0.05, 2, 4)
+
+        ds = xr.Dataset(data_vars = dict(s1 = (["time", "band", "y", "x"], s1), ims = (["time", "y", "x"], ims),
+                                         **{name: (["time", "y", "x"], flag) for name, flag in flags.items()}),
+                        coords = dict(time = times, band = ["VV", "VH", "inc"],
+                                      relative_orbit = (["time"], np.resize([1, 24, 95], n))))
+
+        # split in the middle of a melt season and again with a new orbit in the last part
+        ds['relative_orbit'] = ds['relative_orbit'].where(ds.time < times[100], 12)
+        expected = flag_wet_snow(ds)
+
+        state = None
+        for part in [slice(0, 80), slice(80, 83), slice(83, 100), slice(100, None)]:
+            result = flag_wet_snow(ds.isel(time = part), state = state)
+            for var in ['wet_snow', 'perma_wet']:
+                assert_allclose(result[var], expected[var].isel(time = part))
+            state = get_wet_snow_state(ds.isel(time = part), state = state)
+
+        self.assertEqual(list(state['orbit'].values), [1, 24, 95, 12])
+        self.assertEqual(list(state['melt_count'].values), [3, 3, 3, 3])
+        self.assertEqual(state['melt_flags'].dims, ('orbit', 'lag', 'y', 'x'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -5,11 +5,13 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import shapely
+import tracemalloc
 
 import sys
 from os.path import expanduser
 sys.path.append(expanduser('./'))
 from spicy_snow import retrieve_snow_depth
+from spicy_snow.retrieval import retrieval_from_parameters
 
 class TestWrappers(unittest.TestCase):
     """
@@ -40,4 +42,37 @@ class TestWrappers(unittest.TestCase):
         # test params
         self.assertRaises(AssertionError, retrieve_snow_depth, area, dates, '/tmp', 'job_name_test', 'job_name_test', True, 'out.nc', params = [10, 1])
 
-        self.assertRaises(AssertionError, retrieve_snow_depth, area, dates, '/tmp', 'job_name_test', 'job_name_test', True, 'out.nc', params = 10)
\ No newline at end of file
+        self.assertRaises(AssertionError, retrieve_snow_depth, area, dates, '/tmp', 'job_name_test', 'job_name_test', True, 'out.nc', params = 10)
+
+    def test_retrieval_from_parameters_memory(self):
+        """
+        Test the parameter retrieval leaves the input unchanged and does not copy
+        the dataset at every step
+        """
+        rng = np.random.default_rng(0)
+        times = pd.date_range('2020-01-01', periods = 40, freq = '6D')
+        test_ds = xr.Dataset(
+            data_vars = dict(
+                s1 = (["time", "band", "y", "x"], rng.normal(-12, 4, (40, 3, 100, 100))),
+                deltaVV = (["time", "y", "x"], rng.normal(0, 1, (40, 100, 100))),
+                ims = (["time", "y", "x"], np.full((40, 100, 100), 4)),
+                fcf = (["y", "x"], rng.uniform(0, 1, (100, 100))),
+            ),
+            coords = dict(
+                band = ['VV', 'VH', 'inc'],
+                time = times,
+                relative_orbit = (["time"], np.resize([24, 65], 40))),
+            attrs = dict(s1_units = 'dB'))
+        original = test_ds.copy(deep = True)
+
+        tracemalloc.start()
+        ds = retrieval_from_parameters(test_ds, A = 2.5, B = 0.2, C = 0.55)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        xr.testing.assert_identical(test_ds, original)
+        self.assertTrue('snow_depth' in ds and 'wet_snow' in ds)
+
+        # new variables add 9 (time, y, x) arrays ~ 2x the input so per step
+        # copies of the dataset would go well past 3x
+        self.assertLess(peak, 3 * test_ds.nbytes)